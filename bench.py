@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Startup and end-to-end benchmark for search.py.
+
+Usage:
+    python bench.py [--runs N] [--baseline REF]
+    python bench.py --burst [--rounds N] [--interval-ms MS]
+
+Reports the import cost of ``search_core`` measured with ``python -X
+importtime`` and the wall time of real ``python3 search.py <query>`` launches,
+as Alfred runs them, for a few commands, each against a synthetic tree and an
+isolated workflow data directory. With ``--baseline``, the search.py of that
+git ref is timed the same way, side by side.
+
+``--burst`` is a load test instead: it types each of BURSTS one character at
+a time, starting a ``search.py`` per keystroke without waiting for the
+previous one, as Alfred does. It reports p50/p99 latency, how many runs were
+superseded, the hit rate of each shared cache, and checks that every answer
+and every cache file can still be parsed afterwards.
+"""
+
+import argparse
+import io
+import json
+import marshal
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+ROOT = Path(__file__).resolve().parent
+SEARCH = ROOT / "search.py"
+
+COMMANDS = ["cd..", "ls", "tree", "report", "find report"]
+
+# Queries typed character by character in --burst mode
+BURSTS = ["report", "du 2", "recent 30", "size 1k", "tree", "dupes", "changes"]
+
+
+def build_tree(root: Path, dirs: int = 20, files: int = 25) -> None:
+    """Creates a small synthetic project tree under root."""
+    for d in range(dirs):
+        sub = root / f"dir{d:02d}" / "nested"
+        sub.mkdir(parents=True)
+        for f in range(files):
+            (sub.parent / f"file{f:03d}.txt").write_text("x" * f)
+            (sub / f"report{d}_{f}.md").write_text("report")
+
+
+def alfred_env(tree: Path, data: Path, **extra: str) -> Dict[str, str]:
+    """Returns the environment Alfred gives search.py, scoped to tree.
+
+    data gets a settings.json without search paths, so every query stays in
+    the synthetic tree instead of also walking the real home folders.
+    """
+    data.mkdir(parents=True, exist_ok=True)
+    # Workers would outlive their run and skew the latencies
+    settings = {"search_paths": [], "progressive_results": False}
+    (data / "settings.json").write_text(json.dumps(settings))
+    env = dict(os.environ, scope=str(tree), alfred_workflow_data=str(data), **extra)
+    # Alfred doesn't set it, and without bytecode every launch compiles search_core
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return env
+
+
+def import_time(env: Dict[str, str]) -> Tuple[int, List[Tuple[int, str]]]:
+    """Returns (cumulative µs for search_core, [(µs, module)] of its direct imports)."""
+    # Untimed first import, so the measured one loads cached bytecode
+    subprocess.run([sys.executable, "-c", "import search_core"], cwd=str(ROOT), env=env)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import search_core"],
+        cwd=str(ROOT), env=env, capture_output=True, text=True,
+    )
+    total = 0
+    direct: List[Tuple[int, str]] = []
+    children: List[Tuple[int, str]] = []
+    # Children are printed before their parent: collect the one-level-deep
+    # entries and keep them once the top-level `search_core` line is reached.
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        try:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            cumulative_us = int(cumulative)
+        except ValueError:
+            continue  # header line
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0:
+            if name.strip() == "search_core":
+                total, direct = cumulative_us, children
+            children = []
+        elif depth == 1:
+            children.append((cumulative_us, name.strip()))
+    direct.sort(reverse=True)
+    return total, direct
+
+
+def export_ref(ref: str, dest: Path) -> Path:
+    """Extracts the files of git ref into dest and returns its search.py."""
+    archive = subprocess.run(
+        ["git", "archive", ref], cwd=str(ROOT), capture_output=True, check=True
+    ).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(dest)
+    return dest / "search.py"
+
+
+def time_command(script: Path, query: str, env: Dict[str, str], runs: int) -> List[float]:
+    """Launches ``python3 script query`` `runs` times, returns wall times in ms.
+
+    One untimed launch goes first: Alfred has compiled any imported module
+    into __pycache__ after the first keystroke, but never the script itself.
+    """
+    times = []
+    for i in range(runs + 1):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, str(script), query],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        if i:
+            times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile of values."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+def type_burst(word: str, env: Dict[str, str], interval: float) -> List[Tuple[float, str]]:
+    """Starts search.py for every prefix of word, interval seconds apart.
+
+    Returns (wall time in ms, stdout) of each run, in keystroke order.
+    """
+    results: List[Tuple[float, str]] = [(0.0, "")] * len(word)
+
+    def run(i: int) -> None:
+        start = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, str(SEARCH), word[:i + 1]],
+            env=env, capture_output=True, text=True,
+        )
+        results[i] = ((time.perf_counter() - start) * 1000, proc.stdout)
+
+    threads = []
+    for i in range(len(word)):
+        thread = threading.Thread(target=run, args=(i,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(interval)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def burst(rounds: int, interval_ms: float) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        tree = Path(tmp) / "tree"
+        data = Path(tmp) / "data"
+        stats = Path(tmp) / "stats.jsonl"
+        tree.mkdir()
+        build_tree(tree, dirs=40)
+        env = alfred_env(tree, data, search_stats=str(stats))
+
+        answered: List[float] = []
+        superseded: List[float] = []
+        broken = 0
+        for _ in range(rounds):
+            for word in BURSTS:
+                for ms, stdout in type_burst(word, env, interval_ms / 1000):
+                    if not stdout:
+                        superseded.append(ms)
+                        continue
+                    answered.append(ms)
+                    try:
+                        json.loads(stdout)
+                    except ValueError:
+                        broken += 1
+
+        runs = len(answered) + len(superseded)
+        print(f"{runs} runs in {rounds} rounds of {len(BURSTS)} bursts, "
+              f"{interval_ms:g} ms between keystrokes")
+        print(f"  {'runs':<12} {'count':>6} {'p50 ms':>8} {'p99 ms':>8}")
+        for name, times in (("answered", answered), ("superseded", superseded)):
+            if times:
+                print(f"  {name:<12} {len(times):6d} {percentile(times, 50):8.1f}"
+                      f" {percentile(times, 99):8.1f}")
+        print(f"  unparsable answers: {broken}")
+
+        totals: Dict[str, List[int]] = {}
+        if stats.exists():
+            for line in stats.read_text().splitlines():
+                for name, (hits, misses) in json.loads(line)["caches"].items():
+                    total = totals.setdefault(name, [0, 0])
+                    total[0] += hits
+                    total[1] += misses
+        print("\ncache hit rates:")
+        for name, (hits, misses) in sorted(totals.items()):
+            print(f"  {name:<18} {hits / max(hits + misses, 1):6.1%} of {hits + misses}")
+
+        corrupt = []
+        for path in sorted(data.rglob("*")):
+            if path.suffix in (".cache", ".snapshot", ".baseline", ".costs", ".list"):
+                try:
+                    marshal.loads(path.read_bytes())
+                except (EOFError, ValueError, TypeError):
+                    corrupt.append(str(path.relative_to(data)))
+        print(f"  unreadable cache files: {', '.join(corrupt) or 'none'}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--baseline", metavar="REF", help="also time search.py at this git ref")
+    parser.add_argument("--burst", action="store_true", help="run the keystroke-burst load test")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--interval-ms", type=float, default=40)
+    args = parser.parse_args()
+
+    if args.burst:
+        burst(args.rounds, args.interval_ms)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tree = Path(tmp) / "tree"
+        data = Path(tmp) / "data"
+        tree.mkdir()
+        build_tree(tree)
+        env = alfred_env(tree, data)
+
+        total, direct = import_time(env)
+        print(f"import search_core: {total / 1000:.1f} ms cumulative (python -X importtime)")
+        for cumulative_us, name in direct[:8]:
+            print(f"  {name:<20} {cumulative_us / 1000:6.1f} ms")
+
+        baseline = None
+        if args.baseline:
+            (Path(tmp) / "baseline").mkdir()
+            baseline = export_ref(args.baseline, Path(tmp) / "baseline")
+            base_env = alfred_env(tree, Path(tmp) / "baseline-data")
+
+        print(f"\npython3 search.py <query> wall time over {args.runs} runs (ms):")
+        header = f"  {'query':<14} {'median':>8} {'min':>8} {'max':>8}"
+        if baseline:
+            header += f" {args.baseline + ' median':>18}"
+        print(header)
+        for query in COMMANDS:
+            times = time_command(SEARCH, query, env, args.runs)
+            line = (
+                f"  {query:<14} {statistics.median(times):8.1f}"
+                f" {min(times):8.1f} {max(times):8.1f}"
+            )
+            if baseline:
+                base = time_command(baseline, query, base_env, args.runs)
+                line += f" {statistics.median(base):18.1f}"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3938 @@
+# -*- coding: utf-8 -*-
+
+import json
+import marshal
+import os
+import re
+import sys
+import time
+from collections import deque
+from pathlib import Path
+from stat import S_ISDIR, S_ISREG
+from typing import Any, List, Dict, NamedTuple, Optional, Protocol, Tuple
+
+# Heavier modules (logging, shutil, subprocess) are imported lazily by the code
+# paths that need them, so commands like `cd..` start as fast as possible.
+
+# --- Configuration ---
+
+DEFAULT_SETTINGS = {
+    "search_depth": 3,
+    "max_results": 50,
+    "excluded_patterns": [".*", "*.app"],
+    "search_paths": [
+        "~/Documents",
+        "~/Downloads",
+        "~/Desktop",
+        "~/Projects",
+        "~/Applications",
+    ],
+    "use_fd": True,
+    "use_rg": True,
+    "grep_max_depth": 2,
+    "tree_max_depth": 2,
+    "respect_ignore_files": False,
+    "log_level": "WARNING",
+    "progressive_results": False,
+    "progressive_first_wait_ms": 150,
+    "progressive_cache_ttl": 60,
+    "du_max_depth": 1,
+    "one_file_system": False,
+    "hot_list_size": 200,
+    "hot_list_short_circuit": True,
+    "latency_budget_ms": 150,
+    "max_concurrency": 4,
+    "parallel_walk_workers": 0,
+    "dir_snapshot_ttl": 86400,
+    "use_index": True,
+    "index_max_depth": 8,
+    "index_max_age": 3600,
+    "alfred_cache_seconds": 0,
+    "cancel_superseded": True,
+    "depth_budget_ms": 0,
+    "adaptive_max_depth": 10,
+    "search_archives": True,
+    "find_archive_max_mb": 20,
+}
+
+DIR_FLAG = "1"
+FILE_FLAG = "0"
+
+SETTINGS_SNAPSHOT = "settings.snapshot"
+HASH_CACHE = "hashes.cache"
+ARCHIVE_CACHE = "archives.cache"
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+HASH_EDGE = 64 * 1024  # dupes: bytes hashed at each end of a file before a full hash
+HASH_CACHE_MAX = 100_000  # dupes: hashed files remembered
+DIR_SNAPSHOTS = "snapshots"  # folder holding one snapshot file per walked scope
+DIR_SNAPSHOT_SCOPES = 20  # recent/size/du/dupes: scopes whose snapshots are kept
+TREE_CACHE = "tree.cache"
+TREE_CACHE_SCOPES = 20  # tree: scopes whose listings are kept
+CHANGES_BASELINE = "changes.baseline"
+CHANGES_RERUN = 60  # changes: seconds in which a rerun still compares with the older baseline
+CHANGES_SCOPES_MAX = 20  # changes: scopes whose baseline is kept
+NAME_INDEX = "names.index"
+INDEX_REBUILD_GRACE = 300  # seconds before another background index rebuild may start
+SEARCH_SEQ = "search.seq"
+DEPTH_COSTS = "depth.costs"
+USAGE_DB = "usage.sqlite3"
+HOT_LIST = "hot.list"
+IGNORE_FILES = (".gitignore", ".ignore", ".fdignore")
+PROGRESSIVE_DIR = "progressive"
+PROGRESSIVE_RERUN = 0.3  # seconds between Alfred reruns while a worker runs
+PROGRESSIVE_STALL = 60  # seconds without an update before a worker is restarted
+ASYNC_GRACE = 0.05  # seconds walker threads get to return after the deadline
+GREP_ASYNC_MIN_FILES = 16  # below this, grep reads files sequentially
+CANCEL_POLL = 0.05  # seconds between superseded() checks while waiting on fd
+CANCEL_CHECK_INTERVAL = 0.02  # superseded() stats the sequence file at most this often
+_LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+
+_data_dir_cache: Dict[str, Path] = {}
+
+
+def _get_workflow_data_dir() -> Path:
+    """Returns the Alfred workflow data directory for logs and settings."""
+    alfred_data = os.getenv("alfred_workflow_data") or ""
+    path = _data_dir_cache.get(alfred_data)
+    if path is not None:
+        return path
+    if alfred_data:
+        path = Path(alfred_data)
+    else:
+        path = Path(__file__).parent / "data"
+    path.mkdir(parents=True, exist_ok=True)
+    _data_dir_cache[alfred_data] = path
+    return path
+
+
+def _setup_logging():
+    """Sets up logging to file in workflow data directory.
+
+    The file handler is created with ``delay=True``, so ``search.log`` is only
+    opened when the first record is written.
+    """
+    import logging
+
+    logger = logging.getLogger("alfred_search")
+    if logger.handlers:
+        return logger
+    logger.setLevel(logging.DEBUG)
+    log_file = _get_workflow_data_dir() / "search.log"
+    try:
+        handler = logging.FileHandler(str(log_file), delay=True)
+        handler.setLevel(logging.DEBUG)
+        formatter = logging.Formatter(
+            "%(asctime)s [%(levelname)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+        )
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    except OSError:
+        pass  # If we can't log, continue silently
+    return logger
+
+
+class _LazyLogger:
+    """Logger proxy that imports and configures ``logging`` on first write.
+
+    Messages below the ``log_level`` setting are dropped without touching the
+    logging module at all.
+    """
+
+    def __init__(self) -> None:
+        self._logger: Any = None  # logging.Logger once configured
+        self.level = _LOG_LEVELS["WARNING"]
+
+    def _log(self, level: int, msg: str, *args) -> None:
+        if level < self.level:
+            return
+        if self._logger is None:
+            self._logger = _setup_logging()
+        self._logger.log(level, msg, *args)
+
+    def debug(self, msg: str, *args) -> None:
+        self._log(10, msg, *args)
+
+    def info(self, msg: str, *args) -> None:
+        self._log(20, msg, *args)
+
+    def warning(self, msg: str, *args) -> None:
+        self._log(30, msg, *args)
+
+    def error(self, msg: str, *args) -> None:
+        self._log(40, msg, *args)
+
+
+logger = _LazyLogger()
+
+
+def _read_marshal(path: Path):
+    """Loads a marshal cache file, None if it is missing or unreadable."""
+    try:
+        with open(path, "rb") as f:
+            return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def _write_marshal(path: Path, value) -> None:
+    """Atomically writes a marshal cache file (temp file + rename)."""
+    import threading
+
+    # Unique per writer, so concurrent processes and threads never share one
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            marshal.dump(value, f)
+        os.replace(tmp, path)
+    except (OSError, ValueError) as e:
+        logger.debug("Failed to write cache %s: %s", path, e)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+class _FileLock:
+    """Exclusive fcntl advisory lock on ``<path>.lock``, held within a with block.
+
+    Where fcntl is unavailable or the lock file cannot be opened, the block
+    runs unlocked: the writes it guards are atomic renames anyway, so the
+    worst case is a lost update, never a torn file.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path.with_name(f"{path.name}.lock")
+        self._fd: Optional[int] = None
+
+    def __enter__(self) -> "_FileLock":
+        try:
+            import fcntl
+        except ImportError:
+            return self
+        try:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except OSError as e:
+            logger.debug("Cannot lock %s: %s", self.path, e)
+            self.__exit__()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self._fd is not None:
+            os.close(self._fd)  # releases the lock
+            self._fd = None
+
+
+class CacheStore:
+    """A marshal cache file in the workflow data dir shared by all invocations.
+
+    Alfred runs overlapping ``search.py`` processes while the user types, and
+    they all read and write the same caches. ``load()`` never raises: a
+    missing, unreadable or foreign file loads as an empty ``kind()``. Every
+    write is an atomic rename, so readers never lock and never see a partial
+    file. ``update()`` re-reads the file under the lock and applies only this
+    process's changes, so concurrent writers don't drop each other's entries.
+    """
+
+    def __init__(self, name: str, kind: type = dict) -> None:
+        self.name = name
+        self.kind = kind
+        self.path = _get_workflow_data_dir() / name
+
+    def load(self):
+        value = _read_marshal(self.path)
+        return value if isinstance(value, self.kind) else self.kind()
+
+    def save(self, value) -> None:
+        """Replaces the whole stored value."""
+        with _FileLock(self.path):
+            _write_marshal(self.path, value)
+
+    def update(self, changed: Dict, removed=(), limit: int = 0) -> Dict:
+        """Merges changed keys into the stored dict and drops removed ones.
+
+        Changed keys move to the end, so with ``limit`` the least recently
+        written entries beyond it are dropped. Returns the merged dict.
+        """
+        with _FileLock(self.path):
+            current = self.load()
+            for key in removed:
+                current.pop(key, None)
+            for key, value in changed.items():
+                current.pop(key, None)
+                current[key] = value
+            if limit:
+                for key in list(current)[:max(len(current) - limit, 0)]:
+                    del current[key]
+            _write_marshal(self.path, current)
+        return current
+
+
+# {cache name: [hits, misses]} of this process, see write_cache_stats()
+_cache_stats: Dict[str, List[int]] = {}
+
+
+def count_cache(name: str, hit: bool) -> None:
+    _cache_stats.setdefault(name, [0, 0])[0 if hit else 1] += 1
+
+
+def write_cache_stats() -> None:
+    """Appends this process's cache hits and misses to $search_stats, if set.
+
+    One JSON line per process, written with a single append, so concurrent
+    processes don't interleave. Used by ``bench.py --burst``.
+    """
+    path = os.environ.get("search_stats")
+    if not path or not _cache_stats:
+        return
+    try:
+        with open(path, "a") as f:
+            f.write(json.dumps({"pid": os.getpid(), "caches": _cache_stats}) + "\n")
+    except OSError as e:
+        logger.debug("Cannot write cache stats: %s", e)
+
+
+def _read_settings_snapshot(snapshot: Path, st: os.stat_result) -> Optional[dict]:
+    """Returns user settings from the marshal snapshot if it matches ``st``."""
+    try:
+        mtime_ns, size, user_settings = _read_marshal(snapshot)
+    except (TypeError, ValueError):
+        return None
+    if mtime_ns != st.st_mtime_ns or size != st.st_size:
+        return None
+    return user_settings
+
+
+def _write_settings_snapshot(snapshot: Path, st: os.stat_result, user_settings: dict) -> None:
+    """Stores parsed settings keyed by the settings.json mtime and size."""
+    _write_marshal(snapshot, (st.st_mtime_ns, st.st_size, user_settings))
+
+
+def load_settings() -> dict:
+    """Loads settings from settings.json, falls back to defaults.
+
+    The parsed file is cached as a marshal snapshot that is invalidated by the
+    settings.json mtime, so warm starts skip the JSON parser entirely.
+    """
+    data_dir = _get_workflow_data_dir()
+    settings_file = data_dir / "settings.json"
+    settings = dict(DEFAULT_SETTINGS)
+    try:
+        st = os.stat(settings_file)
+    except OSError:
+        return settings
+
+    snapshot = data_dir / SETTINGS_SNAPSHOT
+    user_settings = _read_settings_snapshot(snapshot, st)
+    count_cache(SETTINGS_SNAPSHOT, user_settings is not None)
+    if user_settings is None:
+        try:
+            with open(settings_file, "r") as f:
+                user_settings = json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            logger.warning("Failed to load settings: %s", e)
+            return settings
+        if not isinstance(user_settings, dict):
+            logger.warning("Failed to load settings: top level is not an object")
+            return settings
+        _write_settings_snapshot(snapshot, st, user_settings)
+        logger.debug("Loaded settings from %s", settings_file)
+    settings.update(user_settings)
+    return settings
+
+
+SETTINGS = load_settings()
+SEARCH_DEPTH = SETTINGS["search_depth"]
+MAX_RESULTS = SETTINGS["max_results"]
+EXCLUDED_PATTERNS = SETTINGS["excluded_patterns"]
+logger.level = _LOG_LEVELS.get(str(SETTINGS.get("log_level", "WARNING")).upper(), 30)
+
+
+# --- Utility functions ---
+
+
+def _glob_to_regex(pattern: str) -> str:
+    """Translates a gitignore-style glob into a regex fragment.
+
+    ``*`` and ``?`` don't cross ``/``, ``**`` does, and a ``**/`` segment also
+    matches zero directories. Bracket classes are kept (``[!x]`` negates).
+    """
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**/", i):
+                out.append("(?:.*/)?")
+                i += 3
+                continue
+            if pattern.startswith("**", i):
+                out.append(".*")
+                i += 2
+                continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            j = pattern.find("]", i + 2)
+            if j == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:j]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append("[" + body.replace("\\", "\\\\") + "]")
+                i = j
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+class ExcludeMatcher:
+    """Compiled form of ``excluded_patterns``.
+
+    Patterns are split by cost: exact names go into a set, ``*.ext`` and
+    ``prefix*`` into tuples for ``str.endswith``/``str.startswith``, and every
+    other glob into one combined regex. A trailing ``/`` restricts a pattern to
+    directories, a leading ``**/`` is dropped (names match at any depth), and a
+    pattern with an inner ``/`` (``docs/*.tmp``) is matched against the path
+    relative to the walk root.
+    """
+
+    def __init__(self, patterns: List[str], dirs_only: bool = False) -> None:
+        self.patterns = list(patterns)
+        exact = set()
+        suffixes = []
+        prefixes = []
+        name_globs = []
+        path_globs = []
+        dir_patterns = []
+        for pattern in patterns:
+            if not dirs_only and pattern.endswith("/"):
+                dir_patterns.append(pattern.rstrip("/"))
+                continue
+            while pattern.startswith("**/"):
+                pattern = pattern[3:]
+            if not pattern:
+                continue
+            if "/" in pattern:
+                path_globs.append(_glob_to_regex(pattern.lstrip("/")))
+            elif not any(c in pattern for c in "*?["):
+                exact.add(pattern)
+            elif pattern.startswith("*") and not any(c in pattern[1:] for c in "*?["):
+                suffixes.append(pattern[1:])
+            elif pattern.endswith("*") and not any(c in pattern[:-1] for c in "*?["):
+                prefixes.append(pattern[:-1])
+            else:
+                name_globs.append(_glob_to_regex(pattern))
+        self.exact = frozenset(exact)
+        self.suffixes = tuple(suffixes)
+        self.prefixes = tuple(prefixes)
+        self.name_re = re.compile("(?:%s)\\Z" % "|".join(name_globs)) if name_globs else None
+        self.path_re = re.compile("(?:%s)(?:/.*)?\\Z" % "|".join(path_globs)) if path_globs else None
+        self.dirs = ExcludeMatcher(dir_patterns, dirs_only=True) if dir_patterns else None
+        self.has_paths: bool = self.path_re is not None or (
+            self.dirs is not None and self.dirs.has_paths
+        )
+
+    def match(self, name: str, is_dir: bool = False, rel_path: Optional[str] = None) -> bool:
+        if name in self.exact or name.endswith(self.suffixes) or name.startswith(self.prefixes):
+            return True
+        if self.name_re is not None and self.name_re.match(name):
+            return True
+        if rel_path is not None and self.path_re is not None and self.path_re.match(rel_path):
+            return True
+        return is_dir and self.dirs is not None and self.dirs.match(name, False, rel_path)
+
+    def fd_args(self) -> List[str]:
+        """Returns ``--exclude`` args so fd prunes excluded trees itself."""
+        args = []
+        for pattern in self.patterns:
+            args += ["--exclude", pattern]
+        return args
+
+
+_exclude_matcher: List = [None, None]  # [source patterns list, compiled matcher]
+
+
+def get_exclude_matcher() -> ExcludeMatcher:
+    """Returns the matcher for EXCLUDED_PATTERNS, recompiled if it was replaced."""
+    if _exclude_matcher[0] is not EXCLUDED_PATTERNS:
+        _exclude_matcher[:] = [EXCLUDED_PATTERNS, ExcludeMatcher(EXCLUDED_PATTERNS)]
+    return _exclude_matcher[1]
+
+
+def should_exclude(name: str, is_dir: bool = False, rel_path: Optional[str] = None) -> bool:
+    """Checks if a file/folder should be excluded based on excluded_patterns.
+
+    Supported patterns:
+      .*           — dotfiles (starts with .)
+      *.app        — by extension (ends with .app)
+      node_modules — exact name match
+      *.tmp[0-9]   — any glob on the name
+      build/       — directories only
+      **/build/    — same; leading **/ matches at any depth
+      docs/*.tmp   — glob on the path relative to the search root (rel_path)
+    """
+    return get_exclude_matcher().match(name, is_dir, rel_path)
+
+
+def fuzzy_match(query: str, text: str) -> bool:
+    """Fuzzy match: all query chars must appear in text in order."""
+    query = query.lower()
+    text = text.lower()
+    if query in text:
+        return True
+    text_pos = 0
+    for char in query:
+        text_pos = text.find(char, text_pos)
+        if text_pos == -1:
+            return False
+        text_pos += 1
+    return True
+
+
+def match_score(query: str, name: str) -> int:
+    """Returns match quality score (lower is better).
+    0 = exact, 1 = prefix, 2 = substring, 3 = fuzzy, 99 = no match.
+    """
+    return _score_lowered(query.lower(), name.lower())
+
+
+def _score_lowered(q: str, n: str) -> int:
+    """match_score for already lowercased strings."""
+    if q == n:
+        return 0
+    if n.startswith(q):
+        return 1
+    if q in n:
+        return 2
+    pos = 0
+    for char in q:
+        pos = n.find(char, pos)
+        if pos == -1:
+            return 99
+        pos += 1
+    return 3
+
+
+def split_path_query(query: str) -> List[str]:
+    """Splits a path query like ``proj/api/handler`` into its segments."""
+    return [segment for segment in query.split("/") if segment]
+
+
+def path_match_score(segments: List[str], path: str) -> int:
+    """Scores a path against query segments aligned to its last components.
+
+    The last segment is matched against the basename, each earlier one against
+    the next directory up. Returns the summed match_score, 99 if any misses.
+    """
+    components = [c for c in path.split(os.sep) if c]
+    if len(components) < len(segments):
+        return 99
+    total = 0
+    for segment, component in zip(segments, components[-len(segments):]):
+        score = match_score(segment, component)
+        if score == 99:
+            return 99
+        total += score
+    return total
+
+
+def query_score(query: str, path: str) -> int:
+    """Scores path for query: by path segments if it has any, else by basename."""
+    segments = split_path_query(query)
+    if len(segments) > 1:
+        return path_match_score(segments, path)
+    return match_score(query, os.path.basename(path))
+
+
+_AGE_UNITS = {"h": 3600, "d": 86400, "w": 7 * 86400}
+
+
+class _StatLike(Protocol):
+    """The stat fields QueryFilters reads: an os.stat_result or index columns."""
+
+    @property
+    def st_size(self) -> int: ...
+
+    @property
+    def st_mtime(self) -> float: ...
+
+
+class QueryFilters(NamedTuple):
+    """Inline filters parsed from a search query (see parse_query_filters)."""
+
+    exts: Tuple[str, ...] = ()
+    kind: Optional[str] = None  # "f" or "d"
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
+    changed_within: Optional[float] = None  # seconds
+    changed_before: Optional[float] = None  # seconds
+
+    @property
+    def needs_stat(self) -> bool:
+        return (
+            self.min_size is not None
+            or self.max_size is not None
+            or self.changed_within is not None
+            or self.changed_before is not None
+        )
+
+    def matches(self, path: str, is_dir: bool, st: Optional[_StatLike] = None) -> bool:
+        """Cheap checks first (kind, extension), then one stat if needed."""
+        if self.kind is not None and (self.kind == "d") != is_dir:
+            return False
+        if self.exts:
+            dot = path.rfind(".")
+            if dot == -1 or path[dot + 1:].lower() not in self.exts:
+                return False
+        if not self.needs_stat:
+            return True
+        if st is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return False
+        if self.min_size is not None and st.st_size <= self.min_size:
+            return False
+        if self.max_size is not None and st.st_size >= self.max_size:
+            return False
+        age = time.time() - st.st_mtime
+        if self.changed_within is not None and age > self.changed_within:
+            return False
+        if self.changed_before is not None and age < self.changed_before:
+            return False
+        return True
+
+    def fd_args(self) -> List[str]:
+        """Returns the equivalent fd flags."""
+        args: List[str] = []
+        for ext in self.exts:
+            args += ["-e", ext]
+        if self.kind is not None:
+            args += ["-t", self.kind]
+        if self.min_size is not None:
+            args += ["--size", f"+{self.min_size + 1}b"]
+        if self.max_size is not None:
+            args += ["--size", f"-{max(self.max_size - 1, 0)}b"]
+        if self.changed_within is not None:
+            args += ["--changed-within", f"{int(self.changed_within)}s"]
+        if self.changed_before is not None:
+            args += ["--changed-before", f"{int(self.changed_before)}s"]
+        return args
+
+
+def _parse_age(s: str) -> Optional[float]:
+    """Parses an age like '7d', '12h', '2w' into seconds."""
+    if len(s) < 2 or s[-1] not in _AGE_UNITS:
+        return None
+    try:
+        return float(s[:-1]) * _AGE_UNITS[s[-1]]
+    except ValueError:
+        return None
+
+
+def parse_query_filters(query: str) -> Tuple[str, Optional[QueryFilters]]:
+    """Splits inline filters off a query.
+
+    Supported tokens: ``ext:pdf`` (repeatable or ``ext:jpg,png``), ``type:f``
+    / ``type:d``, ``>10m`` / ``<100k`` (size) and ``age:<7d`` / ``age:>30d``
+    (h, d or w). Returns (remaining query, filters or None).
+    """
+    fields: Dict = {}
+    exts: List[str] = []
+    words = []
+    for token in query.split():
+        lower = token.lower()
+        if lower.startswith("ext:") and len(lower) > 4:
+            exts += [e.lstrip(".") for e in lower[4:].split(",") if e]
+            continue
+        if lower in ("type:f", "type:d"):
+            fields["kind"] = lower[5]
+            continue
+        if lower[:1] in "<>" and len(lower) > 1 and _parse_size(lower[1:]) >= 0:
+            fields["min_size" if lower[0] == ">" else "max_size"] = _parse_size(lower[1:])
+            continue
+        if lower.startswith(("age:<", "age:>")):
+            age = _parse_age(lower[5:])
+            if age is not None:
+                fields["changed_within" if lower[4] == "<" else "changed_before"] = age
+                continue
+        words.append(token)
+    if exts:
+        fields["exts"] = tuple(exts)
+    return " ".join(words), (QueryFilters(**fields) if fields else None)
+
+
+def _has_fd() -> bool:
+    """Checks if fd is installed."""
+    if not SETTINGS.get("use_fd", True):
+        return False
+    import shutil
+
+    return shutil.which("fd") is not None
+
+
+def _has_rg() -> bool:
+    """Checks if ripgrep is installed."""
+    if not SETTINGS.get("use_rg", True):
+        return False
+    import shutil
+
+    return shutil.which("rg") is not None
+
+
+def _format_size(size: int) -> str:
+    """Formats file size to human-readable string."""
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
+
+
+def _format_mtime(mtime: float) -> str:
+    """Formats modification time."""
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime))
+
+
+def _file_info(path: Path, st: Optional[os.stat_result] = None) -> str:
+    """Returns size and mtime string for a file, from ``st`` if given."""
+    try:
+        if st is None:
+            st = path.stat()
+    except OSError:
+        return ""
+    mtime = _format_mtime(st.st_mtime)
+    if S_ISREG(st.st_mode):
+        return f"{mtime} | {_format_size(st.st_size)}"
+    return mtime
+
+
+def _fd_base_cmd() -> List[str]:
+    """Returns the fd command prefix shared by all fd-backed searches."""
+    cmd = ["fd", "--hidden=false"]
+    if not SETTINGS.get("respect_ignore_files", False):
+        cmd.append("--no-ignore")
+    if SETTINGS.get("one_file_system", False):
+        cmd.append("--one-file-system")
+    return cmd + get_exclude_matcher().fd_args()
+
+
+# --- Superseded searches ---
+
+# [sequence file path, (st_ino, st_mtime_ns) this process wrote, next check
+# time, superseded, query key a progressive worker follows or None]; empty
+# when this process didn't claim the search
+_claim: List = []
+
+
+def _query_key(query: str, scope: Path) -> str:
+    """Returns a short key for a (scope, query) pair."""
+    import hashlib
+
+    return hashlib.sha1(f"{scope}\0{query}".encode("utf-8")).hexdigest()[:16]
+
+
+def claim_search(key: str = "") -> None:
+    """Marks this invocation as the latest interactive search.
+
+    Alfred starts a new process per keystroke. Each one rewrites the sequence
+    file in the workflow data dir (new inode via rename), and older ones see
+    the change through superseded() and stop walking or reading fd output.
+    ``key`` (see _query_key) is stored so progressive workers can tell a
+    rerun of their own query from a newer one.
+    """
+    path = _get_workflow_data_dir() / SEARCH_SEQ
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "w") as f:
+            f.write(f"{os.getpid()}\n{key}\n")
+        os.replace(tmp, path)
+        st = os.stat(path)
+    except OSError as e:
+        logger.debug("Cannot claim search: %s", e)
+        return
+    _claim[:] = [path, (st.st_ino, st.st_mtime_ns), 0.0, False, None]
+
+
+def claim_token() -> Optional[str]:
+    """Returns this invocation's claim as ``"st_ino:st_mtime_ns"``, for a worker."""
+    return "%d:%d" % _claim[1] if _claim else None
+
+
+def follow_search(token: Optional[str], key: str) -> None:
+    """Makes a progressive worker superseded along with the invocation that spawned it.
+
+    token comes from that invocation's claim_token(). Alfred's reruns of the
+    same query claim the sequence file again with the same key; the worker
+    keeps going through those and stops once any other query claims it.
+    """
+    try:
+        ino, mtime_ns = (int(part) for part in (token or "").split(":"))
+    except ValueError:
+        return
+    _claim[:] = [_get_workflow_data_dir() / SEARCH_SEQ, (ino, mtime_ns), 0.0, False, key]
+
+
+def superseded() -> bool:
+    """True once a newer search has claimed the sequence file.
+
+    Cheap enough to call per directory or per line: the file is stat-ed at
+    most every CANCEL_CHECK_INTERVAL seconds. Always False in processes that
+    never claimed or followed a claim (batch mode, index builds).
+    """
+    if not _claim:
+        return False
+    if _claim[3]:
+        return True
+    now = time.monotonic()
+    if now < _claim[2]:
+        return False
+    _claim[2] = now + CANCEL_CHECK_INTERVAL
+    try:
+        st = os.stat(_claim[0])
+    except OSError:
+        return False
+    if (st.st_ino, st.st_mtime_ns) == _claim[1]:
+        return False
+    if _claim[4] is not None:
+        try:
+            with open(_claim[0]) as f:
+                lines = f.read().split("\n")
+        except OSError:
+            lines = []
+        if len(lines) > 1 and lines[1] == _claim[4]:
+            _claim[1] = (st.st_ino, st.st_mtime_ns)  # a rerun of the followed query
+            return False
+    logger.debug("Search superseded by a newer query")
+    _claim[3] = True
+    return True
+
+
+def _read_lines(proc, cmd: List[str], timeout: float):
+    """Yields the stdout lines of proc as they arrive.
+
+    Ends at EOF, or as soon as this search is superseded (an incomplete last
+    line is dropped then). Raises subprocess.TimeoutExpired after timeout
+    seconds like subprocess.run. The caller kills proc if it stops early.
+    """
+    import select
+    import subprocess
+
+    deadline = time.monotonic() + timeout
+    fileno = proc.stdout.fileno()
+    pending = b""
+    while not superseded():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        ready, _, _ = select.select([fileno], [], [], min(remaining, CANCEL_POLL))
+        if not ready:
+            continue
+        chunk = os.read(fileno, 65536)
+        if not chunk:
+            if pending:
+                yield pending.decode("utf-8", "surrogateescape")
+            return
+        *lines, pending = (pending + chunk).split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8", "surrogateescape")
+
+
+def _run_fd(cmd: List[str], timeout: float) -> Tuple[int, List[str]]:
+    """Runs fd and returns (return code, output lines).
+
+    Output is read as it arrives, so fd is killed as soon as this search is
+    superseded; the complete lines read by then are returned with code 0.
+    Raises subprocess.TimeoutExpired after timeout seconds like subprocess.run.
+    """
+    import subprocess
+
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    assert proc.stdout is not None
+    try:
+        lines = list(_read_lines(proc, cmd, timeout))
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        proc.stdout.close()
+    return (0 if superseded() else proc.returncode), lines
+
+
+# --- Traversal ---
+
+
+def _parse_ignore_line(line: str) -> Optional[Tuple[str, bool, bool]]:
+    """Parses one gitignore line into (regex, negate, dir_only), None if blank."""
+    line = line.rstrip("\n").rstrip("\r")
+    if line.endswith(" ") and not line.endswith("\\ "):
+        line = line.rstrip(" ")
+    if not line or line.startswith("#"):
+        return None
+    negate = line.startswith("!")
+    if negate:
+        line = line[1:]
+    elif line.startswith("\\#") or line.startswith("\\!"):
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    anchored = "/" in line
+    line = line.lstrip("/")
+    regex = _glob_to_regex(line)
+    if not anchored:
+        regex = "(?:.*/)?" + regex
+    return regex, negate, dir_only
+
+
+class IgnoreRules:
+    """Compiled ignore rules of one directory, chained to its parent's rules.
+
+    Follows gitignore semantics: within a file the last matching rule wins,
+    rules in deeper directories override their ancestors, ``!`` re-includes,
+    a trailing ``/`` matches directories only and a pattern containing ``/``
+    is anchored to the directory holding the ignore file.
+    """
+
+    def __init__(self, base: str, lines: List[str], parent: Optional["IgnoreRules"] = None) -> None:
+        self.base = base
+        self.parent = parent
+        rules = [rule for rule in map(_parse_ignore_line, lines) if rule is not None]
+        # Without negations the outcome doesn't depend on rule order, so all
+        # rules collapse into two combined regexes.
+        self.simple = not any(negate for _, negate, _ in rules)
+        if self.simple:
+            any_kind = [regex for regex, _, dir_only in rules if not dir_only]
+            dirs_only = [regex for regex, _, dir_only in rules if dir_only]
+            self.file_re = re.compile("(?:%s)\\Z" % "|".join(any_kind)) if any_kind else None
+            self.dir_re = re.compile("(?:%s)\\Z" % "|".join(any_kind + dirs_only)) if rules else None
+            self.rules = []
+        else:
+            self.file_re = self.dir_re = None
+            self.rules = [(re.compile(regex + "\\Z"), negate, dir_only)
+                          for regex, negate, dir_only in reversed(rules)]
+
+    def _decide(self, rel: str, is_dir: bool) -> Optional[bool]:
+        if self.simple:
+            regex = self.dir_re if is_dir else self.file_re
+            return True if regex is not None and regex.match(rel) else None
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel):
+                return not negate
+        return None
+
+    def ignored(self, path: str, is_dir: bool) -> bool:
+        """Returns True if the absolute path is ignored by this chain."""
+        rules: Optional[IgnoreRules] = self
+        while rules is not None:
+            rel = path[len(rules.base):].lstrip("/")
+            decision = rules._decide(rel, is_dir)
+            if decision is not None:
+                return decision
+            rules = rules.parent
+        return False
+
+
+_ignore_cache: Dict[Tuple, Optional[IgnoreRules]] = {}
+
+
+def _load_ignore_rules(
+    directory: str, names, parent: Optional[IgnoreRules]
+) -> Optional[IgnoreRules]:
+    """Returns the rules for directory given the ignore file names it contains.
+
+    Results are cached per (directory, ignore file mtimes) for the process, so
+    repeated walks (several roots, batch queries) parse each file once.
+    """
+    stamps = []
+    for name in IGNORE_FILES:
+        if name in names:
+            try:
+                stamps.append((name, os.stat(os.path.join(directory, name)).st_mtime_ns))
+            except OSError:
+                continue
+    if not stamps:
+        return parent
+    key = (directory, tuple(stamps), id(parent))
+    if key in _ignore_cache:
+        return _ignore_cache[key]
+    lines: List[str] = []
+    for name, _ in stamps:
+        try:
+            with open(os.path.join(directory, name), "r", errors="ignore") as f:
+                lines.extend(f.readlines())
+        except OSError:
+            continue
+    rules = IgnoreRules(directory, lines, parent)
+    _ignore_cache[key] = rules
+    return rules
+
+
+def _ancestor_ignore_rules(top: str) -> Optional[IgnoreRules]:
+    """Loads ignore rules of top's ancestors up to the enclosing git repo root."""
+    chain = []
+    current = os.path.dirname(top)
+    while current and current != os.path.dirname(current):
+        chain.append(current)
+        if os.path.exists(os.path.join(current, ".git")):
+            break
+        current = os.path.dirname(current)
+    else:
+        return None  # not inside a git repository
+    rules = None
+    for directory in reversed(chain):
+        names = [name for name in IGNORE_FILES if os.path.exists(os.path.join(directory, name))]
+        rules = _load_ignore_rules(directory, names, rules)
+    return rules
+
+
+def walk_tree(
+    top,
+    max_depth: Optional[int] = None,
+    visited: Optional[set] = None,
+    one_file_system: Optional[bool] = None,
+    exclude: bool = True,
+    ignore_files: Optional[bool] = None,
+    breadth_first: bool = False,
+):
+    """Walks a directory tree top-down like os.walk, visiting each directory once.
+
+    Yields (dirpath, dirnames, filenames); callers prune by editing dirnames in
+    place. With ``exclude``, entries matching excluded_patterns are filtered
+    out before they are yielded; with ``ignore_files`` (default: the
+    ``respect_ignore_files`` setting) so are entries ignored by
+    .gitignore/.ignore/.fdignore files, as fd would. Symlinked directories are
+    listed but not followed. Directories are keyed by (st_dev, st_ino) in
+    ``visited``, which callers may share across roots, so hardlinked or
+    bind-mounted directories and overlapping search roots are walked once.
+    ``max_depth`` limits how many levels below top are listed;
+    ``one_file_system`` (default: the setting) stays on top's device.
+    ``breadth_first`` lists every directory of a level before the next level.
+    """
+    if visited is None:
+        visited = set()
+    if one_file_system is None:
+        one_file_system = SETTINGS.get("one_file_system", False)
+    if ignore_files is None:
+        ignore_files = SETTINGS.get("respect_ignore_files", False)
+    try:
+        st = os.stat(top)
+    except OSError:
+        return
+    key = (st.st_dev, st.st_ino)
+    if key in visited:
+        return
+    visited.add(key)
+    root_dev = st.st_dev
+    top = os.fspath(top)
+    matcher = get_exclude_matcher() if exclude else None
+    with_paths = matcher is not None and matcher.has_paths
+    rel_start = len(top.rstrip(os.sep)) + 1  # also right for "/" and "dir/"
+
+    stack = deque([(top, 0, _ancestor_ignore_rules(top) if ignore_files else None)])
+    pop = stack.popleft if breadth_first else stack.pop
+    while stack:
+        if superseded():
+            return
+        path, depth, parent_rules = pop()
+        rel_dir = path[rel_start:] if with_paths else ""
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError as e:
+            logger.debug("Cannot list %s: %s", path, e)
+            continue
+
+        rules = parent_rules
+        if ignore_files:
+            names = [entry.name for entry in entries if entry.name in IGNORE_FILES]
+            rules = _load_ignore_rules(path, names, parent_rules)
+
+        dir_entries = {}
+        files = []
+        for entry in entries:
+            name = entry.name
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if matcher is not None:
+                rel = (f"{rel_dir}/{name}" if rel_dir else name) if with_paths else None
+                if matcher.match(name, is_dir, rel):
+                    continue
+            if rules is not None and rules.ignored(entry.path, is_dir):
+                continue
+            if is_dir:
+                dir_entries[name] = entry
+            else:
+                files.append(name)
+
+        dirs = list(dir_entries)
+        yield path, dirs, files
+
+        if max_depth is not None and depth >= max_depth:
+            continue
+        pending = []
+        for name in dirs:
+            child = dir_entries.get(name)
+            if child is None or child.is_symlink():
+                continue
+            try:
+                child_st = child.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if one_file_system and child_st.st_dev != root_dev:
+                continue
+            child_key = (child_st.st_dev, child_st.st_ino)
+            if child_key in visited:
+                continue
+            visited.add(child_key)
+            pending.append((child.path, depth + 1, rules))
+        stack.extend(pending if breadth_first else reversed(pending))
+
+
+def _scan_dir_stats(path: str) -> Tuple:
+    """Lists path for the directory snapshot store.
+
+    Returns (subdir names, NUL-joined file names, file sizes, file mtimes in ns,
+    hardlinks). Sizes and mtimes are packed int64 arrays, and hardlinks is a
+    tuple of (file index, st_dev, st_ino) for files with more than one link.
+    """
+    from array import array
+
+    dirs: List[str] = []
+    names: List[str] = []
+    links: List[Tuple[int, int, int]] = []
+    sizes, mtimes = array("q"), array("q")
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                    continue
+                st = entry.stat()
+            except OSError:
+                continue
+            if st.st_nlink > 1:
+                links.append((len(names), st.st_dev, st.st_ino))
+            names.append(entry.name)
+            sizes.append(st.st_size)
+            mtimes.append(st.st_mtime_ns)
+    return tuple(dirs), "\0".join(names), sizes.tobytes(), mtimes.tobytes(), tuple(links)
+
+
+def _dir_snapshot_store(scope) -> CacheStore:
+    """Returns the snapshot file of scope.
+
+    Each scope gets its own file, so a run only reads and rewrites the
+    listings of the scope it walks, however large other scopes are.
+    """
+    (_get_workflow_data_dir() / DIR_SNAPSHOTS).mkdir(exist_ok=True)
+    return CacheStore(f"{DIR_SNAPSHOTS}/{_query_key('', Path(scope))}.snapshot")
+
+
+def load_dir_snapshots(scope) -> Dict:
+    """Returns the stored directory snapshots of scope, keyed by directory path."""
+    return _dir_snapshot_store(scope).load()
+
+
+def _prune_dir_snapshots(keep: int) -> None:
+    """Deletes all but the ``keep`` most recently written snapshot files."""
+    folder = _get_workflow_data_dir() / DIR_SNAPSHOTS
+    try:
+        with os.scandir(folder) as it:
+            files = [
+                (entry.stat().st_mtime_ns, entry.path)
+                for entry in it if entry.name.endswith(".snapshot")
+            ]
+    except OSError:
+        return
+    files.sort()
+    for _, path in files[:max(len(files) - keep, 0)]:
+        for stale in (path, path + ".lock"):
+            try:
+                os.unlink(stale)
+            except OSError:
+                pass
+
+
+def save_dir_snapshots(snapshots: Dict, fresh: Dict, scope, complete: bool = True) -> None:
+    """Stores the directories seen by a walk of scope in its snapshot file.
+
+    After a complete walk_stats walk, entries that the walk no longer reached
+    (deleted or newly excluded directories) are dropped. A partial walk
+    (``complete=False``) only adds what it listed. Nothing is written when
+    every directory was served from the snapshot. Only this walk's changes
+    are merged into the stored file, so overlapping invocations keep each
+    other's entries. Files of all but the last DIR_SNAPSHOT_SCOPES scopes
+    written are deleted.
+    """
+    root = os.fspath(scope)
+    prefix = root.rstrip(os.sep) + os.sep
+    if superseded():
+        return  # the walk stopped early
+    stale = []
+    if complete:
+        stale = [k for k in snapshots if (k == root or k.startswith(prefix)) and k not in fresh]
+    changed = {k: snap for k, snap in fresh.items() if snapshots.get(k) is not snap}
+    if not stale and not changed:
+        return
+    _dir_snapshot_store(scope).update(changed, stale)
+    _prune_dir_snapshots(DIR_SNAPSHOT_SCOPES)
+
+
+def dir_snapshot(
+    path: str, st: os.stat_result, snapshots: Dict, now: float, ttl: Optional[float] = None
+) -> Optional[Tuple]:
+    """Returns the snapshot entry for path, rescanning it unless the stored one is valid.
+
+    The stored entry is valid while the directory's inode and mtime match
+    ``st`` and it is younger than ``ttl`` seconds (``dir_snapshot_ttl`` by
+    default). Returns None if path cannot be listed.
+    """
+    if ttl is None:
+        ttl = SETTINGS.get("dir_snapshot_ttl", 86400)
+    snap = snapshots.get(path)
+    valid = not (
+        snap is None or snap[0] != st.st_ino or snap[1] != st.st_mtime_ns
+        or now - snap[2] >= ttl
+    )
+    count_cache(DIR_SNAPSHOTS, valid)
+    if not valid:
+        try:
+            snap = (st.st_ino, st.st_mtime_ns, now) + _scan_dir_stats(path)
+        except OSError as e:
+            logger.debug("Cannot list %s: %s", path, e)
+            return None
+    return snap
+
+
+def walk_stats(
+    top, snapshots: Dict, fresh: Dict, max_depth: Optional[int] = None,
+    ttl: Optional[float] = None,
+):
+    """Walks like walk_tree, but also returns file sizes and mtimes.
+
+    Yields (dirpath, dirnames, files), where files is a list of (name, size,
+    mtime_ns, (st_dev, st_ino) or None). A directory with the same inode and
+    mtime as its entry in ``snapshots`` is served from that entry, costing one
+    lstat instead of a scandir plus a stat per file. Every listing used goes
+    into ``fresh`` for save_dir_snapshots. A file changed in place doesn't touch
+    its directory's mtime, so entries older than ``ttl`` seconds (by default
+    ``dir_snapshot_ttl``) are rescanned anyway.
+    """
+    from array import array
+
+    one_file_system = SETTINGS.get("one_file_system", False)
+    ignore_files = SETTINGS.get("respect_ignore_files", False)
+    try:
+        st = os.stat(top)
+    except OSError:
+        return
+    now = time.time()
+    top = os.fspath(top)
+    root_dev = st.st_dev
+    visited = {(st.st_dev, st.st_ino)}
+    matcher = get_exclude_matcher()
+    with_paths = matcher.has_paths
+    rel_start = len(top.rstrip(os.sep)) + 1  # also right for "/" and "dir/"
+
+    stack = [(top, st, 0, _ancestor_ignore_rules(top) if ignore_files else None)]
+    while stack:
+        if superseded():
+            return
+        path, st, depth, rules = stack.pop()
+        snap = dir_snapshot(path, st, snapshots, now, ttl)
+        if snap is None:
+            continue
+        fresh[path] = snap
+        subdirs, joined, size_bytes, mtime_bytes, links = snap[3:]
+        names = joined.split("\0") if joined else []
+        sizes, mtimes = array("q"), array("q")
+        sizes.frombytes(size_bytes)
+        mtimes.frombytes(mtime_bytes)
+        link_keys = {i: (dev, ino) for i, dev, ino in links}
+
+        if ignore_files:
+            rules = _load_ignore_rules(path, [n for n in names if n in IGNORE_FILES], rules)
+        rel_dir = path[rel_start:] if with_paths else ""
+
+        def kept(name, is_dir):
+            rel = (f"{rel_dir}/{name}" if rel_dir else name) if with_paths else None
+            if matcher.match(name, is_dir, rel):
+                return False
+            return rules is None or not rules.ignored(os.path.join(path, name), is_dir)
+
+        dirs = [name for name in subdirs if kept(name, True)]
+        files = [
+            (name, sizes[i], mtimes[i], link_keys.get(i))
+            for i, name in enumerate(names) if kept(name, False)
+        ]
+        yield path, dirs, files
+
+        if max_depth is not None and depth >= max_depth:
+            continue
+        pending = []
+        for name in dirs:
+            child = os.path.join(path, name)
+            try:
+                child_st = os.lstat(child)
+            except OSError:
+                continue
+            if not S_ISDIR(child_st.st_mode):
+                continue  # symlinked directory
+            if one_file_system and child_st.st_dev != root_dev:
+                continue
+            child_key = (child_st.st_dev, child_st.st_ino)
+            if child_key in visited:
+                continue
+            visited.add(child_key)
+            pending.append((child, child_st, depth + 1, rules))
+        stack.extend(reversed(pending))
+
+
+# Per-root traversal costs from earlier runs, loaded on first use:
+# {root: {"walk": [seconds until level d was complete], "fd": {depth: seconds}}}
+# [{root: costs}, roots measured by this process] once loaded
+_depth_costs: List = []
+
+
+def _depth_budget() -> float:
+    """Returns the adaptive depth budget in seconds, 0 when depths are fixed."""
+    return max(SETTINGS.get("depth_budget_ms", 0), 0) / 1000
+
+
+def _root_costs(root) -> Dict:
+    if not _depth_costs:
+        _depth_costs[:] = [CacheStore(DEPTH_COSTS).load(), set()]
+    _depth_costs[1].add(os.fspath(root))
+    return _depth_costs[0].setdefault(os.fspath(root), {})
+
+
+def save_depth_costs() -> None:
+    """Persists the costs measured by this process, if any."""
+    if _depth_costs and _depth_costs[1] and not superseded():
+        costs, roots = _depth_costs
+        CacheStore(DEPTH_COSTS).update({root: costs[root] for root in roots})
+
+
+def budget_walk(top, budget: float, visited: Optional[set] = None):
+    """Walks top breadth-first, going one level deeper while time remains.
+
+    Yields like walk_tree, down to ``adaptive_max_depth``. Before a level is
+    started, its cost on earlier runs is compared with the remaining budget,
+    and the walk ends at the last complete level if it would not fit. Within
+    a level the walk stops once the budget is spent, keeping what was found.
+    Completed level times are averaged into the root's history.
+    """
+    top = os.fspath(top)
+    base = len(top.rstrip(os.sep))
+    costs = _root_costs(top)
+    history = costs.get("walk", [])
+    start = time.monotonic()
+    completed: List[float] = []
+    level = 0
+    try:
+        for path, dirs, files in walk_tree(
+            top, SETTINGS.get("adaptive_max_depth", 10), visited, breadth_first=True
+        ):
+            elapsed = time.monotonic() - start
+            depth = path[base:].count(os.sep) if path != top else 0
+            if depth > level:
+                completed.append(elapsed)
+                level = depth
+                if level < len(history):
+                    level_cost = history[level] - history[level - 1]
+                    if elapsed + level_cost > budget:
+                        return
+            if elapsed > budget and level > 0:
+                return  # the top directory is always listed
+            yield path, dirs, files
+        completed.append(time.monotonic() - start)
+    finally:
+        # Average with earlier runs; a deeper history is kept past this run
+        merged = [(old + new) / 2 for old, new in zip(history, completed)]
+        costs["walk"] = merged + completed[len(merged):] + history[len(completed):]
+
+
+def adaptive_fd_depth(root, default: int) -> int:
+    """Picks fd's --max-depth for root from its earlier run times.
+
+    The deepest depth that fit the budget is used, one level deeper when it
+    took less than half of the budget. Deeper depths that went over the
+    budget are skipped; when every known depth went over, one level
+    shallower than the shallowest one is tried.
+    """
+    budget = _depth_budget()
+    known = _root_costs(root).get("fd", {})
+    if not known:
+        return default
+    fitting = [depth for depth, seconds in known.items() if seconds <= budget]
+    if not fitting:
+        return max(1, min(known) - 1)
+    depth = max(fitting)
+    if known[depth] < budget / 2:
+        depth += 1
+    return min(depth, SETTINGS.get("adaptive_max_depth", 10))
+
+
+def record_fd_cost(root, depth: int, seconds: float) -> None:
+    fd_costs = _root_costs(root).setdefault("fd", {})
+    fd_costs[depth] = (fd_costs[depth] + seconds) / 2 if depth in fd_costs else seconds
+
+
+def _order_roots(paths: List[Path]) -> List[Path]:
+    """Drops duplicate roots and moves nested roots before their ancestors.
+
+    Combined with a shared ``visited`` set, the nested root is walked first
+    (with its own depth budget) and the ancestor's walk then skips it.
+    """
+    ordered: List[Tuple[str, Path]] = []
+    for path in paths:
+        real = os.path.realpath(path)
+        if any(real == other for other, _ in ordered):
+            continue
+        for i, (other, _) in enumerate(ordered):
+            if real.startswith(other.rstrip(os.sep) + os.sep):
+                ordered.insert(i, (real, path))
+                break
+        else:
+            ordered.append((real, path))
+    return [path for _, path in ordered]
+
+
+def parallel_workers() -> int:
+    """Returns the process count for parallel walks, 0 if disabled."""
+    workers = SETTINGS.get("parallel_walk_workers", 0)
+    if workers < 0:
+        workers = os.cpu_count() or 1
+    return workers if workers > 1 else 0
+
+
+def _partition_walk(scope: Path, workers: int) -> List[Tuple[str, bool]]:
+    """Splits scope into (path, recurse) work units for parallel_walk.
+
+    A unit with recurse=False only lists its own directory; recurse=True covers
+    the whole subtree. Top-level subtrees are split one more level while there
+    are fewer than 4 units per worker, so one huge subdirectory doesn't end up
+    in a single unit.
+    """
+    units: List[Tuple[str, bool]] = [(str(scope), False)]
+    subtrees = [os.path.join(root, d) for root, dirs, _ in walk_tree(scope, 0) for d in dirs]
+    for _ in range(2):
+        if len(subtrees) >= workers * 4:
+            break
+        expanded = []
+        for path in subtrees:
+            units.append((path, False))
+            expanded += [os.path.join(root, d) for root, dirs, _ in walk_tree(path, 0) for d in dirs]
+        subtrees = expanded
+    units += [(path, True) for path in subtrees]
+    return units
+
+
+def parallel_walk(scope: Path, unit_fn, unit_args: Tuple, workers: int, enough=None) -> List:
+    """Runs unit_fn over the work units of scope in a process pool.
+
+    unit_fn(path, recurse, excluded_patterns, *unit_args) must be a module-level
+    function returning a list of compact tuples; the lists are concatenated.
+    Units are handed out as workers become free, and once ``enough(results)``
+    is True the units not yet started are cancelled.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    units = _partition_walk(scope, workers)
+    results: List = []
+    pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        futures = [
+            pool.submit(unit_fn, path, recurse, list(EXCLUDED_PATTERNS), *unit_args)
+            for path, recurse in units
+        ]
+        for future in as_completed(futures):
+            try:
+                results.extend(future.result())
+            except Exception as e:  # a failing unit must not lose the others
+                logger.warning("Parallel walk unit failed: %s", e)
+            if (enough is not None and enough(results)) or superseded():
+                break
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    return results
+
+
+def _unit_walk(path: str, recurse: bool, patterns: List[str]):
+    """walk_tree for one work unit, using the parent's excluded patterns."""
+    global EXCLUDED_PATTERNS
+    EXCLUDED_PATTERNS = patterns
+    return walk_tree(path, None if recurse else 0)
+
+
+def _unit_find(path: str, recurse: bool, patterns: List[str], query: str, limit: int) -> List:
+    """Work unit for find: [(path, is_dir)] of names fuzzy-matching query."""
+    found = []
+    q = query.lower()
+    for root, dirs, files in _unit_walk(path, recurse, patterns):
+        for is_dir, names in ((True, dirs), (False, files)):
+            for name in names:
+                if _score_lowered(q, name.lower()) < 99:
+                    found.append((os.path.join(root, name), is_dir))
+                    if len(found) >= limit:
+                        return found
+    return found
+
+
+def _unit_files(
+    path: str, recurse: bool, patterns: List[str], key: str, min_value: float, limit: int
+) -> List:
+    """Work unit for size/recent: the top files by ``key`` ("size" or "mtime").
+
+    Returns up to limit (value, path, link key or None) tuples with value >=
+    min_value; link keys let the parent count hardlinks once.
+    """
+    import heapq
+
+    rows = []
+    for root, _, files in _unit_walk(path, recurse, patterns):
+        for name in files:
+            fpath = os.path.join(root, name)
+            try:
+                st = os.stat(fpath)
+            except OSError:
+                continue
+            value = st.st_size if key == "size" else st.st_mtime
+            if value >= min_value:
+                link = (st.st_dev, st.st_ino) if st.st_nlink > 1 else None
+                rows.append((value, fpath, link))
+    return heapq.nlargest(limit, rows, key=lambda row: row[0])
+
+
+def _top_files(rows: List, limit: int) -> List[Tuple[float, str]]:
+    """Sorts unit rows by value, counting each hardlinked file once."""
+    rows.sort(key=lambda row: row[0], reverse=True)
+    seen_links = set()
+    top = []
+    for value, path, link in rows:
+        if link is not None:
+            if link in seen_links:
+                continue
+            seen_links.add(link)
+        top.append((value, path))
+        if len(top) >= limit:
+            break
+    return top
+
+
+# --- Item creation ---
+
+
+# Shared by every item: the JSON encoder writes them once per item either
+# way, but building an item no longer allocates them.
+_TERMINAL_VARS = {"action": "terminal"}
+_COPY_PATH_VARS = {"action": "copy_path"}
+
+
+def _item_mods(terminal_dir: str, path_str: str) -> Dict:
+    """Returns the ⌘ (Terminal) and ⌃ (copy path) modifiers for an item."""
+    return {
+        "cmd": {"subtitle": "Open in Terminal", "arg": terminal_dir, "variables": _TERMINAL_VARS},
+        "ctrl": {"subtitle": "Copy path to clipboard", "arg": path_str, "variables": _COPY_PATH_VARS},
+    }
+
+
+def create_item(path: Path, is_file: bool = True, st: Optional[os.stat_result] = None) -> Dict:
+    """Creates an Alfred result item with file info in subtitle.
+
+    ``st`` saves the stat when the caller already has one. The parent path is
+    interned, as items listed together mostly share it.
+    """
+    path_str = str(path)
+    parent = sys.intern(os.path.dirname(path_str) or path_str)
+    info = _file_info(path, st)
+    subtitle = f"{'📄' if is_file else '📂'} {parent}"
+    if info:
+        subtitle = f"{subtitle} ({info})"
+
+    variables = {"is_dir": FILE_FLAG if is_file else DIR_FLAG}
+    item: Dict = {
+        "title": path.name or path_str,
+        "subtitle": subtitle,
+        "arg": path_str,
+        "type": "file" if is_file else "default",
+        "valid": True,
+        "variables": variables,
+        "mods": _item_mods(parent if is_file else path_str, path_str),
+        "icon": {"type": "fileicon", "path": path_str},
+    }
+    if not is_file:
+        variables["scope"] = path_str
+        item["autocomplete"] = path_str
+        item["keepalive"] = True
+
+    return item
+
+
+# --- Core operations ---
+
+
+def list_directory(scope: Path) -> List[Dict]:
+    """Shows contents of the current directory."""
+    items = []
+    try:
+        entries = []
+        with os.scandir(scope) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    st = None  # broken symlink: listed as a file, without info
+                is_file = st is None or not S_ISDIR(st.st_mode)
+                if not should_exclude(entry.name, not is_file):
+                    entries.append((is_file, entry.name.lower(), entry.path, st))
+        entries.sort(key=lambda e: (e[0], e[1]))
+        for is_file, _, path, st in entries:
+            items.append(create_item(Path(path), is_file, st))
+    except PermissionError:
+        logger.warning("Permission denied: %s", scope)
+        items.append(
+            {
+                "title": "Permission denied",
+                "subtitle": f"Cannot access {scope}",
+                "valid": False,
+            }
+        )
+    return items
+
+
+def search_files(
+    query: str,
+    scope: Path,
+    depth: int = SEARCH_DEPTH,
+    max_depth: int = 5,
+    max_results: int = 50,
+    use_fuzzy: bool = True,
+    visited: Optional[set] = None,
+    filters: Optional[QueryFilters] = None,
+) -> List[Dict]:
+    """Searches for files by query with fuzzy matching and relevance sorting.
+
+    ``visited`` is shared between calls for several roots so directories
+    reachable from more than one root are only searched once. ``filters`` are
+    checked on each match before its item is built; with filters an empty
+    query matches everything.
+    """
+    if not query and filters is None:
+        return []
+
+    segments = split_path_query(query)
+    if len(segments) > 1:
+        return _search_path_segments(
+            segments, scope, min(depth, max_depth), max_results, visited, filters
+        )
+
+    # Try fd first
+    if _has_fd():
+        budget = _depth_budget()
+        if budget:
+            depth = adaptive_fd_depth(scope, depth)
+        start = time.monotonic()
+        results = _search_with_fd(query, scope, depth, max_results, filters)
+        if results is not None:
+            if budget:
+                record_fd_cost(scope, depth, time.monotonic() - start)
+            return results
+
+    return _walk_search(query, scope, min(depth, max_depth), max_results, visited, filters)
+
+
+def _walk_search(
+    query: str,
+    scope: Path,
+    depth: int,
+    max_results: int,
+    visited: Optional[set] = None,
+    filters: Optional[QueryFilters] = None,
+    should_stop=None,
+) -> List[Dict]:
+    """Python fallback of search_files.
+
+    ``should_stop`` is polled between directories; when it returns True the
+    results gathered so far are returned. With ``depth_budget_ms`` the depth
+    adapts to the budget (see budget_walk) instead.
+    """
+    scored_items: List[Tuple[int, Dict]] = []
+    budget = _depth_budget()
+    walk = budget_walk(scope, budget, visited) if budget else walk_tree(scope, depth, visited)
+    for root, dirs, files in walk:
+        if should_stop is not None and should_stop():
+            break
+        for is_dir, names in ((True, dirs), (False, files)):
+            for name in names:
+                score = match_score(query, name)
+                if score == 99:
+                    continue
+                path_str = os.path.join(root, name)
+                if filters is not None and not filters.matches(path_str, is_dir):
+                    continue
+                scored_items.append((score, create_item(Path(path_str), not is_dir)))
+                if len(scored_items) >= max_results:
+                    break
+            if len(scored_items) >= max_results:
+                break
+        if len(scored_items) >= max_results:
+            break
+
+    scored_items.sort(key=lambda x: x[0])
+    return [item for _, item in scored_items]
+
+
+def _search_path_segments(
+    segments: List[str],
+    scope: Path,
+    depth: int,
+    max_results: int,
+    visited: Optional[set] = None,
+    filters: Optional[QueryFilters] = None,
+    should_stop=None,
+) -> List[Dict]:
+    """Searches for a path query like ``proj/api/handler``.
+
+    The first segment is matched against directory names within ``depth``;
+    each following segment must match an entry directly inside the directory
+    matched by the previous one. Only matching subtrees are descended into.
+    ``should_stop`` is polled between directories like in _walk_search.
+    """
+    scored: List[Tuple[int, Dict]] = []
+    first, rest = segments[0], segments[1:]
+    for root, dirs, _ in walk_tree(scope, depth, visited):
+        if should_stop is not None and should_stop():
+            break
+        for name in dirs:
+            score = match_score(first, name)
+            if score < 99:
+                _descend_segments(
+                    os.path.join(root, name), rest, score, scored, max_results, filters,
+                    should_stop,
+                )
+                if len(scored) >= max_results:
+                    break
+        if len(scored) >= max_results:
+            break
+    scored.sort(key=lambda x: x[0])
+    return [item for _, item in scored]
+
+
+def _descend_segments(
+    path: str,
+    segments: List[str],
+    score: int,
+    scored: List,
+    max_results: int,
+    filters: Optional[QueryFilters] = None,
+    should_stop=None,
+) -> None:
+    """Matches segments against successive levels below path."""
+    if should_stop is not None and should_stop():
+        return
+    last = len(segments) == 1
+    for _, dirs, files in walk_tree(path, max_depth=0):
+        for name in dirs:
+            seg_score = match_score(segments[0], name)
+            if seg_score == 99:
+                continue
+            child = os.path.join(path, name)
+            if last:
+                if filters is None or filters.matches(child, True):
+                    scored.append((score + seg_score, create_item(Path(child), is_file=False)))
+            else:
+                _descend_segments(
+                    child, segments[1:], score + seg_score, scored, max_results, filters,
+                    should_stop,
+                )
+            if len(scored) >= max_results:
+                return
+        if not last:
+            return
+        for name in files:
+            seg_score = match_score(segments[0], name)
+            child = os.path.join(path, name)
+            if seg_score < 99 and (filters is None or filters.matches(child, False)):
+                scored.append((score + seg_score, create_item(Path(child), is_file=True)))
+                if len(scored) >= max_results:
+                    return
+
+
+def _fd_search_cmd(
+    query: str,
+    scope: Path,
+    depth: int,
+    max_results: int,
+    filters: Optional[QueryFilters] = None,
+) -> List[str]:
+    """Builds the fd command line for a regular search."""
+    return _fd_base_cmd() + (filters.fd_args() if filters is not None else []) + [
+        "--max-depth",
+        str(depth),
+        "--max-results",
+        str(max_results),
+        query or ".",
+        str(scope),
+    ]
+
+
+def _fd_items(query: str, lines: List[str]) -> List[Dict]:
+    """Turns fd output lines into items sorted by match quality."""
+    items: List[Tuple[int, Dict]] = []
+    for line in lines:
+        if not line:
+            continue
+        path = Path(line)
+        score = match_score(query, path.name)
+        items.append((score, create_item(path, path.is_file())))
+    items.sort(key=lambda x: x[0])
+    return [item for _, item in items]
+
+
+def _search_with_fd(
+    query: str,
+    scope: Path,
+    depth: int,
+    max_results: int,
+    filters: Optional[QueryFilters] = None,
+) -> Optional[List[Dict]]:
+    """Searches using fd command for better performance."""
+    import subprocess
+
+    try:
+        cmd = _fd_search_cmd(query, scope, depth, max_results, filters)
+        returncode, lines = _run_fd(cmd, timeout=10)
+        if returncode not in (0, 1):
+            logger.warning("fd returned code %d", returncode)
+            return None
+        return _fd_items(query, lines)
+    except subprocess.TimeoutExpired:
+        logger.warning("fd search timed out")
+        return None
+    except FileNotFoundError:
+        logger.debug("fd not found, falling back to Python search")
+        return None
+    except OSError as e:
+        logger.warning("fd error: %s", e)
+        return None
+
+
+# --- New commands ---
+
+
+def handle_cd_up(scope: Path) -> List[Dict]:
+    """Handles cd.. command to move up one level."""
+    parent = scope.parent
+    item = create_item(parent, is_file=False)
+    item["subtitle"] = "⬆️ Parent directory"
+    return [item]
+
+
+def handle_find(
+    pattern: str, scope: Path, progress: Optional["_ProgressWriter"] = None
+) -> List[Dict]:
+    """Deep recursive search by filename (no depth limit)."""
+    if not pattern:
+        return [{
+            "title": "Usage: find <pattern>",
+            "subtitle": "Deep search by filename",
+            "valid": False,
+        }]
+
+    logger.info("find '%s' in %s", pattern, scope)
+    items = _find_entries(pattern, scope, progress)
+    if SETTINGS.get("search_archives", True) and len(items) < MAX_RESULTS:
+        # Interactive runs only open small uncached archives; progressive
+        # workers and the archive command open them all.
+        limit = None if progress is not None else SETTINGS.get("find_archive_max_mb", 20) << 20
+        items += search_archives(pattern, scope, MAX_RESULTS - len(items), limit)
+    return items
+
+
+def _find_entries(
+    pattern: str, scope: Path, progress: Optional["_ProgressWriter"] = None
+) -> List[Dict]:
+    """handle_find without archives: fd, else the parallel or plain walk."""
+    # Try fd first (no depth limit)
+    if _has_fd():
+        import subprocess
+
+        try:
+            cmd = _fd_base_cmd() + [
+                "--max-results",
+                str(MAX_RESULTS),
+                pattern,
+                str(scope),
+            ]
+            returncode, lines = _run_fd(cmd, timeout=15)
+            if returncode in (0, 1):
+                items = []
+                for line in lines:
+                    if not line:
+                        continue
+                    path = Path(line)
+                    items.append(create_item(path, path.is_file()))
+                if items:
+                    return items[:MAX_RESULTS]
+        except (subprocess.TimeoutExpired, OSError) as e:
+            logger.warning("fd find failed: %s", e)
+
+    # Python fallback: unlimited depth
+    workers = parallel_workers()
+    if workers:
+        found = parallel_walk(
+            scope, _unit_find, (pattern, MAX_RESULTS), workers,
+            enough=lambda results: len(results) >= MAX_RESULTS,
+        )
+        return [create_item(Path(p), not is_dir) for p, is_dir in found[:MAX_RESULTS]]
+
+    items = []
+    query_lower = pattern.lower()
+    for root, dirs, files in walk_tree(scope):
+        if progress is not None and progress.due():
+            progress.publish(items)
+        for name in dirs + files:
+            if query_lower in name.lower() or fuzzy_match(pattern, name):
+                path = Path(root) / name
+                items.append(create_item(path, path.is_file()))
+                if len(items) >= MAX_RESULTS:
+                    return items
+    return items
+
+
+TEXT_EXTENSIONS = {
+    ".txt", ".md", ".py", ".js", ".ts", ".json", ".yaml", ".yml",
+    ".toml", ".cfg", ".ini", ".sh", ".zsh", ".bash", ".html", ".css",
+    ".xml", ".csv", ".log", ".conf", ".env", ".rb", ".go", ".rs",
+    ".java", ".c", ".cpp", ".h", ".hpp", ".swift", ".kt", ".sql",
+}
+
+
+def _grep_file(fpath: Path, needle: str) -> Optional[Tuple[int, str]]:
+    """Returns (line number, snippet) of the first line containing needle."""
+    try:
+        with open(fpath, "r", errors="ignore") as f:
+            for lineno, line in enumerate(f, 1):
+                if needle in line.lower():
+                    return lineno, line.strip()[:80]
+    except OSError:
+        pass
+    return None
+
+
+def _grep_item(fpath: Path, lineno: int, snippet: str) -> Dict:
+    """Creates an Alfred item for a grep match."""
+    return {
+        "title": f"{fpath.name}:{lineno}",
+        "subtitle": f"📝 {snippet}",
+        "arg": str(fpath),
+        "type": "file",
+        "valid": True,
+        "variables": {"is_dir": FILE_FLAG},
+        "mods": _item_mods(str(fpath.parent), str(fpath)),
+    }
+
+
+def _rg_grep_cmd(pattern: str, scope: Path, max_depth: int) -> List[str]:
+    """Builds the ``rg --json`` command matching the Python grep engine.
+
+    Case-insensitive fixed strings, first match per file, TEXT_EXTENSIONS
+    only, and the depth, exclusion, ignore-file and file-system settings.
+    Hidden files are left to excluded_patterns, like the Python walker.
+    """
+    cmd = [
+        "rg", "--json", "--fixed-strings", "--ignore-case", "--max-count", "1",
+        "--hidden", "--max-depth", str(max_depth),
+    ]
+    if SETTINGS.get("respect_ignore_files", False):
+        cmd.append("--no-require-git")
+    else:
+        cmd.append("--no-ignore")
+    if SETTINGS.get("one_file_system", False):
+        cmd.append("--one-file-system")
+    for ext in sorted(TEXT_EXTENSIONS):
+        cmd += ["--iglob", f"*{ext}"]
+    # Later globs win in rg, so exclusions come after the extensions
+    for excluded in get_exclude_matcher().patterns:
+        cmd += ["--glob", f"!{excluded}"]
+    return cmd + ["--", pattern, str(scope)]
+
+
+def _grep_with_rg(pattern: str, scope: Path, max_depth: int) -> Optional[List[Dict]]:
+    """Searches file contents with ripgrep, parsing its JSON events as they arrive.
+
+    rg is killed once MAX_RESULTS files matched. Returns None if rg could not
+    run or failed without matches, so the Python engine takes over.
+    """
+    import subprocess
+
+    cmd = _rg_grep_cmd(pattern, scope, max_depth)
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        logger.warning("rg error: %s", e)
+        return None
+    assert proc.stdout is not None
+    items: List[Dict] = []
+    finished = False
+    try:
+        for line in _read_lines(proc, cmd, 15):
+            if not line.startswith('{"type":"match"'):
+                continue  # begin/end/context/summary events
+            try:
+                data = json.loads(line)["data"]
+                path = data["path"]["text"]  # non-UTF-8 paths come as "bytes": skipped
+                snippet = data["lines"].get("text", "")
+                lineno = data["line_number"]
+            except (ValueError, KeyError, TypeError):
+                continue
+            items.append(_grep_item(Path(path), lineno, snippet.strip()[:80]))
+            if len(items) >= MAX_RESULTS:
+                break
+        else:
+            finished = True
+    except subprocess.TimeoutExpired:
+        logger.warning("rg grep timed out")
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        proc.stdout.close()
+    if finished and proc.returncode not in (0, 1) and not items:
+        logger.warning("rg returned code %d", proc.returncode)
+        return None
+    return items
+
+
+async def _grep_files_async(
+    files: List[Path], needle: str, progress: Optional["_ProgressWriter"] = None
+) -> Dict[int, Tuple[int, str]]:
+    """Scans files concurrently (bounded by max_concurrency) until MAX_RESULTS hit.
+
+    Returns {index in files: (line number, snippet)}.
+    """
+    import asyncio
+
+    found: Dict[int, Tuple[int, str]] = {}
+
+    def factory(i: int):
+        async def scan():
+            if len(found) >= MAX_RESULTS or superseded():
+                return  # enough matches (or a newer search): remaining files are skipped
+            match = await asyncio.to_thread(_grep_file, files[i], needle)
+            if match is not None:
+                found[i] = match
+                if progress is not None and progress.due():
+                    progress.publish([_grep_item(files[j], *found[j]) for j in sorted(found)])
+        return scan
+
+    await gather_limited([factory(i) for i in range(len(files))], SETTINGS.get("max_concurrency", 4))
+    return found
+
+
+def handle_grep(
+    pattern: str, scope: Path, progress: Optional["_ProgressWriter"] = None
+) -> List[Dict]:
+    """Searches file contents for pattern.
+
+    Candidate files are collected first; larger sets are then read
+    concurrently through the async core.
+    """
+    if not pattern:
+        return [{
+            "title": "Usage: grep <pattern>",
+            "subtitle": "Search inside files",
+            "valid": False,
+        }]
+
+    logger.info("grep '%s' in %s", pattern, scope)
+    max_depth = SETTINGS.get("grep_max_depth", 2)
+    if max_depth < 1:
+        return []
+
+    if _has_rg() and not _depth_budget():
+        items = _grep_with_rg(pattern, scope, max_depth)
+        if items is not None:
+            return items
+
+    candidates = []
+    budget = _depth_budget()
+    if budget:
+        # Adaptive depth: listing gets half the budget, reading the rest
+        walk = budget_walk(scope, budget / 2)
+    else:
+        walk = walk_tree(scope, max_depth - 1)
+    for root, dirs, files in walk:
+        for fname in files:
+            fpath = Path(root) / fname
+            if fpath.suffix.lower() in TEXT_EXTENSIONS:
+                candidates.append(fpath)
+    save_depth_costs()
+
+    needle = pattern.lower()
+    if len(candidates) >= GREP_ASYNC_MIN_FILES:
+        found = run_async(_grep_files_async(candidates, needle, progress))
+        return [_grep_item(candidates[i], *found[i]) for i in sorted(found)][:MAX_RESULTS]
+
+    items = []
+    for fpath in candidates:
+        if superseded():
+            break
+        if progress is not None and progress.due():
+            progress.publish(items)
+        match = _grep_file(fpath, needle)
+        if match is not None:
+            items.append(_grep_item(fpath, *match))
+            if len(items) >= MAX_RESULTS:
+                break
+    return items
+
+
+class _TreeDir:
+    """A directory in handle_tree: its sorted listing and how much of it is shown."""
+
+    __slots__ = ("path", "children", "shown", "depth")
+
+    def __init__(self, path: str, children: List[Tuple[bool, str]], depth: int) -> None:
+        self.path = path
+        self.children = children  # (is_dir, name), directories first
+        self.shown: List = []  # _TreeDir for expanded subdirectories, else (is_dir, name)
+        self.depth = depth
+
+
+def _scan_dir_names(path: str) -> Tuple[Tuple[str, ...], str]:
+    """Returns (subdir names, NUL-joined file names) of path, without a stat per entry."""
+    dirs: List[str] = []
+    files: List[str] = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                (dirs if entry.is_dir() else files).append(entry.name)
+            except OSError:
+                continue
+    return tuple(dirs), "\0".join(files)
+
+
+def _tree_listing(path: str, st: os.stat_result, cache: Dict, fresh: Dict, top: str) -> Optional[List]:
+    """Returns the sorted, exclusion-filtered (is_dir, name) children of path.
+
+    Names are reused from ``cache`` while the directory's inode and mtime
+    match ``st``; every listing used goes into ``fresh``.
+    """
+    entry = cache.get(path)
+    hit = entry is not None and entry[0] == st.st_ino and entry[1] == st.st_mtime_ns
+    count_cache(TREE_CACHE, hit)
+    if entry is None or not hit:
+        try:
+            entry = (st.st_ino, st.st_mtime_ns) + _scan_dir_names(path)
+        except OSError as e:
+            logger.debug("Cannot list %s: %s", path, e)
+            return None
+    fresh[path] = entry
+    matcher = get_exclude_matcher()
+    rel_dir = path[len(top.rstrip(os.sep)) + 1:] if matcher.has_paths else ""
+    children = []
+    for is_dir, names in ((True, entry[2]), (False, entry[3].split("\0") if entry[3] else ())):
+        for name in names:
+            rel = (f"{rel_dir}/{name}" if rel_dir else name) if matcher.has_paths else None
+            if not matcher.match(name, is_dir, rel):
+                children.append((is_dir, name))
+    children.sort(key=lambda child: (not child[0], child[1].lower()))
+    return children
+
+
+def handle_tree(scope: Path) -> List[Dict]:
+    """Shows directory tree structure (tree_max_depth levels deep).
+
+    The MAX_RESULTS items are shared level by level: all of a level's folders
+    show their entries round-robin before any subfolder is expanded, so
+    siblings come before descendants and one huge folder can't crowd out the
+    rest. Whatever a folder can't show is collapsed into an "N more…" node
+    that sets the scope to it. Only the folders actually expanded are listed,
+    with one scandir and no stat per entry; their names are kept in
+    tree.cache for the last TREE_CACHE_SCOPES scopes, so an unchanged folder
+    costs one stat.
+    """
+    logger.info("tree %s", scope)
+    max_depth = SETTINGS.get("tree_max_depth", 2)
+    top = os.fspath(scope)
+    store = CacheStore(TREE_CACHE)
+    cache = store.load().get(top, {})
+    fresh: Dict[str, Tuple] = {}
+    try:
+        children = _tree_listing(top, os.stat(top), cache, fresh, top)
+    except OSError:
+        children = None
+    if children is None:
+        return []
+
+    root = _TreeDir(top, children, 0)
+    level = [root]
+    used = 1 if children else 0  # shown entries plus one "more" node per unfinished dir
+    while level and not superseded():
+        # Share what is left between this level's folders, one entry per round
+        open_dirs = [node for node in level if node.children]
+        while open_dirs:
+            still_open = []
+            for node in open_dirs:
+                cost = 1 if len(node.shown) + 1 < len(node.children) else 0  # 0: replaces "more"
+                if used + cost > MAX_RESULTS:
+                    continue  # full: this directory stays collapsed from here on
+                used += cost
+                node.shown.append(node.children[len(node.shown)])
+                if len(node.shown) < len(node.children):
+                    still_open.append(node)
+            open_dirs = still_open
+
+        # Then expand the subfolders shown, in display order, while room is left
+        next_level: List[_TreeDir] = []
+        for node in level:
+            if node.depth >= max_depth:
+                break
+            for i, (is_dir, name) in enumerate(node.shown):
+                if not is_dir or used + 2 > MAX_RESULTS:  # its "more" node and one entry
+                    continue
+                path = os.path.join(node.path, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if not S_ISDIR(st.st_mode):
+                    continue  # symlinks are not expanded
+                listing = _tree_listing(path, st, cache, fresh, top)
+                if listing:
+                    child = _TreeDir(path, listing, node.depth + 1)
+                    node.shown[i] = child
+                    next_level.append(child)
+                    used += 1
+        level = next_level
+    if not superseded() and any(cache.get(path) is not entry for path, entry in fresh.items()):
+        store.update({top: fresh}, limit=TREE_CACHE_SCOPES)
+
+    items: List[Dict] = []
+
+    def render(node: _TreeDir, prefix: str) -> None:
+        hidden = len(node.children) - len(node.shown)
+        for i, entry in enumerate(node.shown):
+            is_last = i == len(node.shown) - 1 and not hidden
+            if isinstance(entry, _TreeDir):
+                is_dir, path = True, entry.path
+            else:
+                is_dir, path = entry[0], os.path.join(node.path, entry[1])
+            connector = "└── " if is_last else "├── "
+            label = f"📂 {os.path.basename(path)}/" if is_dir else os.path.basename(path)
+            variables = {"is_dir": DIR_FLAG if is_dir else FILE_FLAG}
+            if is_dir:
+                variables["scope"] = path
+            items.append({
+                "title": f"{prefix}{connector}{label}",
+                "subtitle": path,
+                "arg": path,
+                "type": "default" if is_dir else "file",
+                "valid": True,
+                "variables": variables,
+            })
+            if isinstance(entry, _TreeDir):
+                render(entry, prefix + ("    " if is_last else "│   "))
+        if hidden:
+            items.append({
+                "title": f"{prefix}└── … {hidden} more",
+                "subtitle": f"Show all of {node.path}",
+                "arg": node.path,
+                "type": "default",
+                "valid": True,
+                "variables": {"is_dir": DIR_FLAG, "scope": node.path},
+            })
+
+    render(root, "")
+    return items
+
+
+def handle_recent(args: str, scope: Path) -> List[Dict]:
+    """Shows recently modified files. Usage: recent [days]."""
+    days = 1
+    if args.strip():
+        try:
+            days = int(args.strip())
+        except ValueError:
+            return [{
+                "title": "Usage: recent [days]",
+                "subtitle": "Show files modified in last N days (default: 1)",
+                "valid": False,
+            }]
+
+    logger.info("recent %d days in %s", days, scope)
+
+    # Try fd first
+    if _has_fd():
+        import subprocess
+
+        try:
+            cmd = _fd_base_cmd() + [
+                "--type", "f",
+                "--changed-within", f"{days}d",
+                "--max-results", str(MAX_RESULTS),
+                ".", str(scope),
+            ]
+            returncode, lines = _run_fd(cmd, timeout=15)
+            if returncode in (0, 1) and lines:
+                items = []
+                for line in lines:
+                    if not line:
+                        continue
+                    path = Path(line)
+                    items.append(create_item(path, is_file=True))
+                # Sort by mtime newest first
+                items.sort(
+                    key=lambda x: _safe_mtime(Path(x["arg"])), reverse=True
+                )
+                return items[:MAX_RESULTS]
+        except (subprocess.TimeoutExpired, OSError) as e:
+            logger.warning("fd recent failed: %s", e)
+
+    # Python fallback
+    cutoff = time.time() - days * 86400
+    workers = parallel_workers()
+    if workers:
+        rows = parallel_walk(scope, _unit_files, ("mtime", cutoff, MAX_RESULTS), workers)
+        return [create_item(Path(p), is_file=True) for _, p in _top_files(rows, MAX_RESULTS)]
+
+    import heapq
+
+    cutoff_ns = int(cutoff * 1e9)
+    snapshots = load_dir_snapshots(scope)
+    fresh: Dict[str, Tuple] = {}
+    rows = []
+    for root, _, files in walk_stats(scope, snapshots, fresh):
+        for name, _, mtime_ns, _ in files:
+            if mtime_ns >= cutoff_ns:
+                rows.append((mtime_ns, os.path.join(root, name)))
+    save_dir_snapshots(snapshots, fresh, scope)
+    return [create_item(Path(p), is_file=True) for _, p in heapq.nlargest(MAX_RESULTS, rows)]
+
+
+def _safe_mtime(path: Path) -> float:
+    """Returns mtime or 0 on error."""
+    try:
+        return path.stat().st_mtime
+    except OSError:
+        return 0.0
+
+
+def handle_size(
+    args: str, scope: Path, progress: Optional["_ProgressWriter"] = None
+) -> List[Dict]:
+    """Shows largest files. Usage: size [threshold like 10m, 100k]."""
+    threshold = 0
+    if args.strip():
+        threshold = _parse_size(args.strip())
+        if threshold < 0:
+            return [{
+                "title": "Usage: size [threshold]",
+                "subtitle": "Examples: size 10m, size 100k, size 1g",
+                "valid": False,
+            }]
+
+    logger.info("size threshold=%d in %s", threshold, scope)
+    workers = parallel_workers()
+    if workers:
+        # Each unit returns its own top files; extra rows absorb hardlink dups
+        rows = parallel_walk(scope, _unit_files, ("size", threshold, MAX_RESULTS * 2), workers)
+        return [create_item(Path(p), is_file=True) for _, p in _top_files(rows, MAX_RESULTS)]
+
+    rows = []  # (size, path, link key); _top_files counts hardlinks once
+    snapshots = load_dir_snapshots(scope)
+    fresh: Dict[str, Tuple] = {}
+    for root, _, files in walk_stats(scope, snapshots, fresh):
+        if progress is not None and progress.due():
+            progress.publish([create_item(Path(p)) for _, p in _top_files(rows, MAX_RESULTS)])
+        for name, size, _, link in files:
+            if size >= threshold:
+                rows.append((size, os.path.join(root, name), link))
+    save_dir_snapshots(snapshots, fresh, scope)
+    return [create_item(Path(p), is_file=True) for _, p in _top_files(rows, MAX_RESULTS)]
+
+
+def handle_du(args: str, scope: Path) -> List[Dict]:
+    """Shows heaviest directories by aggregated size. Usage: du [depth]."""
+    max_depth = SETTINGS.get("du_max_depth", 1)
+    if args.strip():
+        try:
+            max_depth = int(args.strip())
+        except ValueError:
+            max_depth = 0
+        if max_depth < 1:
+            return [{
+                "title": "Usage: du [depth]",
+                "subtitle": "Largest folders by total size (default depth: 1)",
+                "valid": False,
+            }]
+
+    logger.info("du depth=%d in %s", max_depth, scope)
+    # The shared walker brings exclusions, ignore files, one_file_system and
+    # the directory snapshots, so an unchanged folder costs one lstat
+    snapshots = load_dir_snapshots(scope)
+    fresh: Dict[str, Tuple] = {}
+    totals: Dict[str, int] = {}
+    seen_links = set()
+    root = str(scope)
+    for path, _, files in walk_stats(root, snapshots, fresh):
+        if path == root:
+            continue
+        own = 0
+        for _, size, _, link in files:
+            if link is not None:
+                if link in seen_links:
+                    continue  # another name for a file already counted
+                seen_links.add(link)
+            own += size
+        # The folder's own bytes count towards each ancestor down to max_depth
+        parts = path[len(root):].strip(os.sep).split(os.sep)
+        if len(parts) <= max_depth:
+            totals.setdefault(path, 0)
+        for level in range(1, min(len(parts), max_depth) + 1):
+            key = os.path.join(root, *parts[:level])
+            totals[key] += own
+    if superseded():
+        return []
+    save_dir_snapshots(snapshots, fresh, root)
+
+    items = []
+    for path_str, total in sorted(totals.items(), key=lambda x: x[1], reverse=True)[:MAX_RESULTS]:
+        path = Path(path_str)
+        item = create_item(path, is_file=False)
+        item["subtitle"] = f"📂 {_format_size(total)} | {path.parent}"
+        items.append(item)
+    return items
+
+
+def _parse_size(s: str) -> int:
+    """Parses size string like '10m', '100k', '1g'. Returns -1 on error."""
+    s = s.lower().strip()
+    multipliers = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    if s[-1] in multipliers:
+        try:
+            return int(float(s[:-1]) * multipliers[s[-1]])
+        except ValueError:
+            return -1
+    try:
+        return int(s)
+    except ValueError:
+        return -1
+
+
+def _hash_file(path: str, size: int, partial: bool) -> Optional[bytes]:
+    """Returns a blake2b digest of the file, or of its first and last HASH_EDGE bytes."""
+    import hashlib
+
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        with open(path, "rb") as f:
+            if partial and size > 2 * HASH_EDGE:
+                digest.update(f.read(HASH_EDGE))
+                f.seek(size - HASH_EDGE)
+                digest.update(f.read(HASH_EDGE))
+            else:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+    except OSError as e:
+        logger.debug("dupes cannot read %s: %s", path, e)
+        return None
+    return digest.digest()
+
+
+def _narrow_groups(groups: List[List[Tuple]], stage: int, cache: Dict, pool) -> List[List[Tuple]]:
+    """Splits each group of (path, size, cache key) by hash, keeping collisions.
+
+    ``stage`` 0 hashes both ends of each file, 1 the whole file. Hashes are
+    looked up in ``cache`` by (st_dev, st_ino, size, mtime_ns) first; the
+    missing ones are computed in ``pool``.
+    """
+    todo = [
+        entry for group in groups for entry in group
+        if cache.get(entry[2], (None, None))[stage] is None
+    ]
+    for group in groups:
+        for entry in group:
+            count_cache(HASH_CACHE, cache.get(entry[2], (None, None))[stage] is not None)
+    results = pool.map(lambda entry: _hash_file(entry[0], entry[1], stage == 0), todo)
+    for entry, digest in zip(todo, results):
+        hashes = list(cache.get(entry[2], (None, None)))
+        hashes[stage] = digest
+        # Up to 2 * HASH_EDGE bytes the partial hash already covers the file
+        if stage == 0 and entry[1] <= 2 * HASH_EDGE:
+            hashes[1] = digest
+        cache[entry[2]] = tuple(hashes)
+
+    narrowed: List[List[Tuple]] = []
+    for group in groups:
+        by_hash: Dict[bytes, List[Tuple]] = {}
+        for entry in group:
+            digest = cache.get(entry[2], (None, None))[stage]
+            if digest is not None:
+                by_hash.setdefault(digest, []).append(entry)
+        narrowed.extend(same for same in by_hash.values() if len(same) > 1)
+    return narrowed
+
+
+def handle_dupes(args: str, scope: Path) -> List[Dict]:
+    """Finds duplicate files. Usage: dupes [min size like 1m, 100k]."""
+    min_size = 1
+    if args.strip():
+        min_size = _parse_size(args.strip())
+        if min_size < 0:
+            return [{
+                "title": "Usage: dupes [min size]",
+                "subtitle": "Examples: dupes, dupes 1m, dupes 100k",
+                "valid": False,
+            }]
+
+    logger.info("dupes min_size=%d in %s", min_size, scope)
+    # Stage 1: group by size, from the directory snapshots
+    snapshots = load_dir_snapshots(scope)
+    fresh: Dict[str, Tuple] = {}
+    by_size: Dict[int, List[str]] = {}
+    seen_links = set()
+    for root, _, files in walk_stats(scope, snapshots, fresh):
+        for name, size, _, link in files:
+            if size < max(min_size, 1):
+                continue
+            if link is not None:
+                if link in seen_links:
+                    continue  # another name for a file already listed
+                seen_links.add(link)
+            by_size.setdefault(size, []).append(os.path.join(root, name))
+    save_dir_snapshots(snapshots, fresh, scope)
+
+    groups = []
+    for size, paths in by_size.items():
+        if len(paths) < 2:
+            continue
+        group = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            group.append((path, size, (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)))
+        if len(group) > 1:
+            groups.append(group)
+
+    # Stages 2 and 3: hash both ends, then whole files, of what still collides
+    from concurrent.futures import ThreadPoolExecutor
+
+    store = CacheStore(HASH_CACHE)
+    cache = store.load()
+    candidates = [entry for group in groups for entry in group]
+    with ThreadPoolExecutor(max_workers=SETTINGS.get("max_concurrency", 4)) as pool:
+        for stage in (0, 1):
+            if superseded():
+                return []
+            groups = _narrow_groups(groups, stage, cache, pool)
+    # Keys change whenever a file does, so old ones are simply aged out:
+    # entries used now move to the end, the oldest beyond the limit go
+    used = {entry[2]: cache[entry[2]] for entry in candidates if entry[2] in cache}
+    if used:
+        store.update(used, limit=HASH_CACHE_MAX)
+
+    groups.sort(key=lambda group: group[0][1] * (len(group) - 1), reverse=True)
+    items = []
+    for number, group in enumerate(groups, 1):
+        for path, size, _ in sorted(group):
+            item = create_item(Path(path), is_file=True)
+            item["subtitle"] = (
+                f"🧬 #{number}: {len(group)} copies × {_format_size(size)} | {os.path.dirname(path)}"
+            )
+            items.append(item)
+        if len(items) >= MAX_RESULTS:
+            break
+    return items[:MAX_RESULTS]
+
+
+def _is_archive(name: str) -> bool:
+    return name.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def _archive_members(path: str) -> Optional[List[str]]:
+    """Lists the file members of a zip or tar archive, None if unreadable."""
+    try:
+        if path.lower().endswith(".zip"):
+            import zipfile
+
+            with zipfile.ZipFile(path) as archive:
+                return [info.filename for info in archive.infolist() if not info.is_dir()]
+        import tarfile
+
+        with tarfile.open(path) as archive:
+            return [member.name for member in archive.getmembers() if not member.isdir()]
+    except Exception as e:  # BadZipFile, TarError, EOFError, zlib/lzma errors...
+        logger.debug("Cannot list archive %s: %s", path, e)
+        return None
+
+
+def _find_archives(scope: Path) -> List[str]:
+    """Returns the paths of the archives under scope (fd, else walk_tree)."""
+    if _has_fd():
+        cmd = _fd_base_cmd() + ["--type", "f"]
+        for ext in sorted({suffix.rsplit(".", 1)[1] for suffix in ARCHIVE_SUFFIXES}):
+            cmd += ["--extension", ext]
+        try:
+            returncode, lines = _run_fd(cmd + [".", str(scope)], timeout=15)
+            if returncode in (0, 1):
+                return [line for line in lines if _is_archive(line)]
+        except Exception as e:
+            logger.warning("fd archive listing failed: %s", e)
+    return [
+        os.path.join(root, name)
+        for root, _, files in walk_tree(scope) for name in files if _is_archive(name)
+    ]
+
+
+def _archive_item(archive: str, member: str) -> Dict:
+    """Creates an item for a member, shown as ``archive.zip › member/path``."""
+    return {
+        "title": f"{os.path.basename(archive)} › {member}",
+        "subtitle": f"🗜 {member} in {os.path.dirname(archive)}",
+        "arg": archive,
+        "type": "file",
+        "valid": True,
+        "variables": {"is_dir": FILE_FLAG, "member": member},
+        "mods": _item_mods(os.path.dirname(archive), archive),
+        "icon": {"type": "fileicon", "path": archive},
+    }
+
+
+def search_archives(
+    pattern: str, scope: Path, max_results: int = 50, max_open_bytes: Optional[int] = None
+) -> List[Dict]:
+    """Matches pattern against the members of the zip/tar archives under scope.
+
+    Member names are scored by basename with match_score. Each archive's
+    member list is cached in archives.cache keyed by (path, size, mtime), so
+    only new or changed archives are opened; a compressed tar has to be read
+    in full to list it. Uncached archives larger than ``max_open_bytes`` are
+    skipped. A superseded run returns [] and leaves the cache as it was.
+    """
+    store = CacheStore(ARCHIVE_CACHE)
+    cache = store.load()
+    archives = _find_archives(scope)
+    if superseded():
+        return []  # the listing may be incomplete: don't prune by it
+    # Forget archives that are gone from this scope
+    prefix = str(scope).rstrip(os.sep) + os.sep
+    present = set(archives)
+    stale = [key for key in cache if key.startswith(prefix) and key not in present]
+    changed: Dict[str, Tuple] = {}
+    q = pattern.lower()
+    scored: List[Tuple[int, str, str]] = []
+    for archive in archives:
+        if superseded():
+            return []
+        try:
+            st = os.stat(archive)
+        except OSError:
+            continue
+        cached = cache.get(archive)
+        hit = cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns
+        count_cache(ARCHIVE_CACHE, hit)
+        if hit:
+            joined = cached[2]
+        elif max_open_bytes is not None and st.st_size > max_open_bytes:
+            continue
+        else:
+            members = _archive_members(archive)
+            joined = "\0".join(members) if members else ""
+            changed[archive] = (st.st_size, st.st_mtime_ns, joined)
+        for member in joined.split("\0") if joined else ():
+            score = _score_lowered(q, member.rsplit("/", 1)[-1].lower())
+            if score != 99:
+                scored.append((score, archive, member))
+    if stale or changed:
+        store.update(changed, stale)
+    scored.sort()
+    return [_archive_item(archive, member) for _, archive, member in scored[:max_results]]
+
+
+def handle_archive(pattern: str, scope: Path) -> List[Dict]:
+    """Searches inside zip/tar archives. Usage: archive <pattern>."""
+    if not pattern:
+        return [{
+            "title": "Usage: archive <pattern>",
+            "subtitle": "Search file names inside .zip and .tar archives",
+            "valid": False,
+        }]
+    logger.info("archive '%s' in %s", pattern, scope)
+    return search_archives(pattern, scope, MAX_RESULTS)
+
+
+def _snapshot_files(snap: Tuple) -> Dict[str, Tuple[int, int]]:
+    """Returns {file name: (size, mtime_ns)} of a directory snapshot entry."""
+    from array import array
+
+    names = snap[4].split("\0") if snap[4] else []
+    sizes, mtimes = array("q"), array("q")
+    sizes.frombytes(snap[5])
+    mtimes.frombytes(snap[6])
+    return {name: (sizes[i], mtimes[i]) for i, name in enumerate(names)}
+
+
+def _change_item(kind: str, path: str, size: int) -> Dict:
+    if kind == "deleted":
+        item = {"title": os.path.basename(path), "arg": path, "valid": False}
+        mark = "✖"
+    else:
+        item = create_item(Path(path), is_file=True)
+        mark = "✚" if kind == "created" else "✎"
+    item["subtitle"] = f"{mark} {kind}, {_format_size(size)} | {os.path.dirname(path)}"
+    return item
+
+
+def handle_changes(args: str, scope: Path) -> List[Dict]:
+    """Lists files created, modified or deleted under scope since the last visit.
+
+    Each visit stores the directory snapshot entries of scope as its baseline
+    in changes.baseline. The next visit walks scope with walk_stats against
+    that baseline: a directory whose inode and mtime are unchanged costs one
+    stat and holds no changes, only the others are listed and compared file by
+    file. As with du, a file rewritten in place without touching its directory
+    is not noticed. Alfred reruns the query while it is open, so a visit
+    within CHANGES_RERUN seconds of the last one keeps comparing with the
+    baseline before it.
+    """
+    if args:
+        return [{
+            "title": "Usage: changes",
+            "subtitle": "Files created, modified or deleted here since the last visit",
+            "valid": False,
+        }]
+
+    store = CacheStore(CHANGES_BASELINE)
+    root = str(scope)
+    record = store.load().get(root)
+    now = time.time()
+    since, base = None, {}
+    if record is not None:
+        visited, current, prev_since, prev = record
+        if now - visited < CHANGES_RERUN and prev_since is not None:
+            since, base = prev_since, prev
+        else:
+            since, base = visited, current
+
+    fresh: Dict[str, Tuple] = {}
+    changes: List[Tuple[int, str, str, int]] = []  # (mtime_ns, kind, path, size)
+    count = 0
+    for path, _, files in walk_stats(root, base, fresh, ttl=float("inf")):
+        count += len(files)
+        old = base.get(path)
+        if since is None or fresh[path] is old:
+            continue
+        before = _snapshot_files(old) if old is not None else {}
+        for name, size, mtime_ns, _ in files:
+            was = before.get(name)
+            if was is None:
+                changes.append((mtime_ns, "created", os.path.join(path, name), size))
+            elif was != (size, mtime_ns):
+                changes.append((mtime_ns, "modified", os.path.join(path, name), size))
+        now_names = set(fresh[path][4].split("\0"))
+        for name, (size, mtime_ns) in before.items():
+            if name not in now_names and not should_exclude(name, False):
+                changes.append((mtime_ns, "deleted", os.path.join(path, name), size))
+    if superseded():
+        return []
+    if since is not None:
+        # Directories gone since the baseline take their files with them
+        for path, old in base.items():
+            if path not in fresh and not os.path.isdir(path):
+                for name, (size, mtime_ns) in _snapshot_files(old).items():
+                    if not should_exclude(name, False):
+                        changes.append((mtime_ns, "deleted", os.path.join(path, name), size))
+    store.update({root: (now, fresh, since, base)}, limit=CHANGES_SCOPES_MAX)
+
+    if since is None:
+        return [{
+            "title": f"Snapshot saved: {count} files in {len(fresh)} folders",
+            "subtitle": "Run changes again later to see what was created, modified or deleted",
+            "valid": False,
+        }]
+    counts = {kind: 0 for kind in ("created", "modified", "deleted")}
+    for _, kind, _, _ in changes:
+        counts[kind] += 1
+    summary = {
+        "title": ", ".join(f"{n} {kind}" for kind, n in counts.items()),
+        "subtitle": f"Since {time.strftime('%Y-%m-%d %H:%M', time.localtime(since))} in {scope}",
+        "valid": False,
+    }
+    # Newest first; deletions, whose time is unknown, after the rest
+    changes.sort(key=lambda change: (change[1] != "deleted", change[0], change[2]), reverse=True)
+    return [summary] + [
+        _change_item(kind, path, size) for _, kind, path, size in changes[:MAX_RESULTS]
+    ]
+
+
+# --- Name index ---
+#
+# names.index layout (native byte order), every section 8-byte aligned:
+#   header       INDEX_HEADER: magic, entry count N, root count R, build time,
+#                then the byte offset of each section below
+#   lower_off    uint32[N + 1]  start of each name in lower_names
+#   lower_names  lowercased basenames, sorted, each followed by NUL
+#   name_off     uint32[N + 1]  start of each name in names
+#   names        original basenames in the same order, NUL-terminated
+#   parent       uint32[N]      entry index of the parent directory, or N + r
+#                               for entries directly inside root r
+#   kind         uint8[N]       1 for directories, 0 for files
+#   size         int64[N]       bytes
+#   mtime        int64[N]       seconds
+#   roots        R NUL-terminated root paths
+
+INDEX_MAGIC = b"ASRIDX1\0"
+INDEX_HEADER = "=8sIId9Q"
+
+
+class _IndexStat(NamedTuple):
+    """The stat fields QueryFilters reads, taken from index columns."""
+
+    st_size: int
+    st_mtime: float
+
+
+def build_index(roots: List[Path], path: Optional[Path] = None) -> int:
+    """Walks roots up to ``index_max_depth`` and writes the name index.
+
+    Returns the number of entries. The file is written to a temp name and
+    renamed into place, so readers never see a partial index.
+    """
+    import struct
+    from array import array
+
+    started = time.time()  # what changes after this may be missing
+    max_depth = SETTINGS.get("index_max_depth", 8)
+    lowers: List[bytes] = []
+    names: List[bytes] = []
+    parents: List[int] = []  # walk order ids, -1 - r for root r
+    kinds = array("B")
+    sizes = array("q")
+    mtimes = array("q")
+    root_paths: List[bytes] = []
+    visited: set = set()
+    for r, root in enumerate(_order_roots(roots)):
+        root_str = os.path.abspath(root)
+        root_paths.append(os.fsencode(root_str))
+        dir_ids = {root_str: -1 - r}
+        for dirpath, dirs, files in walk_tree(root_str, max_depth, visited):
+            parent = dir_ids.get(dirpath)
+            if parent is None:
+                continue
+            for is_dir, entries in ((True, dirs), (False, files)):
+                for name in entries:
+                    full = os.path.join(dirpath, name)
+                    try:
+                        st = os.lstat(full)
+                    except OSError:
+                        continue
+                    if is_dir:
+                        dir_ids[full] = len(names)
+                    names.append(os.fsencode(name))
+                    lowers.append(name.lower().encode("utf-8", "surrogateescape"))
+                    parents.append(parent)
+                    kinds.append(1 if is_dir else 0)
+                    sizes.append(0 if is_dir else st.st_size)
+                    mtimes.append(int(st.st_mtime))
+
+    count = len(names)
+    order = sorted(range(count), key=lowers.__getitem__)
+    rank = [0] * count
+    for new, old in enumerate(order):
+        rank[old] = new
+
+    def table(strings):
+        offsets = array("I", [0])
+        for value in strings:
+            offsets.append(offsets[-1] + len(value) + 1)
+        return offsets.tobytes(), b"".join(value + b"\0" for value in strings)
+
+    lower_off, lower_blob = table([lowers[i] for i in order])
+    name_off, name_blob = table([names[i] for i in order])
+    parent_col = array("I", [
+        rank[parents[i]] if parents[i] >= 0 else count - 1 - parents[i] for i in order
+    ])
+    sections = [
+        lower_off, lower_blob, name_off, name_blob, parent_col.tobytes(),
+        array("B", [kinds[i] for i in order]).tobytes(),
+        array("q", [sizes[i] for i in order]).tobytes(),
+        array("q", [mtimes[i] for i in order]).tobytes(),
+        b"".join(root + b"\0" for root in root_paths),
+    ]
+    offsets = []
+    pos = struct.calcsize(INDEX_HEADER)
+    body = []
+    for section in sections:
+        pad = -pos % 8
+        body.append(b"\0" * pad)
+        pos += pad
+        offsets.append(pos)
+        body.append(section)
+        pos += len(section)
+    header = struct.pack(INDEX_HEADER, INDEX_MAGIC, count, len(root_paths), started, *offsets)
+
+    path = path or _get_workflow_data_dir() / NAME_INDEX
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            f.write(header)
+            f.writelines(body)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    logger.info("Indexed %d entries under %d roots", count, len(root_paths))
+    return count
+
+
+class NameIndex:
+    """Read-only view of names.index (see build_index).
+
+    Opening maps the file and reads the header only; queries read the pages
+    they touch, so the cost does not grow with the index size.
+    """
+
+    def __init__(self, path: Path) -> None:
+        import mmap
+        import struct
+
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        fields = struct.unpack_from(INDEX_HEADER, self._mm, 0)
+        if fields[0] != INDEX_MAGIC:
+            raise ValueError(f"{path} is not a name index")
+        self.count, root_count, self.built_at = fields[1:4]
+        offsets = fields[4:] + (len(self._mm),)
+        n = self.count
+        view = memoryview(self._mm)
+        self._lower_start = offsets[1]
+        self._lower_off = view[offsets[0]:offsets[0] + 4 * (n + 1)].cast("I")
+        self._name_start = offsets[3]
+        self._name_off = view[offsets[2]:offsets[2] + 4 * (n + 1)].cast("I")
+        self._parent = view[offsets[4]:offsets[4] + 4 * n].cast("I")
+        self._kind = view[offsets[5]:offsets[5] + n]
+        self._size = view[offsets[6]:offsets[6] + 8 * n].cast("q")
+        self._mtime = view[offsets[7]:offsets[7] + 8 * n].cast("q")
+        roots = bytes(view[offsets[8]:offsets[9]]).split(b"\0")[:root_count]
+        self.roots = [os.fsdecode(root) for root in roots]
+
+    def _lower(self, i: int) -> bytes:
+        start = self._lower_start + self._lower_off[i]
+        return self._mm[start:self._lower_start + self._lower_off[i + 1] - 1]
+
+    def name(self, i: int) -> str:
+        start = self._name_start + self._name_off[i]
+        return os.fsdecode(self._mm[start:self._name_start + self._name_off[i + 1] - 1])
+
+    def path(self, i: int) -> str:
+        parts = []
+        while i < self.count:
+            parts.append(self.name(i))
+            i = self._parent[i]
+        parts.append(self.roots[i - self.count])
+        return os.path.join(*reversed(parts))
+
+    def is_dir(self, i: int) -> bool:
+        return self._kind[i] == 1
+
+    def stat(self, i: int) -> _IndexStat:
+        return _IndexStat(self._size[i], float(self._mtime[i]))
+
+    def _entry_at(self, pos: int) -> int:
+        """Returns the entry whose lowered name contains blob offset pos."""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._lower_off[mid + 1] <= pos:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def candidates(self, q: str):
+        """Yields (score, entry) for names matching q, best match kinds first.
+
+        Exact and prefix matches come from a binary search of the sorted
+        names, substrings from ``mmap.find`` and fuzzy matches from a regex
+        run over the mapped names; an entry is yielded once.
+        """
+        needle = q.lower().encode("utf-8", "surrogateescape")
+        if not needle:
+            return
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._lower(mid) < needle:
+                lo = mid + 1
+            else:
+                hi = mid
+        seen = set()
+        i = lo
+        while i < self.count:
+            lower = self._lower(i)
+            if not lower.startswith(needle):
+                break
+            seen.add(i)
+            yield (0 if lower == needle else 1), i
+            i += 1
+
+        start, end = self._lower_start, self._lower_start + self._lower_off[self.count]
+        pos = start
+        while True:
+            pos = self._mm.find(needle, pos, end)
+            if pos == -1:
+                break
+            i = self._entry_at(pos - start)
+            if i not in seen:
+                seen.add(i)
+                yield 2, i
+            pos = start + self._lower_off[i + 1]
+
+        pattern = re.compile(b"[^\0]*?".join(
+            re.escape(c.encode("utf-8", "surrogateescape")) for c in q.lower()
+        ))
+        pos = start
+        while True:
+            match = pattern.search(self._mm, pos, end)
+            if match is None:
+                break
+            i = self._entry_at(match.start() - start)
+            if i not in seen:
+                seen.add(i)
+                yield 3, i
+            pos = start + self._lower_off[i + 1]
+
+    def fresh_for(self, path: Path) -> bool:
+        """True if the index can still answer for path.
+
+        It goes stale when it is older than ``index_max_age`` seconds, or when
+        path itself, usually a root or the scope, changed after the build
+        started. Changes further down only show up through the age.
+        """
+        max_age = SETTINGS.get("index_max_age", 3600)
+        if max_age and time.time() - self.built_at > max_age:
+            return False
+        try:
+            return os.stat(path).st_mtime <= self.built_at
+        except OSError:
+            return False
+
+    def covers(self, path: Path) -> bool:
+        """True if path is one of the indexed roots or inside one."""
+        path_str = os.path.abspath(path)
+        return any(
+            path_str == root or path_str.startswith(root.rstrip(os.sep) + os.sep)
+            for root in self.roots
+        )
+
+    def search(
+        self,
+        query: str,
+        scopes: List[Path],
+        filters: Optional[QueryFilters] = None,
+        max_results: int = 50,
+    ) -> List[Dict]:
+        """Fuzzy search like search_files, answered from the index.
+
+        Kind, extension, size and age filters are checked on the index columns
+        before a path is built. Entries that no longer exist are skipped.
+        """
+        segments = split_path_query(query)
+        last = segments[-1] if segments else ""
+        prefixes = [os.path.abspath(scope).rstrip(os.sep) + os.sep for scope in scopes]
+        scored: List[Tuple[int, str, bool]] = []
+        for score, i in self.candidates(last):
+            is_dir = self.is_dir(i)
+            if filters is not None and not filters.matches(self.name(i), is_dir, self.stat(i)):
+                continue
+            path_str = self.path(i)
+            if not path_str.startswith(tuple(prefixes)):
+                continue
+            if len(segments) > 1:
+                score = path_match_score(segments, path_str)
+                if score == 99:
+                    continue
+            if not os.path.lexists(path_str):
+                continue
+            scored.append((score, path_str, is_dir))
+            if len(scored) >= max_results:
+                break
+        scored.sort(key=lambda x: x[0])
+        return [create_item(Path(p), not is_dir) for _, p, is_dir in scored]
+
+
+def open_index() -> Optional[NameIndex]:
+    """Returns the name index if enabled and built, else None."""
+    if not SETTINGS.get("use_index", True):
+        return None
+    try:
+        return NameIndex(_get_workflow_data_dir() / NAME_INDEX)
+    except (OSError, ValueError) as e:
+        if not isinstance(e, FileNotFoundError):
+            logger.warning("Unusable name index: %s", e)
+        return None
+
+
+def rebuild_index_async(roots: List[str]) -> None:
+    """Starts a detached `search.py --build-index` for roots.
+
+    A marker file in the workflow data dir keeps the overlapping invocations
+    of a typing burst from each starting one; another rebuild may start
+    INDEX_REBUILD_GRACE seconds later.
+    """
+    import subprocess
+
+    marker = _get_workflow_data_dir() / f"{NAME_INDEX}.rebuild"
+    with _FileLock(marker):
+        try:
+            if time.time() - os.stat(marker).st_mtime < INDEX_REBUILD_GRACE:
+                return
+        except OSError:
+            pass
+        try:
+            marker.touch()
+            subprocess.Popen(
+                [sys.executable, str(Path(__file__).resolve().with_name("search.py")),
+                 "--build-index", *roots],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        except OSError as e:
+            logger.warning("Cannot start index rebuild: %s", e)
+
+
+# --- Search paths ---
+
+
+def get_search_paths(scope_str: Optional[str] = None) -> List[Path]:
+    """Returns list of directories for search.
+
+    scope_str defaults to the ``scope`` environment variable set by Alfred.
+    """
+    paths = []
+    if scope_str is None:
+        scope_str = os.getenv("scope")
+    if scope_str:
+        paths.append(Path(scope_str))
+
+    for path_str in SETTINGS.get("search_paths", []):
+        path = Path(os.path.expanduser(path_str))
+        if path.exists() and path.is_dir():
+            paths.append(path)
+
+    return _order_roots(paths) if paths else [Path.home()]
+
+
+def regular_search(query: str, scope_str: Optional[str] = None) -> List[Dict]:
+    """Fuzzy search over the search paths, hot list first, frecency-ranked.
+
+    Inline filters (``ext:pdf type:f >10m age:<7d``) are split off the query
+    and pushed down into every backend.
+    """
+    query, filters = parse_query_filters(query)
+    search_paths = get_search_paths(scope_str)
+    hot = load_hot_list()
+    hot_items, short_circuit = search_hot_list(query, search_paths, hot, filters)
+    if short_circuit:
+        logger.debug("'%s' answered from the hot list", query)
+        return hot_items
+
+    items: List[Dict] = list(hot_items)
+    seen = {item["arg"] for item in hot_items}
+    per_root = []
+    index = open_index() if query else None
+    if index is not None:
+        # Paths inside the indexed roots are answered from the index, unless
+        # it is stale for them: those are walked while it is rebuilt
+        covered = [path for path in search_paths if index.covers(path)]
+        indexed = [path for path in covered if index.fresh_for(path)]
+        if len(indexed) < len(covered):
+            rebuild_index_async(index.roots)
+        if indexed:
+            per_root.append(index.search(query, indexed, filters, MAX_RESULTS))
+            search_paths = [path for path in search_paths if path not in indexed]
+    if len(search_paths) > 1:
+        # Roots are searched concurrently within the latency budget
+        per_root += run_async(_search_roots_async(query, search_paths, filters))
+    else:
+        visited: set = set()
+        for path in search_paths:
+            try:
+                per_root.append(search_files(
+                    query, path, max_results=MAX_RESULTS, visited=visited, filters=filters,
+                ))
+            except (PermissionError, OSError):
+                continue
+    for path_items in per_root:
+        for item in path_items:
+            if item["arg"] not in seen:
+                seen.add(item["arg"])
+                items.append(item)
+    save_depth_costs()
+    return rank_by_frecency(query, items[:MAX_RESULTS], hot)
+
+
+# --- Frecency ---
+
+
+def _frecency(count: int, last_used: float, now: float) -> float:
+    """Scores usage by frequency weighted with recency buckets."""
+    age_days = (now - last_used) / 86400
+    if age_days < 4:
+        weight = 100
+    elif age_days < 14:
+        weight = 70
+    elif age_days < 31:
+        weight = 50
+    elif age_days < 90:
+        weight = 30
+    else:
+        weight = 10
+    return count * weight
+
+
+def _open_usage_db():
+    """Opens (and creates) the usage database in the workflow data dir."""
+    import sqlite3
+
+    conn = sqlite3.connect(str(_get_workflow_data_dir() / USAGE_DB), timeout=2)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS usage ("
+        "path TEXT PRIMARY KEY, count INTEGER NOT NULL, last_used REAL NOT NULL)"
+    )
+    return conn
+
+
+def record_usage(path: str) -> None:
+    """Records that path was opened and refreshes the hot list."""
+    import sqlite3
+
+    now = time.time()
+    try:
+        conn = _open_usage_db()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO usage (path, count, last_used) VALUES (?, 1, ?) "
+                    "ON CONFLICT(path) DO UPDATE SET count = count + 1, last_used = ?",
+                    (path, now, now),
+                )
+            rows = conn.execute("SELECT path, count, last_used FROM usage").fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning("Failed to record usage of %s: %s", path, e)
+        return
+
+    scored = sorted(
+        ((p, _frecency(count, last, now)) for p, count, last in rows),
+        key=lambda x: x[1],
+        reverse=True,
+    )
+    hot = dict(scored[:SETTINGS.get("hot_list_size", 200)])
+    CacheStore(HOT_LIST).save(hot)
+
+
+def load_hot_list() -> Dict[str, float]:
+    """Returns {path: frecency} of the most used paths, empty if none."""
+    return CacheStore(HOT_LIST).load()
+
+
+def search_hot_list(
+    query: str,
+    roots: List[Path],
+    hot: Dict[str, float],
+    filters: Optional[QueryFilters] = None,
+) -> Tuple[List[Dict], bool]:
+    """Matches query against the hot list before any walk.
+
+    Returns (items, short_circuit). Only paths under one of roots that still
+    exist are returned. short_circuit is True when a hot path matches exactly
+    or by prefix and ``hot_list_short_circuit`` is on, in which case the walk
+    is skipped entirely.
+    """
+    if not hot or (not query and filters is None):
+        return [], False
+    prefixes = tuple(str(root).rstrip(os.sep) + os.sep for root in roots)
+    scored = []
+    for path_str, frecency in hot.items():
+        if not path_str.startswith(prefixes):
+            continue
+        score = query_score(query, path_str)
+        if score < 99:
+            scored.append((score - _frecency_bonus(frecency), score, path_str))
+    scored.sort()
+
+    items = []
+    best = 99
+    for _, score, path_str in scored[:MAX_RESULTS]:
+        try:
+            st = os.stat(path_str)
+        except OSError:
+            continue
+        is_dir = S_ISDIR(st.st_mode)
+        if filters is not None and not filters.matches(path_str, is_dir, st):
+            continue
+        items.append(create_item(Path(path_str), not is_dir))
+        best = min(best, score)
+    short_circuit = bool(query) and best <= 1 and SETTINGS.get("hot_list_short_circuit", True)
+    return items, short_circuit
+
+
+def _frecency_bonus(frecency: float) -> float:
+    """Maps frecency to a bonus in [0, 2) subtracted from match_score."""
+    return 2 * frecency / (frecency + 100) if frecency > 0 else 0.0
+
+
+def rank_by_frecency(query: str, items: List[Dict], hot: Dict[str, float]) -> List[Dict]:
+    """Re-sorts items by match_score blended with usage frecency."""
+    if not hot:
+        return items
+    return sorted(
+        items,
+        key=lambda item: query_score(query, item["arg"]) - _frecency_bonus(hot.get(item["arg"], 0)),
+    )
+
+
+# --- Async execution core ---
+
+# asyncio is imported lazily (it is the single most expensive import), and
+# only by code paths that actually have concurrent work to do.
+
+
+def run_async(coro):
+    """Runs a coroutine to completion on a fresh event loop."""
+    import asyncio
+
+    return asyncio.run(coro)
+
+
+async def gather_limited(factories, limit: int, timeout: Optional[float] = None):
+    """Runs coroutine factories with at most ``limit`` running at once.
+
+    Returns a list aligned with factories holding each result, or None for
+    tasks that failed, were cancelled or missed the timeout.
+    """
+    import asyncio
+
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def guarded(factory):
+        async with semaphore:
+            return await factory()
+
+    tasks = [asyncio.ensure_future(guarded(factory)) for factory in factories]
+    if not tasks:
+        return []
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.wait(pending)
+    return [
+        task.result() if task.done() and not task.cancelled() and task.exception() is None else None
+        for task in tasks
+    ]
+
+
+async def _fd_lines_async(cmd: List[str], deadline: Optional[float]) -> Optional[List[str]]:
+    """Streams fd output until EOF or the deadline (loop time).
+
+    fd is killed when the deadline passes or the task is cancelled; the lines
+    read so far are returned. Returns None if fd could not run or failed.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+    except OSError as e:
+        logger.warning("fd error: %s", e)
+        return None
+    assert proc.stdout is not None
+    lines: List[str] = []
+    finished = False
+    try:
+        while not superseded():
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                break
+            if _claim:
+                # Wake up regularly to notice a newer search
+                remaining = CANCEL_POLL if remaining is None else min(remaining, CANCEL_POLL)
+            try:
+                line = await asyncio.wait_for(proc.stdout.readline(), remaining)
+            except asyncio.TimeoutError:
+                continue
+            if not line:
+                finished = True
+                break
+            lines.append(line.decode("utf-8", "surrogateescape").rstrip("\n"))
+    finally:
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+        await proc.wait()
+    if finished and proc.returncode not in (0, 1):
+        logger.warning("fd returned code %d", proc.returncode)
+        return None
+    return lines
+
+
+async def _search_root_async(
+    query: str,
+    root: Path,
+    filters: Optional[QueryFilters],
+    visited: set,
+    stop,
+    deadline: Optional[float],
+) -> List[Dict]:
+    """search_files for one root: async fd, else the walker in a thread."""
+    import asyncio
+
+    if not query and filters is None:
+        return []
+    depth = SEARCH_DEPTH
+    segments = split_path_query(query)
+    if len(segments) == 1 and _has_fd():
+        budget = _depth_budget()
+        if budget:
+            depth = adaptive_fd_depth(root, depth)
+        start = time.monotonic()
+        lines = await _fd_lines_async(
+            _fd_search_cmd(query, root, depth, MAX_RESULTS, filters), deadline
+        )
+        if lines is not None:
+            if budget:
+                record_fd_cost(root, depth, time.monotonic() - start)
+            return _fd_items(query, lines)
+    if len(segments) > 1:
+        return await asyncio.to_thread(
+            _search_path_segments, segments, root, min(depth, 5), MAX_RESULTS, visited,
+            filters, stop.is_set,
+        )
+    return await asyncio.to_thread(
+        _walk_search, query, root, min(depth, 5), MAX_RESULTS, visited, filters, stop.is_set
+    )
+
+
+async def _search_roots_async(
+    query: str, roots: List[Path], filters: Optional[QueryFilters]
+) -> List[List[Dict]]:
+    """Searches all roots concurrently and returns per-root results.
+
+    Honours ``latency_budget_ms`` (0 disables it): fd is killed and the walker
+    threads are told to stop when it runs out, and whatever each root found
+    by then is returned. Each root's walk skips the other roots, so nested
+    roots are searched once, by their own walk.
+    """
+    import asyncio
+    import threading
+
+    loop = asyncio.get_running_loop()
+    budget = SETTINGS.get("latency_budget_ms", 150) / 1000
+    deadline = loop.time() + budget if budget > 0 else None
+    stop = threading.Event()
+
+    root_keys: List[Optional[Tuple[int, int]]] = []
+    for root in roots:
+        try:
+            st = os.stat(root)
+            root_keys.append((st.st_dev, st.st_ino))
+        except OSError:
+            root_keys.append(None)
+
+    def factory(i: int):
+        visited = {key for j, key in enumerate(root_keys) if j != i and key is not None}
+        return lambda: _search_root_async(query, roots[i], filters, visited, stop, deadline)
+
+    factories = [factory(i) for i in range(len(roots))]
+    limit = SETTINGS.get("max_concurrency", 4)
+    if deadline is None:
+        results = await gather_limited(factories, limit)
+    else:
+        # Walker threads can't be cancelled: signal them at the deadline and
+        # give them a moment to hand back their partial results.
+        loop.call_at(deadline, stop.set)
+        results = await gather_limited(factories, limit, budget + ASYNC_GRACE)
+    return [r or [] for r in results]
+
+
+# --- Batch mode ---
+
+
+def _is_command(query: str) -> bool:
+    """Returns True if query is a command rather than a regular search."""
+    return query in ("ls", "cd..", "tree") or query.split(" ", 1)[0] in (
+        "find", "grep", "recent", "size", "du", "dupes", "archive", "changes"
+    )
+
+
+def _shared_walk_search(
+    queries: List[Tuple[str, Optional[QueryFilters]]], roots: List[Path]
+) -> List[List[Dict]]:
+    """Answers several plain queries with a single walk over roots.
+
+    Every entry is lowercased once and scored against each query that still
+    needs results; items are only built for the final top results.
+    """
+    depth = min(SEARCH_DEPTH, 5)
+    lowered = [(query.lower(), filters) for query, filters in queries]
+    found: List[List[Tuple[int, str, bool]]] = [[] for _ in queries]
+    active = [i for i, (query, filters) in enumerate(queries) if query or filters is not None]
+    visited: set = set()
+    for root in roots:
+        if not active:
+            break
+        for dirpath, dirs, files in walk_tree(root, depth, visited):
+            for is_dir, names in ((True, dirs), (False, files)):
+                for name in names:
+                    lower = name.lower()
+                    path_str = None
+                    for i in active:
+                        q, filters = lowered[i]
+                        score = _score_lowered(q, lower)
+                        if score == 99:
+                            continue
+                        if path_str is None:
+                            path_str = os.path.join(dirpath, name)
+                        if filters is not None and not filters.matches(path_str, is_dir):
+                            continue
+                        found[i].append((score, path_str, is_dir))
+            active = [i for i in active if len(found[i]) < MAX_RESULTS]
+            if not active:
+                break
+
+    results = []
+    for matches in found:
+        matches.sort(key=lambda x: x[0])
+        results.append([create_item(Path(p), not is_dir) for _, p, is_dir in matches[:MAX_RESULTS]])
+    return results
+
+
+def _parse_batch_line(line: str, index: int) -> Optional[Dict]:
+    """Parses one batch input line: a JSON object, a JSON string or plain text."""
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        request = json.loads(line)
+    except ValueError:
+        request = line
+    if isinstance(request, str):
+        request = {"query": request}
+    if not isinstance(request, dict):
+        return None
+    request.setdefault("id", index)
+    request["query"] = str(request.get("query", ""))
+    return request
+
+
+def run_batch(lines, out) -> None:
+    """Runs one query per input line and writes one JSON result per line.
+
+    Settings, the hot list and fd detection are loaded once. Commands and path
+    queries are answered (and streamed) immediately; plain queries sharing a
+    scope are collected and answered by one shared walk at the end. Each
+    output line echoes the request ``id`` (default: line number).
+    """
+    default_scope = os.getenv("scope")
+    hot = load_hot_list()
+    pending: Dict[Optional[str], List[Tuple[Dict, str, Optional[QueryFilters]]]] = {}
+
+    def emit(request: Dict, items: List[Dict]) -> None:
+        write_json({"id": request["id"], "query": request["query"], "items": items}, out)
+        out.write("\n")
+        out.flush()
+
+    for index, line in enumerate(lines):
+        request = _parse_batch_line(line, index)
+        if request is None:
+            continue
+        query = request["query"]
+        scope_str = request.get("scope", default_scope)
+        try:
+            if _is_command(query):
+                scope = Path(scope_str or os.path.expanduser("~"))
+                emit(request, run_query(query, scope)[:MAX_RESULTS])
+                continue
+            plain, filters = parse_query_filters(query)
+            if len(split_path_query(plain)) > 1:
+                emit(request, regular_search(query, scope_str)[:MAX_RESULTS])
+                continue
+            hot_items, short_circuit = search_hot_list(
+                plain, get_search_paths(scope_str), hot, filters
+            )
+            if short_circuit:
+                emit(request, hot_items)
+                continue
+            pending.setdefault(scope_str, []).append((request, plain, filters))
+        except (OSError, ValueError) as e:
+            logger.warning("Batch query '%s' failed: %s", query, e)
+            emit(request, [])
+
+    for scope_str, group in pending.items():
+        results = _shared_walk_search(
+            [(plain, filters) for _, plain, filters in group], get_search_paths(scope_str)
+        )
+        for (request, plain, _), items in zip(group, results):
+            emit(request, rank_by_frecency(plain, items, hot))
+
+
+# --- Progressive results ---
+
+
+def _progressive_cache_file(query: str, scope: Path) -> Path:
+    """Returns the cache file shared by a progressive query and its worker."""
+    cache_dir = _get_workflow_data_dir() / PROGRESSIVE_DIR
+    cache_dir.mkdir(exist_ok=True)
+    return cache_dir / f"{_query_key(query, scope)}.json"
+
+
+def _read_progress(cache_file: Path) -> Optional[Dict]:
+    """Reads the state written by a progressive worker, None if unavailable."""
+    try:
+        with open(cache_file, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return state if isinstance(state, dict) else None
+
+
+class _ProgressWriter:
+    """Publishes partial results of a background worker to its cache file.
+
+    Handlers call ``due()`` between directories and ``publish()`` when it
+    returns True, so the cache is rewritten at most every ``interval`` seconds.
+    """
+
+    def __init__(self, cache_file: Path, interval: float = 0.25) -> None:
+        self.cache_file = cache_file
+        self.interval = interval
+        self._next = time.monotonic() + interval
+
+    def due(self) -> bool:
+        return time.monotonic() >= self._next
+
+    def publish(self, items: List[Dict], done: bool = False) -> None:
+        state = {"done": done, "updated": time.time(), "items": items[:MAX_RESULTS]}
+        tmp = self.cache_file.with_name(f"{self.cache_file.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp, self.cache_file)
+        except OSError as e:
+            logger.warning("Failed to write progressive cache: %s", e)
+        self._next = time.monotonic() + self.interval
+
+
+def _is_progressive(query: str) -> bool:
+    """Returns True for the commands that run in a background worker."""
+    return (
+        query.startswith("find ")
+        or query.startswith("grep ")
+        or query == "size"
+        or query.startswith("size ")
+        or query == "dupes"
+        or query.startswith("dupes ")
+        or query.startswith("archive ")
+    )
+
+
+def _spawn_progressive_worker(query: str, scope: Path) -> None:
+    """Starts a detached `search.py --worker` process for query.
+
+    The worker gets this invocation's claim, so it stops once a newer query
+    supersedes it (see follow_search).
+    """
+    import subprocess
+
+    env = dict(os.environ, scope=str(scope))
+    token = claim_token()
+    if token is not None:
+        env["search_seq"] = token
+    subprocess.Popen(
+        [sys.executable, str(Path(__file__).resolve().with_name("search.py")), "--worker", query],
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def _expire_progressive(cache_dir: Path, max_age: float) -> None:
+    """Deletes worker cache files not written to for max_age seconds."""
+    cutoff = time.time() - max_age
+    try:
+        with os.scandir(cache_dir) as it:
+            old = [entry.path for entry in it if entry.stat().st_mtime < cutoff]
+    except OSError:
+        return
+    for path in old:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def _needs_worker(state: Optional[Dict], now: float, ttl: float) -> bool:
+    """Returns True if the progressive state is missing, expired or stalled."""
+    if state is None:
+        return True
+    if state.get("done"):
+        return now - state.get("updated", 0) >= ttl
+    return now - state.get("updated", 0) > PROGRESSIVE_STALL
+
+
+def _run_progressive(query: str, scope: Path) -> Tuple[List[Dict], Optional[float]]:
+    """Answers an expensive command from the worker cache.
+
+    Returns (items, rerun). The first call starts a background worker and
+    returns whatever it produced within ``progressive_first_wait_ms``; Alfred
+    then reruns the script every ``rerun`` seconds and each rerun reads the
+    growing cache, until the worker marks it done.
+    """
+    cache_file = _progressive_cache_file(query, scope)
+    state = _read_progress(cache_file)
+    now = time.time()
+    ttl = SETTINGS.get("progressive_cache_ttl", 60)
+
+    if state is not None and state.get("done") and now - state.get("updated", 0) < ttl:
+        return state.get("items", []), None
+
+    claimed = False
+    if _needs_worker(state, now, ttl):
+        # Claim the cache under a lock before spawning, so overlapping
+        # invocations of the same query don't each start a worker. One lock
+        # for the folder, rather than a lock file next to every query's cache.
+        with _FileLock(cache_file.parent):
+            state = _read_progress(cache_file)
+            claimed = _needs_worker(state, now, ttl)
+            if claimed:
+                _ProgressWriter(cache_file).publish([])
+    if claimed:
+        # Every typed prefix leaves a file behind; drop those that are expired
+        # and no longer written to by a worker
+        _expire_progressive(cache_file.parent, max(ttl, PROGRESSIVE_STALL))
+        try:
+            _spawn_progressive_worker(query, scope)
+        except OSError as e:
+            logger.warning("Failed to start worker, running inline: %s", e)
+            return run_query(query, scope), None
+        deadline = time.monotonic() + SETTINGS.get("progressive_first_wait_ms", 150) / 1000
+        while time.monotonic() < deadline:
+            time.sleep(0.02)
+            state = _read_progress(cache_file)
+            if state is not None and (state.get("done") or state.get("items")):
+                break
+
+    state = state or {}
+    items = state.get("items", [])
+    if state.get("done"):
+        return items, None
+    status = {
+        "title": "Searching…",
+        "subtitle": f"{len(items)} results so far",
+        "valid": False,
+    }
+    return [status] + items, PROGRESSIVE_RERUN
+
+
+def _progressive_worker(query: str, scope: Path) -> None:
+    """Background worker: runs query and streams results to the cache.
+
+    A worker superseded by a newer query stops early and removes its cache,
+    so its partial results are never served as complete.
+    """
+    follow_search(os.getenv("search_seq"), _query_key(query, scope))
+    progress = _ProgressWriter(_progressive_cache_file(query, scope))
+    try:
+        items = run_query(query, scope, progress)
+    except Exception as e:  # the worker must always finish the cache
+        logger.error("Worker failed for '%s': %s", query, e)
+        items = []
+    if superseded():
+        try:
+            progress.cache_file.unlink()
+        except OSError:
+            pass
+        return
+    progress.publish(items, done=True)
+
+
+# --- Output ---
+
+_orjson: List = []  # [orjson.dumps or None] once looked up
+
+
+def _json_bytes(value) -> bytes:
+    """Serialises value to compact UTF-8 JSON, with orjson if it is installed."""
+    if not _orjson:
+        try:
+            import orjson
+
+            _orjson.append(orjson.dumps)
+        except ImportError:
+            _orjson.append(None)
+    if _orjson[0] is not None:
+        try:
+            return _orjson[0](value)
+        except TypeError:
+            pass  # e.g. a lone surrogate from an undecodable file name
+    # backslashreplace turns lone surrogates into the same \udcxx escapes
+    # ensure_ascii would have written
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode(
+        "utf-8", "backslashreplace"
+    )
+
+
+def write_json(value, out=None) -> None:
+    """Writes value as JSON to out (default stdout), as bytes when possible."""
+    out = out or sys.stdout
+    data = _json_bytes(value)
+    buffer = getattr(out, "buffer", None)
+    if buffer is None:
+        out.write(data.decode("utf-8"))
+        return
+    out.flush()
+    buffer.write(data)
+    buffer.flush()
+
+
+def build_response(items: List[Dict], scope: Optional[Path] = None, rerun: Optional[float] = None) -> Dict:
+    """Wraps items in an Alfred Script Filter response.
+
+    The scope goes into top-level ``variables``, which Alfred passes back on
+    ``rerun`` and to every item's action. Without rerun, ``alfred_cache_seconds``
+    asks Alfred to cache the response for identical queries.
+    """
+    response: Dict = {"items": items[:MAX_RESULTS]}
+    if scope is not None:
+        response["variables"] = {"scope": str(scope)}
+    if rerun is not None:
+        response["rerun"] = rerun
+    else:
+        seconds = SETTINGS.get("alfred_cache_seconds", 0)
+        if seconds > 0:
+            # Alfred accepts 5 seconds to 24 hours
+            response["cache"] = {"seconds": min(max(int(seconds), 5), 86400), "loosereload": True}
+    return response
+
+
+# --- Main ---
+
+
+def run_query(
+    query: str, scope: Path, progress: Optional[_ProgressWriter] = None
+) -> List[Dict]:
+    """Dispatches a query to its command handler or the regular search."""
+    items: List[Dict] = []
+    if query == "ls":
+        items = list_directory(scope)
+    elif query == "cd..":
+        items = handle_cd_up(scope)
+    elif query == "tree":
+        items = handle_tree(scope)
+    elif query.startswith("find "):
+        items = handle_find(query[5:].strip(), scope, progress)
+    elif query.startswith("grep "):
+        items = handle_grep(query[5:].strip(), scope, progress)
+    elif query == "recent" or query.startswith("recent "):
+        items = handle_recent(query[6:].strip() if " " in query else "", scope)
+    elif query == "size" or query.startswith("size "):
+        items = handle_size(query[4:].strip() if " " in query else "", scope, progress)
+    elif query == "du" or query.startswith("du "):
+        items = handle_du(query[2:].strip(), scope)
+    elif query == "dupes" or query.startswith("dupes "):
+        items = handle_dupes(query[5:].strip(), scope)
+    elif query == "archive" or query.startswith("archive "):
+        items = handle_archive(query[7:].strip(), scope)
+    elif query == "changes" or query.startswith("changes "):
+        items = handle_changes(query[7:].strip(), scope)
+    else:
+        items = regular_search(query)
+    return items
+
+
+def main():
+    try:
+        query = sys.argv[1] if len(sys.argv) > 1 else ""
+        scope = Path(os.getenv("scope", os.path.expanduser("~")))
+
+        if query == "--worker":
+            _progressive_worker(sys.argv[2] if len(sys.argv) > 2 else "", scope)
+            return
+        if query == "--record":
+            if len(sys.argv) > 2:
+                record_usage(sys.argv[2])
+            return
+        if query == "--batch":
+            run_batch(sys.stdin, sys.stdout)
+            return
+        if query == "--build-index":
+            roots = [Path(p) for p in sys.argv[2:]] or get_search_paths("")
+            print(f"Indexed {build_index(roots)} entries")
+            return
+
+        logger.debug("Query: '%s', Scope: %s", query, scope)
+        if SETTINGS.get("cancel_superseded", True):
+            claim_search(_query_key(query, scope))
+
+        rerun = None
+        if SETTINGS.get("progressive_results", False) and _is_progressive(query):
+            items, rerun = _run_progressive(query, scope)
+        else:
+            items = run_query(query, scope)
+
+        if not items:
+            items = [
+                {
+                    "title": "No matches found",
+                    "subtitle": f"No items matching '{query}' in search paths",
+                    "arg": str(scope),
+                    "valid": False,
+                }
+            ]
+
+        if superseded():
+            return  # Alfred has already moved on to a newer query
+        write_json(build_response(items, scope, rerun))
+
+    except KeyboardInterrupt:
+        write_json({
+            "items": [
+                {
+                    "title": "Search interrupted",
+                    "subtitle": "The search was interrupted by user",
+                    "valid": False,
+                }
+            ]
+        })
+    finally:
+        write_cache_stats()
+
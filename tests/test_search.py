@@ -7,7 +7,7 @@ import sys
 import pytest
 from pathlib import Path
 from unittest.mock import patch
-from search import (
+from search_core import (
     should_exclude,
     create_item,
     list_directory,
@@ -18,11 +18,46 @@ from search import (
     handle_tree,
     handle_recent,
     handle_size,
+    handle_du,
+    handle_dupes,
+    handle_archive,
+    handle_changes,
+    walk_tree,
+    _order_roots,
+    ExcludeMatcher,
+    IgnoreRules,
+    record_usage,
+    load_hot_list,
+    regular_search,
+    rank_by_frecency,
+    path_match_score,
+    parse_query_filters,
+    QueryFilters,
+    run_batch,
+    run_async,
+    gather_limited,
+    _fd_lines_async,
+    _search_roots_async,
+    parallel_walk,
+    walk_stats,
+    load_dir_snapshots,
+    build_index,
+    NameIndex,
+    budget_walk,
+    adaptive_fd_depth,
+    _partition_walk,
+    _unit_find,
     fuzzy_match,
     match_score,
     load_settings,
+    _LazyLogger,
+    SETTINGS_SNAPSHOT,
     _format_size,
     _parse_size,
+    _run_progressive,
+    _progressive_worker,
+    _progressive_cache_file,
+    _ProgressWriter,
 )
 
 
@@ -180,7 +215,7 @@ def test_list_directory_permission_error(tmp_path):
 # --- search_files ---
 
 
-@patch("search._has_fd", return_value=False)
+@patch("search_core._has_fd", return_value=False)
 def test_search_files_basic(mock_fd, temp_directory):
     results = search_files("test", temp_directory)
     names = [r["title"] for r in results]
@@ -188,19 +223,19 @@ def test_search_files_basic(mock_fd, temp_directory):
     assert "test2.py" in names
 
 
-@patch("search._has_fd", return_value=False)
+@patch("search_core._has_fd", return_value=False)
 def test_search_files_case_insensitive(mock_fd, temp_directory):
     results = search_files("TEST", temp_directory)
     assert len(results) >= 2
 
 
-@patch("search._has_fd", return_value=False)
+@patch("search_core._has_fd", return_value=False)
 def test_search_files_with_depth(mock_fd, temp_directory):
     results = search_files("subfile", temp_directory, depth=1)
     assert len(results) == 1
 
 
-@patch("search._has_fd", return_value=False)
+@patch("search_core._has_fd", return_value=False)
 def test_search_files_deep_recursion(mock_fd, temp_directory):
     """Tests that recursion works beyond 1 level (bug fix)."""
     results = search_files("deepfile", temp_directory, depth=3)
@@ -208,13 +243,13 @@ def test_search_files_deep_recursion(mock_fd, temp_directory):
     assert "deepfile.txt" in names
 
 
-@patch("search._has_fd", return_value=False)
+@patch("search_core._has_fd", return_value=False)
 def test_search_files_empty_query(mock_fd, temp_directory):
     results = search_files("", temp_directory)
     assert len(results) == 0
 
 
-@patch("search._has_fd", return_value=False)
+@patch("search_core._has_fd", return_value=False)
 def test_search_files_fuzzy(mock_fd, temp_directory):
     """Fuzzy match should find 'tst' -> 'test'."""
     results = search_files("tst", temp_directory, depth=1)
@@ -222,7 +257,7 @@ def test_search_files_fuzzy(mock_fd, temp_directory):
     assert "test1.txt" in names
 
 
-@patch("search._has_fd", return_value=False)
+@patch("search_core._has_fd", return_value=False)
 def test_search_files_relevance_order(mock_fd, tmp_path):
     """Exact matches should come before prefix, substring, fuzzy."""
     (tmp_path / "abc").touch()
@@ -255,7 +290,7 @@ def test_handle_cd_up_root():
 # --- handle_find ---
 
 
-@patch("search._has_fd", return_value=False)
+@patch("search_core._has_fd", return_value=False)
 def test_handle_find_basic(mock_fd, temp_directory):
     results = handle_find("deepfile", temp_directory)
     names = [r["title"] for r in results]
@@ -332,13 +367,36 @@ def test_load_settings_defaults():
     assert settings["search_depth"] == 3
 
 
+def test_load_settings_snapshot_invalidated_by_mtime(tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path))
+    settings_file = tmp_path / "settings.json"
+    settings_file.write_text(json.dumps({"max_results": 7}))
+    assert load_settings()["max_results"] == 7
+    assert (tmp_path / SETTINGS_SNAPSHOT).exists()
+    # Warm start is served from the snapshot
+    assert load_settings()["max_results"] == 7
+
+    settings_file.write_text(json.dumps({"max_results": 9}))
+    os.utime(settings_file, ns=(0, settings_file.stat().st_mtime_ns + 10 ** 9))
+    assert load_settings()["max_results"] == 9
+
+
+def test_lazy_logger_opens_log_only_on_write(tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path))
+    lazy = _LazyLogger()
+    lazy.level = 30
+    lazy.debug("dropped below level")
+    assert lazy._logger is None
+    assert not (tmp_path / "search.log").exists()
+
+
 # --- Alfred JSON output integration ---
 
 
 def test_alfred_json_output(temp_directory, capsys):
     os.environ["scope"] = str(temp_directory)
     sys.argv = ["search.py", "test"]
-    from search import main
+    from search_core import main
 
     main()
     captured = capsys.readouterr()
@@ -353,7 +411,7 @@ def test_alfred_json_output(temp_directory, capsys):
 def test_alfred_ls_command(temp_directory, capsys):
     os.environ["scope"] = str(temp_directory)
     sys.argv = ["search.py", "ls"]
-    from search import main
+    from search_core import main
 
     main()
     captured = capsys.readouterr()
@@ -365,7 +423,7 @@ def test_alfred_ls_command(temp_directory, capsys):
 def test_alfred_tree_command(temp_directory, capsys):
     os.environ["scope"] = str(temp_directory)
     sys.argv = ["search.py", "tree"]
-    from search import main
+    from search_core import main
 
     main()
     captured = capsys.readouterr()
@@ -374,10 +432,37 @@ def test_alfred_tree_command(temp_directory, capsys):
     assert len(output["items"]) > 0
 
 
+def test_alfred_response_variables_and_cache(temp_directory, capsys):
+    os.environ["scope"] = str(temp_directory)
+    sys.argv = ["search.py", "ls"]
+    from search_core import main
+
+    with patch.dict("search_core.SETTINGS", {"alfred_cache_seconds": 2}):
+        main()
+    output = json.loads(capsys.readouterr().out)
+    assert output["variables"] == {"scope": str(temp_directory)}
+    assert output["cache"] == {"seconds": 5, "loosereload": True}
+
+    main()
+    assert "cache" not in json.loads(capsys.readouterr().out)
+
+
+def test_json_bytes_matches_json_module_without_orjson():
+    import search_core as search
+
+    value = {"items": [create_item(Path("/tmp/caf\u00e9 \udcff.txt"))]}
+    with patch.object(search, "_orjson", [None]):
+        fallback = search._json_bytes(value)
+    assert b'", "' not in fallback and b'": ' not in fallback  # compact separators
+    assert "café".encode() in fallback and b"\\udcff" in fallback
+    assert json.loads(fallback) == json.loads(json.dumps(value))
+    assert json.loads(search._json_bytes(value)) == json.loads(json.dumps(value))
+
+
 # --- should_exclude with custom patterns ---
 
 
-@patch("search.EXCLUDED_PATTERNS", [".*", "*.app", "node_modules"])
+@patch("search_core.EXCLUDED_PATTERNS", [".*", "*.app", "node_modules"])
 def test_should_exclude_custom_patterns():
     assert should_exclude(".hidden") is True
     assert should_exclude(".git") is True
@@ -387,17 +472,67 @@ def test_should_exclude_custom_patterns():
     assert should_exclude("myapp") is False
 
 
-@patch("search.EXCLUDED_PATTERNS", ["*.log", "*.tmp"])
+@patch("search_core.EXCLUDED_PATTERNS", ["*.log", "*.tmp"])
 def test_should_exclude_extension_patterns():
     assert should_exclude("debug.log") is True
     assert should_exclude("cache.tmp") is True
     assert should_exclude("readme.md") is False
 
 
+@patch("search_core.EXCLUDED_PATTERNS", ["*.tmp[0-9]", "build/", "**/dist/", "docs/*.bak"])
+def test_should_exclude_globs_and_path_patterns():
+    assert should_exclude("cache.tmp1") is True
+    assert should_exclude("cache.tmpx") is False
+    assert should_exclude("build", is_dir=True) is True
+    assert should_exclude("build", is_dir=False) is False
+    assert should_exclude("dist", is_dir=True) is True
+    assert should_exclude("old.bak", rel_path="docs/old.bak") is True
+    assert should_exclude("old.bak", rel_path="src/old.bak") is False
+
+
+def test_exclude_matcher_buckets_and_fd_args():
+    matcher = ExcludeMatcher([".*", "*.app", "node_modules", "a?c"])
+    assert matcher.exact == {"node_modules"}
+    assert matcher.suffixes == (".app",)
+    assert matcher.prefixes == (".",)
+    assert matcher.name_re.match("abc")
+    assert matcher.fd_args() == [
+        "--exclude", ".*", "--exclude", "*.app",
+        "--exclude", "node_modules", "--exclude", "a?c",
+    ]
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_walkers_prune_excluded_path_patterns(mock_fd, temp_directory):
+    with patch("search_core.EXCLUDED_PATTERNS", ["subdir/deep/"]):
+        results = handle_find("deepfile", temp_directory)
+    assert results == []
+
+
+
+def test_path_patterns_with_trailing_separator_in_top(tmp_path, monkeypatch):
+    import search_core as search
+
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    for folder in ("docs", "xdocs"):
+        (tmp_path / "t" / folder).mkdir(parents=True)
+        (tmp_path / "t" / folder / "a.bak").write_text("x")
+    top = str(tmp_path / "t") + os.sep
+    kept = {str(tmp_path / "t" / "xdocs"): ["a.bak"], str(tmp_path / "t" / "docs"): []}
+    with patch("search_core.EXCLUDED_PATTERNS", ["docs/*.bak", "data"]):
+        walked = {path: files for path, _, files in walk_tree(top) if path != top}
+        assert walked == kept
+        walked = {
+            path: [f[0] for f in files] for path, _, files in walk_stats(top, {}, {}) if path != top
+        }
+        assert walked == kept
+        docs = str(tmp_path / "t" / "docs")
+        assert search._tree_listing(docs, os.stat(docs), {}, {}, top) == []
+
 # --- handle_recent ---
 
 
-@patch("search._has_fd", return_value=False)
+@patch("search_core._has_fd", return_value=False)
 def test_handle_recent_basic(mock_fd, temp_directory):
     """Recent should find files modified within the last day."""
     results = handle_recent("", temp_directory)
@@ -406,14 +541,14 @@ def test_handle_recent_basic(mock_fd, temp_directory):
     assert "test2.py" in names
 
 
-@patch("search._has_fd", return_value=False)
+@patch("search_core._has_fd", return_value=False)
 def test_handle_recent_with_days(mock_fd, temp_directory):
     """Recent with days parameter should work."""
     results = handle_recent("7", temp_directory)
     assert len(results) > 0
 
 
-@patch("search._has_fd", return_value=False)
+@patch("search_core._has_fd", return_value=False)
 def test_handle_recent_invalid_arg(mock_fd, temp_directory):
     results = handle_recent("abc", temp_directory)
     assert len(results) == 1
@@ -423,7 +558,7 @@ def test_handle_recent_invalid_arg(mock_fd, temp_directory):
 # --- handle_size ---
 
 
-@patch("search._has_fd", return_value=False)
+@patch("search_core._has_fd", return_value=False)
 def test_handle_size_basic(mock_fd, temp_directory):
     """Size should return files sorted largest first."""
     results = handle_size("", temp_directory)
@@ -433,7 +568,7 @@ def test_handle_size_basic(mock_fd, temp_directory):
         assert r["type"] == "file"
 
 
-@patch("search._has_fd", return_value=False)
+@patch("search_core._has_fd", return_value=False)
 def test_handle_size_with_threshold(mock_fd, temp_directory):
     """Size with high threshold should return fewer results."""
     results = handle_size("1g", temp_directory)
@@ -473,3 +608,1220 @@ def test_create_item_dir_has_icon():
     item = create_item(path, is_file=False)
     assert "icon" in item
     assert item["icon"]["type"] == "fileicon"
+
+
+# --- progressive results ---
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_progressive_worker_then_cached(mock_fd, temp_directory, tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    _progressive_worker("size", temp_directory)
+    with patch("search_core._spawn_progressive_worker") as spawn:
+        items, rerun = _run_progressive("size", temp_directory)
+    spawn.assert_not_called()
+    assert rerun is None
+    assert items[0]["type"] == "file"
+
+
+def test_progressive_partial_results_request_rerun(temp_directory, tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    partial = [create_item(temp_directory / "test1.txt")]
+    _ProgressWriter(_progressive_cache_file("grep x", temp_directory)).publish(partial)
+    with patch("search_core._spawn_progressive_worker") as spawn:
+        items, rerun = _run_progressive("grep x", temp_directory)
+    spawn.assert_not_called()
+    assert rerun is not None
+    assert items[0]["valid"] is False  # "Searching…" status item
+    assert items[1]["title"] == "test1.txt"
+
+
+def test_progressive_first_call_spawns_worker(temp_directory, tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    with patch("search_core._spawn_progressive_worker") as spawn, \
+            patch.dict("search_core.SETTINGS", {"progressive_first_wait_ms": 0}):
+        items, rerun = _run_progressive("find test", temp_directory)
+    spawn.assert_called_once_with("find test", temp_directory)
+    assert rerun is not None
+
+
+
+def test_spawning_a_worker_expires_old_progressive_files(temp_directory, tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    old = _progressive_cache_file("find te", temp_directory)
+    _ProgressWriter(old).publish([], done=True)
+    os.utime(old, (0, 0))
+    recent = _progressive_cache_file("find tes", temp_directory)
+    _ProgressWriter(recent).publish([], done=True)
+    with patch("search_core._spawn_progressive_worker"), \
+            patch.dict("search_core.SETTINGS", {"progressive_first_wait_ms": 0}):
+        _run_progressive("find test", temp_directory)
+    assert not old.exists() and recent.exists()
+    assert _progressive_cache_file("find test", temp_directory).exists()
+
+# --- handle_du ---
+
+
+def test_handle_du_aggregates_subtrees(tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    scope = tmp_path / "scope"
+    (scope / "big" / "inner").mkdir(parents=True)
+    (scope / "small").mkdir()
+    (scope / "big" / "a.bin").write_bytes(b"x" * 3000)
+    (scope / "big" / "inner" / "b.bin").write_bytes(b"x" * 2000)
+    (scope / "small" / "c.bin").write_bytes(b"x" * 100)
+
+    results = handle_du("", scope)
+    assert [r["title"] for r in results] == ["big", "small"]
+    assert results[0]["variables"]["scope"] == str(scope / "big")
+    assert "4.9KB" in results[0]["subtitle"]
+
+
+def test_handle_du_reuses_cache_for_unchanged_dirs(tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    scope = tmp_path / "scope"
+    (scope / "sub").mkdir(parents=True)
+    (scope / "sub" / "f.bin").write_bytes(b"x" * 10)
+    handle_du("", scope)
+
+    with patch("search_core.os.scandir", side_effect=AssertionError("rescanned")):
+        results = handle_du("", scope)
+    assert results[0]["title"] == "sub"
+
+
+def test_handle_du_counts_hardlinks_once(tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    scope = tmp_path / "scope"
+    (scope / "photos").mkdir(parents=True)
+    (scope / "photos" / "a.jpg").write_bytes(b"x" * 100_000)
+    os.link(scope / "photos" / "a.jpg", scope / "photos" / "b.jpg")
+    os.link(scope / "photos" / "a.jpg", scope / "photos" / "c.jpg")
+    results = handle_du("", scope)
+    assert "97.7KB" in results[0]["subtitle"]
+
+
+def test_handle_du_honours_path_excludes(tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    scope = tmp_path / "scope"
+    (scope / "big" / "inner").mkdir(parents=True)
+    (scope / "big" / "a.bin").write_bytes(b"x" * 1000)
+    (scope / "big" / "inner" / "b.bin").write_bytes(b"x" * 9000)
+    with patch("search_core.EXCLUDED_PATTERNS", [".*", "big/inner"]):
+        results = handle_du("2", scope)
+    assert [r["title"] for r in results] == ["big"]
+    assert "1000B" in results[0]["subtitle"]
+
+
+def test_handle_du_invalid_depth(tmp_path):
+    results = handle_du("abc", tmp_path)
+    assert len(results) == 1
+    assert results[0]["valid"] is False
+
+
+# --- walk_tree ---
+
+
+def test_walk_tree_shared_visited_skips_overlapping_roots(temp_directory):
+    visited = set()
+    inner = [root for root, _, _ in walk_tree(temp_directory / "subdir", visited=visited)]
+    outer = [root for root, _, _ in walk_tree(temp_directory, visited=visited)]
+    assert str(temp_directory / "subdir") in inner
+    assert not set(inner) & set(outer)
+
+
+def test_walk_tree_max_depth(temp_directory):
+    roots = [root for root, _, _ in walk_tree(temp_directory, max_depth=1)]
+    assert str(temp_directory / "subdir") in roots
+    assert str(temp_directory / "subdir" / "deep") not in roots
+
+
+def test_walk_tree_does_not_follow_symlinks(temp_directory):
+    (temp_directory / "loop").symlink_to(temp_directory)
+    roots = [root for root, _, _ in walk_tree(temp_directory)]
+    assert str(temp_directory / "loop") not in roots
+
+
+def test_order_roots_nested_first_and_deduplicated(tmp_path):
+    outer = tmp_path / "docs"
+    inner = outer / "projects"
+    inner.mkdir(parents=True)
+    assert _order_roots([outer, inner, outer]) == [inner, outer]
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_handle_size_counts_hardlinks_once(mock_fd, tmp_path):
+    (tmp_path / "a.bin").write_bytes(b"x" * 100)
+    os.link(tmp_path / "a.bin", tmp_path / "b.bin")
+    results = handle_size("", tmp_path)
+    assert len(results) == 1
+
+
+# --- ignore files ---
+
+
+def test_ignore_rules_gitignore_semantics():
+    rules = IgnoreRules("/repo", ["# comment", "*.log", "!keep.log", "build/", "/docs/tmp"])
+    assert rules.ignored("/repo/a/debug.log", False) is True
+    assert rules.ignored("/repo/a/keep.log", False) is False
+    assert rules.ignored("/repo/x/build", True) is True
+    assert rules.ignored("/repo/x/build", False) is False
+    assert rules.ignored("/repo/docs/tmp", False) is True
+    assert rules.ignored("/repo/sub/docs/tmp", False) is False
+
+
+def test_ignore_rules_child_overrides_parent():
+    parent = IgnoreRules("/repo", ["*.txt"])
+    child = IgnoreRules("/repo/sub", ["!notes.txt"], parent)
+    assert child.ignored("/repo/sub/notes.txt", False) is False
+    assert child.ignored("/repo/sub/other.txt", False) is True
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_python_walkers_respect_ignore_files(mock_fd, tmp_path):
+    (tmp_path / ".gitignore").write_text("node_modules/\n*.log\n")
+    (tmp_path / "node_modules" / "pkg").mkdir(parents=True)
+    (tmp_path / "node_modules" / "pkg" / "target.js").write_text("x")
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / ".ignore").write_text("generated.py\n")
+    (tmp_path / "src" / "generated.py").write_text("x")
+    (tmp_path / "src" / "target.py").write_text("x")
+    (tmp_path / "target.log").write_text("x")
+
+    with patch.dict("search_core.SETTINGS", {"respect_ignore_files": True}):
+        names = [r["title"] for r in handle_find("target", tmp_path)]
+        assert names == ["target.py"]
+        assert handle_find("generated", tmp_path) == []
+
+    with patch.dict("search_core.SETTINGS", {"respect_ignore_files": False}):
+        assert len(handle_find("target", tmp_path)) == 3
+
+
+# --- frecency ---
+
+
+def test_record_usage_builds_hot_list(tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    record_usage("/a/often.txt")
+    record_usage("/a/often.txt")
+    record_usage("/a/once.txt")
+    hot = load_hot_list()
+    assert hot["/a/often.txt"] > hot["/a/once.txt"] > 0
+
+
+def test_rank_by_frecency_promotes_used_paths():
+    items = [create_item(Path("/a/report.txt")), create_item(Path("/a/my_report.txt"))]
+    hot = {"/a/my_report.txt": 1000.0}
+    ranked = rank_by_frecency("report", items, hot)
+    assert ranked[0]["title"] == "my_report.txt"
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_regular_search_answered_from_hot_list(mock_fd, temp_directory, tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    monkeypatch.setenv("scope", str(temp_directory))
+    record_usage(str(temp_directory / "test1.txt"))
+    with patch("search_core.search_files") as walk:
+        results = regular_search("test1")
+    walk.assert_not_called()
+    assert results[0]["arg"] == str(temp_directory / "test1.txt")
+
+
+# --- path-aware queries ---
+
+
+def test_path_match_score():
+    assert path_match_score(["proj", "api", "handler"], "/x/proj/api/handler.py") == 1
+    assert path_match_score(["proj", "handler"], "/x/proj/api/handler.py") == 99
+    assert path_match_score(["a", "b"], "b") == 99
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_search_files_path_segments(mock_fd, tmp_path):
+    for parent in ("project", "other"):
+        api = tmp_path / "work" / parent / "api"
+        api.mkdir(parents=True)
+        (api / "handler.py").write_text("x")
+    (tmp_path / "work" / "project" / "handler.py").write_text("x")
+
+    results = search_files("proj/api/hand", tmp_path)
+    assert [r["arg"] for r in results] == [str(tmp_path / "work" / "project" / "api" / "handler.py")]
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_search_files_path_segments_descend_only_matching(mock_fd, tmp_path):
+    (tmp_path / "proj" / "api" / "v1").mkdir(parents=True)
+    (tmp_path / "proj" / "api" / "v1" / "routes.py").write_text("x")
+    (tmp_path / "proj" / "web" / "v1").mkdir(parents=True)
+    listed = []
+    real_scandir = os.scandir
+
+    def spy(path):
+        listed.append(str(path))
+        return real_scandir(path)
+
+    with patch("search_core.os.scandir", side_effect=spy):
+        results = search_files("proj/api/v1/routes", tmp_path, depth=0)
+    # Found below search_depth by descending the matching subtree only
+    assert [r["title"] for r in results] == ["routes.py"]
+    assert str(tmp_path / "proj" / "web") not in listed
+
+
+# --- query filters ---
+
+
+def test_parse_query_filters():
+    query, filters = parse_query_filters("report ext:pdf,md type:f >10m age:<7d")
+    assert query == "report"
+    assert filters.exts == ("pdf", "md")
+    assert filters.kind == "f"
+    assert filters.min_size == 10 * 1024 ** 2
+    assert filters.changed_within == 7 * 86400
+
+
+def test_parse_query_filters_plain_query():
+    assert parse_query_filters("my notes") == ("my notes", None)
+
+
+def test_query_filters_fd_args():
+    filters = QueryFilters(exts=("pdf",), kind="f", min_size=1023, changed_within=3600.0)
+    assert filters.fd_args() == [
+        "-e", "pdf", "-t", "f", "--size", "+1024b", "--changed-within", "3600s",
+    ]
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_search_files_applies_filters(mock_fd, temp_directory):
+    _, filters = parse_query_filters("ext:py")
+    results = search_files("test", temp_directory, filters=filters)
+    assert [r["title"] for r in results] == ["test2.py"]
+
+    _, filters = parse_query_filters("type:d")
+    results = search_files("", temp_directory, filters=filters)
+    assert {r["title"] for r in results} == {"subdir", "deep"}
+
+    _, filters = parse_query_filters(">5 age:<1d")
+    results = search_files("", temp_directory, filters=filters)
+    assert "test1.txt" in [r["title"] for r in results]
+    assert ".hidden" not in [r["title"] for r in results]
+
+
+# --- batch mode ---
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_run_batch_streams_one_result_per_line(mock_fd, temp_directory, tmp_path, monkeypatch):
+    import io
+
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    monkeypatch.setenv("scope", str(temp_directory))
+    lines = [
+        json.dumps({"query": "test1", "id": "a"}),
+        json.dumps("deepfile"),
+        "ls",
+        "",
+        json.dumps({"query": "subfile ext:txt"}),
+    ]
+    out = io.StringIO()
+    with patch.dict("search_core.SETTINGS", {"search_paths": []}):
+        run_batch(lines, out)
+    results = {r["id"]: r for r in map(json.loads, out.getvalue().splitlines())}
+    assert set(results) == {"a", 1, 2, 4}
+    assert results["a"]["items"][0]["title"] == "test1.txt"
+    assert results[1]["items"][0]["title"] == "deepfile.txt"
+    assert len(results[2]["items"]) >= 3
+    assert results[4]["items"][0]["title"] == "subfile.txt"
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_run_batch_shares_one_walk(mock_fd, temp_directory, tmp_path, monkeypatch):
+    import io
+
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    monkeypatch.setenv("scope", str(temp_directory))
+    with patch.dict("search_core.SETTINGS", {"search_paths": []}), \
+            patch("search_core.walk_tree", wraps=walk_tree) as walker:
+        run_batch(["test1", "test2", "subfile", "deep"], io.StringIO())
+    assert walker.call_count == 1
+
+
+# --- async core ---
+
+
+def test_gather_limited_bounds_concurrency_and_times_out():
+    import asyncio
+
+    running = []
+    peak = []
+
+    def factory(delay):
+        async def job():
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(delay)
+            running.pop()
+            return delay
+        return job
+
+    results = run_async(gather_limited([factory(0.01)] * 6 + [factory(5)], 2, timeout=0.3))
+    assert max(peak) <= 2
+    assert results[:6] == [0.01] * 6
+    assert results[6] is None  # missed the timeout, cancelled
+
+
+def test_fd_lines_async_stops_at_deadline():
+    import asyncio
+    import time as _time
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        return await _fd_lines_async(["sh", "-c", "echo first; exec sleep 5"], loop.time() + 0.2)
+
+    start = _time.monotonic()
+    assert run_async(run()) == ["first"]
+    assert _time.monotonic() - start < 2
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_search_roots_async_returns_partial_results_within_budget(mock_fd, temp_directory):
+    import time as _time
+
+    def slow_walk(query, root, depth, max_results, visited, filters, should_stop):
+        while not should_stop():
+            _time.sleep(0.01)
+        return [create_item(Path(root) / "partial.txt")]
+
+    with patch("search_core._walk_search", side_effect=slow_walk), \
+            patch.dict("search_core.SETTINGS", {"latency_budget_ms": 50}):
+        start = _time.monotonic()
+        results = run_async(_search_roots_async("x", [temp_directory, temp_directory / "subdir"], None))
+    assert _time.monotonic() - start < 1
+    assert [r[0]["title"] for r in results] == ["partial.txt", "partial.txt"]
+
+
+def test_search_roots_async_stops_path_queries_at_budget(tmp_path):
+    import time as _time
+    import search_core as search
+
+    roots = [tmp_path / "one", tmp_path / "two"]
+    for root in roots:
+        (root / "proj" / "api").mkdir(parents=True)
+        (root / "proj" / "api" / "handler.py").write_text("x")
+        for i in range(150):
+            (root / f"d{i:03}").mkdir()
+
+    walk_tree = search.walk_tree
+
+    def slow_walk(*args, **kwargs):
+        for entry in walk_tree(*args, **kwargs):
+            _time.sleep(0.01)
+            yield entry
+
+    with patch("search_core.walk_tree", side_effect=slow_walk), \
+            patch.dict("search_core.SETTINGS", {"latency_budget_ms": 200}):
+        start = _time.monotonic()
+        results = run_async(_search_roots_async("proj/api/hand", roots, None))
+    assert _time.monotonic() - start < 1
+    assert [[r["title"] for r in found] for found in results] == [["handler.py"]] * 2
+
+@pytest.mark.parametrize("has_fd", [False, True])
+def test_regular_search_empty_query_with_several_roots(has_fd, temp_directory, tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "file.txt").write_text("x")
+    with patch("search_core._has_fd", return_value=has_fd), \
+            patch.dict("search_core.SETTINGS", {"search_paths": [str(other)]}):
+        assert regular_search("", str(temp_directory)) == []
+
+
+def test_handle_grep_concurrent_scan(tmp_path):
+    for i in range(40):
+        (tmp_path / f"f{i:02d}.txt").write_text("nothing\n" if i % 2 else "a needle here\n")
+    results = handle_grep("NEEDLE", tmp_path)
+    assert {r["title"] for r in results} == {f"f{i:02d}.txt:1" for i in range(0, 40, 2)}
+
+
+# --- Parallel walk ---
+
+def _deep_tree(root):
+    for a in range(3):
+        for b in range(3):
+            sub = root / f"a{a}" / f"b{b}" / "deep"
+            sub.mkdir(parents=True)
+            (sub / f"log{a}{b}.txt").write_text("x" * (a * 10 + b))
+            (sub.parent / f"note{a}{b}.md").write_text("n")
+    (root / "top_log.txt").write_text("top")
+
+
+def test_partition_walk_covers_tree_once(tmp_path):
+    _deep_tree(tmp_path)
+    units = _partition_walk(tmp_path, 2)
+    seen = []
+    for path, recurse in units:
+        for root, dirs, files in walk_tree(path, None if recurse else 0):
+            seen += [os.path.join(root, f) for f in files]
+    expected = [os.path.join(r, f) for r, _, fs in walk_tree(tmp_path) for f in fs]
+    assert sorted(seen) == sorted(expected)
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_parallel_find_matches_serial(mock_fd, tmp_path):
+    _deep_tree(tmp_path)
+    serial = handle_find("log", tmp_path)
+    with patch.dict("search_core.SETTINGS", {"parallel_walk_workers": 2}):
+        parallel = handle_find("log", tmp_path)
+    assert sorted(r["arg"] for r in parallel) == sorted(r["arg"] for r in serial)
+    assert len(parallel) == 10
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_parallel_size_and_recent_match_serial(mock_fd, tmp_path):
+    _deep_tree(tmp_path)
+    os.link(tmp_path / "a2" / "b2" / "deep" / "log22.txt", tmp_path / "hardlink.txt")
+    serial = handle_size("10", tmp_path)
+    with patch.dict("search_core.SETTINGS", {"parallel_walk_workers": 2}):
+        parallel = handle_size("10", tmp_path)
+        recent = handle_recent("1", tmp_path)
+    assert [r["subtitle"].split(" | ")[0] for r in parallel] == \
+        [r["subtitle"].split(" | ")[0] for r in serial]
+    assert len(parallel) == len(serial) == 6  # log1x, log2x, top_log, hardlink counted once
+    assert len(recent) == 19
+
+
+def test_parallel_walk_stops_when_enough(tmp_path):
+    _deep_tree(tmp_path)
+    found = parallel_walk(tmp_path, _unit_find, ("log", 1), 2, enough=lambda r: len(r) >= 1)
+    assert 1 <= len(found) < 10
+
+
+# --- Directory snapshots ---
+
+@patch("search_core._has_fd", return_value=False)
+def test_recent_and_size_reuse_dir_snapshots(mock_fd, tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    scope = tmp_path / "scope"
+    _deep_tree(scope)
+    first = handle_size("10", scope)
+    assert len(load_dir_snapshots(scope)) == 22  # scope, a*, a*/b*, a*/b*/deep
+
+    with patch("search_core._scan_dir_stats", side_effect=AssertionError("rescanned")):
+        assert handle_size("10", scope) == first
+        assert len(handle_recent("1", scope)) == 19
+
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_dir_snapshots_are_kept_per_scope(mock_fd, tmp_path, monkeypatch):
+    import search_core as search
+
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    scopes = [tmp_path / f"scope{i}" for i in range(3)]
+    for scope in scopes:
+        (scope / "sub").mkdir(parents=True)
+        (scope / "sub" / "f.txt").write_text("x")
+    handle_size("0", scopes[0])
+    assert set(load_dir_snapshots(scopes[0])) == {str(scopes[0]), str(scopes[0] / "sub")}
+    assert load_dir_snapshots(scopes[1]) == {}  # a small scope doesn't load others
+
+    with patch("search_core.DIR_SNAPSHOT_SCOPES", 2):
+        handle_size("0", scopes[1])
+        os.utime(search._dir_snapshot_store(scopes[0]).path, ns=(0, 0))  # oldest write
+        handle_size("0", scopes[2])
+    assert load_dir_snapshots(scopes[0]) == {}
+    assert load_dir_snapshots(scopes[1]) and load_dir_snapshots(scopes[2])
+
+@patch("search_core._has_fd", return_value=False)
+def test_dir_snapshots_rescan_changed_and_expired_dirs(mock_fd, tmp_path, monkeypatch):
+    import search_core as search
+
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    scope = tmp_path / "scope"
+    _deep_tree(scope)
+    handle_recent("1", scope)
+    (scope / "a1" / "fresh_file.txt").write_text("new")
+    with patch("search_core._scan_dir_stats", wraps=search._scan_dir_stats) as scan:
+        results = handle_recent("1", scope)
+    assert [call.args[0] for call in scan.call_args_list] == [str(scope / "a1")]
+    assert "fresh_file.txt" in [r["title"] for r in results]
+
+    with patch.dict("search_core.SETTINGS", {"dir_snapshot_ttl": 0}), \
+            patch("search_core._scan_dir_stats", wraps=search._scan_dir_stats) as scan:
+        handle_recent("1", scope)
+    assert scan.call_count == 22
+
+
+def test_dir_snapshot_reuses_unchanged_listing_for_a_day(tmp_path):
+    import search_core as search
+
+    path, st = str(tmp_path), os.stat(tmp_path)
+    snapshots = {path: search.dir_snapshot(path, st, {}, 1000.0)}
+    with patch("search_core._scan_dir_stats", side_effect=AssertionError("rescanned")):
+        assert search.dir_snapshot(path, st, snapshots, 1000.0 + 3600) == snapshots[path]
+    assert search.dir_snapshot(path, st, snapshots, 1000.0 + 86400)[2] == 1000.0 + 86400
+
+def test_walk_stats_applies_excludes_to_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    (tmp_path / "keep.txt").write_text("abc")
+    (tmp_path / "skip.log").write_text("x")
+    snapshots = {}
+    list(walk_stats(tmp_path, snapshots, snapshots))
+    with patch("search_core.EXCLUDED_PATTERNS", ["*.log", "data"]):
+        walked = list(walk_stats(tmp_path, snapshots, {}))
+    assert [(name, size) for name, size, _, _ in walked[0][2]] == [("keep.txt", 3)]
+
+
+# --- Name index ---
+
+def _index_tree(root):
+    (root / "Projects" / "api").mkdir(parents=True)
+    (root / "Projects" / "api" / "handler.py").write_text("x" * 100)
+    (root / "Projects" / "api" / "report.md").write_text("r")
+    (root / "Projects" / "Report").mkdir()
+    (root / "notes").mkdir()
+    (root / "notes" / "old_report.txt").write_text("old")
+    (root / "notes" / "rpt.txt").write_text("")
+    (root / ".hidden_report").write_text("")
+
+
+def test_build_index_round_trip(tmp_path):
+    _index_tree(tmp_path / "root")
+    count = build_index([tmp_path / "root"], tmp_path / "names.index")
+    index = NameIndex(tmp_path / "names.index")
+    assert count == index.count == 8  # .hidden_report is excluded
+    found = [(score, index.path(i)) for score, i in index.candidates("report")]
+    root = str(tmp_path / "root")
+    assert found == [
+        (0, os.path.join(root, "Projects", "Report")),
+        (1, os.path.join(root, "Projects", "api", "report.md")),
+        (2, os.path.join(root, "notes", "old_report.txt")),
+    ]
+    assert [index.name(i) for score, i in index.candidates("rpt") if score == 3] == \
+        ["old_report.txt", "Report", "report.md"]
+
+
+def test_name_index_search_with_filters_and_segments(tmp_path):
+    root = tmp_path / "root"
+    _index_tree(root)
+    build_index([root], tmp_path / "names.index")
+    index = NameIndex(tmp_path / "names.index")
+
+    files = index.search("report", [root], QueryFilters(kind="f"))
+    assert [r["title"] for r in files] == ["report.md", "old_report.txt"]
+    big = index.search("py", [root], QueryFilters(min_size=50))
+    assert [r["title"] for r in big] == ["handler.py"]
+    assert [r["title"] for r in index.search("proj/api/hand", [root])] == ["handler.py"]
+    assert index.search("report", [root / "notes"])[0]["title"] == "old_report.txt"
+
+    (root / "notes" / "old_report.txt").unlink()
+    assert "old_report.txt" not in [r["title"] for r in index.search("report", [root])]
+
+
+def test_regular_search_answers_from_index(tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    root = tmp_path / "root"
+    _index_tree(root)
+    build_index([root])
+    with patch.dict("search_core.SETTINGS", {"search_paths": [], "hot_list_short_circuit": False}), \
+            patch("search_core.search_files", side_effect=AssertionError("walked")):
+        results = regular_search("handler", str(root))
+    assert [r["title"] for r in results] == ["handler.py"]
+
+
+def test_regular_search_walks_and_rebuilds_when_index_is_stale(tmp_path, monkeypatch):
+    import time as _time
+
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    root = tmp_path / "root"
+    _index_tree(root)
+    build_index([root])
+    (root / "handler_new.py").write_text("")
+    later = _time.time() + 10
+    os.utime(root, (later, later))  # the root changed after the build
+    settings = {"search_paths": [], "hot_list_short_circuit": False}
+    with patch.dict("search_core.SETTINGS", settings), \
+            patch("search_core.rebuild_index_async") as rebuild:
+        titles = [r["title"] for r in regular_search("handler", str(root))]
+    assert "handler_new.py" in titles
+    rebuild.assert_called_once_with([str(root)])
+
+
+def test_name_index_expires_after_max_age(tmp_path):
+    root = tmp_path / "root"
+    _index_tree(root)
+    build_index([root], tmp_path / "names.index")
+    index = NameIndex(tmp_path / "names.index")
+    assert index.fresh_for(root)
+    with patch.dict("search_core.SETTINGS", {"index_max_age": 60}), \
+            patch("search_core.time.time", return_value=index.built_at + 120):
+        assert not index.fresh_for(root)
+        with patch.dict("search_core.SETTINGS", {"index_max_age": 0}):
+            assert index.fresh_for(root)
+
+
+def test_rebuild_index_async_starts_one_rebuild(tmp_path, monkeypatch):
+    from search_core import rebuild_index_async
+
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path))
+    with patch("subprocess.Popen") as popen:
+        rebuild_index_async([str(tmp_path / "root")])
+        rebuild_index_async([str(tmp_path / "root")])
+    assert popen.call_count == 1
+    assert popen.call_args.args[0][-2:] == ["--build-index", str(tmp_path / "root")]
+
+
+def test_build_index_empty_root(tmp_path):
+    (tmp_path / "empty").mkdir()
+    assert build_index([tmp_path / "empty"], tmp_path / "names.index") == 0
+    index = NameIndex(tmp_path / "names.index")
+    assert list(index.candidates("x")) == []
+
+
+# --- Superseded searches ---
+
+@pytest.fixture
+def claim(tmp_path, monkeypatch):
+    import search_core as search
+
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    monkeypatch.setattr(search, "_claim", [])
+    monkeypatch.setattr(search, "CANCEL_CHECK_INTERVAL", 0)
+    return search
+
+
+def test_newer_claim_supersedes_older_search(claim):
+    claim.claim_search()
+    assert not claim.superseded()
+    older = list(claim._claim)
+    claim.claim_search()  # a newer keystroke
+    claim._claim[:] = older
+    assert claim.superseded()
+    assert claim.superseded()  # sticky
+
+
+
+def test_worker_follows_reruns_of_its_query_until_superseded(claim, tmp_path, monkeypatch):
+    scope = tmp_path / "scope"
+    claim.claim_search(claim._query_key("find r", scope))
+    token = claim.claim_token()
+    claim._claim[:] = []
+    claim.follow_search(token, claim._query_key("find r", scope))
+    assert not claim.superseded()
+    followed = list(claim._claim)
+    claim.claim_search(claim._query_key("find r", scope))  # Alfred's rerun
+    claim._claim[:] = followed
+    assert not claim.superseded()
+    followed = list(claim._claim)
+    claim.claim_search(claim._query_key("find re", scope))  # the next keystroke
+    claim._claim[:] = followed
+    assert claim.superseded()
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_superseded_worker_drops_its_cache(mock_fd, claim, temp_directory, monkeypatch):
+    spawned = {}
+    claim.claim_search(claim._query_key("size", temp_directory))
+    with patch("subprocess.Popen", side_effect=lambda *a, **kw: spawned.update(kw["env"])):
+        claim._spawn_progressive_worker("size", temp_directory)
+    monkeypatch.setenv("search_seq", spawned["search_seq"])
+    claim._claim[:] = []
+    claim.claim_search(claim._query_key("size 10", temp_directory))  # a newer query
+    claim._claim[:] = []
+    claim._progressive_worker("size", temp_directory)
+    assert not claim._progressive_cache_file("size", temp_directory).exists()
+
+def test_walk_tree_stops_when_superseded(claim, tmp_path):
+    _deep_tree(tmp_path / "tree")
+    with patch("search_core.superseded", side_effect=[False, False, True]):
+        walked = list(walk_tree(tmp_path / "tree"))
+    assert len(walked) == 2
+
+
+def test_run_fd_kills_child_when_superseded(claim):
+    import time as _time
+
+    checks = iter([False] * 10)
+    with patch("search_core.superseded", side_effect=lambda: next(checks, True)):
+        start = _time.monotonic()
+        code, lines = claim._run_fd(["sh", "-c", "echo first; printf partial; exec sleep 5"], 10)
+    assert _time.monotonic() - start < 2
+    assert (code, lines) == (0, ["first"])
+
+
+def test_run_fd_returns_output_and_code(claim):
+    assert claim._run_fd(["sh", "-c", "printf 'a\\nb\\n'; exit 1"], 5) == (1, ["a", "b"])
+
+
+def test_main_skips_output_when_superseded(claim, temp_directory, capsys):
+    os.environ["scope"] = str(temp_directory)
+    sys.argv = ["search.py", "ls"]
+    with patch("search_core.superseded", return_value=True):
+        claim.main()
+    assert capsys.readouterr().out == ""
+    assert (claim._get_workflow_data_dir() / claim.SEARCH_SEQ).exists()
+
+
+# --- Adaptive depth ---
+
+@pytest.fixture
+def depth_costs(tmp_path, monkeypatch):
+    import search_core as search
+
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    monkeypatch.setattr(search, "_depth_costs", [])
+    return search
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_adaptive_depth_searches_past_search_depth(mock_fd, depth_costs, tmp_path):
+    deep = tmp_path / "tree" / "a" / "b" / "c" / "d" / "e"
+    deep.mkdir(parents=True)
+    (deep / "needle.txt").write_text("x")
+    with patch.dict("search_core.SETTINGS", {"depth_budget_ms": 5000, "search_paths": []}):
+        assert regular_search("needle", str(tmp_path / "tree")) != []
+    assert regular_search("needle", str(tmp_path / "tree")) == []  # fixed depth 3
+
+    costs = depth_costs._read_marshal(tmp_path / "data" / depth_costs.DEPTH_COSTS)
+    assert len(costs[str(tmp_path / "tree")]["walk"]) == 6  # levels 0..5 completed
+
+
+def test_budget_walk_skips_levels_too_costly_last_time(depth_costs, tmp_path):
+    _deep_tree(tmp_path / "tree")
+    root = str(tmp_path / "tree")
+    depth_costs._root_costs(root)["walk"] = [0.001, 0.002, 10.0]
+    walked = [path for path, _, _ in budget_walk(root, 1.0)]
+    assert walked[0] == root and len(walked) == 4  # levels 0 and 1 only
+    assert depth_costs._root_costs(root)["walk"][2] == 10.0  # kept, not re-measured
+
+
+def test_budget_walk_always_lists_top(depth_costs, tmp_path):
+    _deep_tree(tmp_path / "tree")
+    assert [p for p, _, _ in budget_walk(tmp_path / "tree", 1e-9)] == [str(tmp_path / "tree")]
+
+
+def test_adaptive_fd_depth_follows_history(depth_costs):
+    with patch.dict("search_core.SETTINGS", {"depth_budget_ms": 100}):
+        assert adaptive_fd_depth("/r", 3) == 3  # no history yet
+        depth_costs._root_costs("/r")["fd"] = {3: 0.02}
+        assert adaptive_fd_depth("/r", 3) == 4  # cheap: probe deeper
+        depth_costs._root_costs("/r")["fd"] = {3: 0.02, 4: 0.08, 5: 0.4}
+        assert adaptive_fd_depth("/r", 3) == 4
+        depth_costs._root_costs("/r")["fd"] = {3: 0.5}
+        assert adaptive_fd_depth("/r", 3) == 2  # too slow: back off
+
+
+@patch("search_core._has_fd", return_value=True)
+def test_search_files_skips_fd_depth_over_budget(mock_fd, depth_costs, tmp_path):
+    depth_costs._root_costs(tmp_path)["fd"] = {2: 0.06, 3: 0.5, 4: 0.9}
+    with patch.dict("search_core.SETTINGS", {"depth_budget_ms": 100}), \
+            patch("search_core._search_with_fd", return_value=[]) as mock_search:
+        search_files("needle", tmp_path)
+    assert mock_search.call_args.args[2] == 2  # 3 and 4 went over the budget
+    assert depth_costs._root_costs(tmp_path)["fd"][3] == 0.5  # not re-measured
+
+
+# --- Tree rendering ---
+
+def test_tree_shares_budget_between_siblings(tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    scope = tmp_path / "scope"
+    (scope / "aaa_huge").mkdir(parents=True)
+    for i in range(200):
+        (scope / "aaa_huge" / f"f{i:03d}.txt").write_text("")
+    for name in ("bbb", "ccc"):
+        (scope / name).mkdir()
+        (scope / name / "inner.txt").write_text("")
+    (scope / "top.txt").write_text("")
+
+    with patch("search_core.MAX_RESULTS", 20):
+        results = handle_tree(scope)
+    titles = [r["title"] for r in results]
+    assert len(results) <= 20
+    assert "├── 📂 bbb/" in titles and "│   └── inner.txt" in titles
+    assert "└── top.txt" in titles
+    more = [r for r in results if "more" in r["title"]]
+    assert len(more) == 1 and more[0]["title"] == "│   └── … 187 more"
+    assert more[0]["variables"] == {"is_dir": "1", "scope": str(scope / "aaa_huge")}
+
+
+def test_tree_reuses_cached_listings(tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    scope = tmp_path / "scope"
+    _deep_tree(scope)
+    first = handle_tree(scope)
+    with patch("search_core._scan_dir_names", side_effect=AssertionError("rescanned")):
+        assert handle_tree(scope) == first
+    assert [r["title"] for r in first[:3]] == ["├── 📂 a0/", "│   ├── 📂 b0/", "│   │   ├── 📂 deep/"]
+    assert not (tmp_path / "data" / "snapshots").exists()  # snapshot store left alone
+
+    (scope / "a1" / "b1" / "new.txt").write_text("")
+    import search_core as search
+    with patch("search_core._scan_dir_names", wraps=search._scan_dir_names) as scanned:
+        assert "│   │   ├── new.txt" in [r["title"] for r in handle_tree(scope)]
+    assert [call.args[0] for call in scanned.call_args_list] == [str(scope / "a1" / "b1")]
+
+
+def test_tree_shows_siblings_before_descendants(tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    scope = tmp_path / "scope"
+    for i in range(50):
+        (scope / f"dir{i:02d}" / "sub").mkdir(parents=True)
+        (scope / f"dir{i:02d}" / "file.txt").write_text("")
+    results = handle_tree(scope)
+    assert len(results) == 50
+    assert [r["title"] for r in results[-2:]] == ["├── 📂 dir48/", "└── 📂 dir49/"]
+
+
+# --- Duplicate finder ---
+
+def _dupes_tree(root):
+    (root / "a").mkdir(parents=True)
+    (root / "b").mkdir()
+    (root / "a" / "photo.jpg").write_bytes(b"X" * 1000)
+    (root / "b" / "photo copy.jpg").write_bytes(b"X" * 1000)
+    (root / "b" / "same_size.jpg").write_bytes(b"Y" * 1000)
+    os.link(root / "a" / "photo.jpg", root / "a" / "hardlink.jpg")
+    big = b"H" * (64 * 1024) + b"%s" + b"T" * (64 * 1024)
+    (root / "a" / "big1.bin").write_bytes(big.replace(b"%s", b"1" * 100))
+    (root / "b" / "big2.bin").write_bytes(big.replace(b"%s", b"2" * 100))  # same ends
+    (root / "b" / "big3.bin").write_bytes(big.replace(b"%s", b"1" * 100))
+
+
+def test_handle_dupes_groups_identical_files(tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    _dupes_tree(tmp_path / "scope")
+    results = handle_dupes("", tmp_path / "scope")
+    groups = {}
+    for r in results:
+        groups.setdefault(r["subtitle"].split(":")[0], set()).add(r["title"])
+    big, photos = sorted(groups.values(), key=lambda titles: "big1.bin" not in titles)
+    assert big == {"big1.bin", "big3.bin"}  # big2.bin only shares its ends
+    # The hardlink is the same file, listed under one of its names
+    assert photos in ({"photo.jpg", "photo copy.jpg"}, {"hardlink.jpg", "photo copy.jpg"})
+    assert results[0]["subtitle"].startswith("🧬 #1: 2 copies × ")  # biggest waste first
+
+
+def test_handle_dupes_reuses_cached_hashes(tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    scope = tmp_path / "scope"
+    _dupes_tree(scope)
+    first = handle_dupes("", scope)
+    with patch("search_core._hash_file", side_effect=AssertionError("rehashed")):
+        assert handle_dupes("", scope) == first
+
+    (scope / "b" / "big3.bin").write_bytes(b"H" * (64 * 1024) + b"3" * 100 + b"T" * (64 * 1024))
+    import search_core as search
+    with patch("search_core._hash_file", wraps=search._hash_file) as hashed:
+        results = handle_dupes("", scope)
+    assert {call.args[0] for call in hashed.call_args_list} == {str(scope / "b" / "big3.bin")}
+    assert "big1.bin" not in [r["title"] for r in results]
+
+
+def test_handle_dupes_invalid_size(tmp_path):
+    assert handle_dupes("abc", tmp_path)[0]["valid"] is False
+
+
+# --- ripgrep backend ---
+
+@pytest.fixture
+def fake_rg(tmp_path, monkeypatch):
+    """An ``rg`` on PATH that records its args and prints canned --json events."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    events = [
+        {"type": "begin", "data": {"path": {"text": "/s/a.txt"}}},
+        {"type": "match", "data": {"path": {"text": "/s/a.txt"}, "lines": {"text": "  a Needle\\n"},
+                                   "line_number": 3}},
+        {"type": "match", "data": {"path": {"bytes": "L3MvYg=="}, "lines": {"text": "x"},
+                                   "line_number": 1}},
+        {"type": "match", "data": {"path": {"text": "/s/sub/b.md"}, "lines": {"text": "needle"},
+                                   "line_number": 7}},
+        {"type": "match", "data": {"path": {"text": "/s/c.py"}, "lines": {"text": "needle"},
+                                   "line_number": 1}},
+    ]
+    script = bin_dir / "rg"
+    script.write_text(
+        "#!/bin/sh\n"
+        f"printf '%s\\n' \"$@\" > {tmp_path / 'args'}\n"
+        + "".join(f"echo '{json.dumps(e, separators=(',', ':'))}'\n" for e in events)
+        + "exec sleep ${FAKE_RG_SLEEP:-0}\n"
+    )
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    return tmp_path / "args"
+
+
+def test_grep_streams_rg_json_and_stops_at_max_results(fake_rg, tmp_path, monkeypatch):
+    import time as _time
+
+    monkeypatch.setenv("FAKE_RG_SLEEP", "5")
+    start = _time.monotonic()
+    with patch("search_core.MAX_RESULTS", 2):
+        results = handle_grep("Needle", tmp_path)
+    assert _time.monotonic() - start < 2  # rg killed, not waited for
+    assert [(r["title"], r["subtitle"]) for r in results] == [
+        ("a.txt:3", "📝 a Needle"), ("b.md:7", "📝 needle"),
+    ]
+
+
+def test_rg_command_mirrors_grep_settings(fake_rg, tmp_path):
+    with patch.dict("search_core.SETTINGS", {"grep_max_depth": 3, "respect_ignore_files": True}), \
+            patch("search_core.EXCLUDED_PATTERNS", [".*", "build/"]):
+        handle_grep("needle", tmp_path)
+    args = fake_rg.read_text().splitlines()
+    assert args[args.index("--max-depth") + 1] == "3"
+    assert "--no-require-git" in args and "--no-ignore" not in args
+    assert args.index("*.txt") < args.index("!build/")
+    assert args[-3:] == ["--", "needle", str(tmp_path)]
+
+
+def test_grep_falls_back_when_rg_fails(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "rg").write_text("#!/bin/sh\nexit 2\n")
+    (bin_dir / "rg").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    (tmp_path / "notes.txt").write_text("one\nthe needle\n")
+    assert [r["title"] for r in handle_grep("needle", tmp_path)] == ["notes.txt:2"]
+
+
+# --- Archive search ---
+
+def _archives(root):
+    import tarfile
+    import zipfile
+
+    root.mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(root / "bundle.zip", "w") as archive:
+        archive.writestr("docs/", "")
+        archive.writestr("docs/report_2024.pdf", "pdf")
+        archive.writestr("readme.txt", "hi")
+    (root / "src").mkdir(exist_ok=True)
+    (root / "src" / "report.md").write_text("r")
+    with tarfile.open(root / "src.tar.gz", "w:gz") as archive:
+        archive.add(root / "src" / "report.md", arcname="project/report.md")
+    (root / "broken.zip").write_bytes(b"not a zip")
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_handle_archive_matches_members(mock_fd, tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    _archives(tmp_path / "scope")
+    results = handle_archive("report", tmp_path / "scope")
+    assert [r["title"] for r in results] == [
+        "bundle.zip › docs/report_2024.pdf", "src.tar.gz › project/report.md",
+    ]
+    assert results[0]["arg"] == str(tmp_path / "scope" / "bundle.zip")
+    assert results[0]["variables"]["member"] == "docs/report_2024.pdf"
+    assert handle_archive("", tmp_path)[0]["valid"] is False
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_archive_members_are_cached(mock_fd, tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    scope = tmp_path / "scope"
+    _archives(scope)
+    handle_archive("readme", scope)
+    with patch("search_core._archive_members", side_effect=AssertionError("reopened")):
+        assert len(handle_archive("readme", scope)) == 1
+
+    import zipfile
+    with zipfile.ZipFile(scope / "bundle.zip", "a") as archive:
+        archive.writestr("readme2.txt", "new")
+    assert len(handle_archive("readme", scope)) == 2
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_find_includes_archive_members_by_default(mock_fd, tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    _archives(tmp_path / "scope")
+    titles = [r["title"] for r in handle_find("report", tmp_path / "scope")]
+    assert titles[0] == "report.md" and "bundle.zip › docs/report_2024.pdf" in titles
+    with patch.dict("search_core.SETTINGS", {"search_archives": False}):
+        titles = [r["title"] for r in handle_find("report", tmp_path / "scope")]
+    assert titles == ["report.md"]
+
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_superseded_find_keeps_archive_cache(mock_fd, tmp_path, monkeypatch):
+    import search_core as search
+
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    _archives(tmp_path / "scope")
+    handle_archive("report", tmp_path / "scope")
+    cached = search.CacheStore(search.ARCHIVE_CACHE).load()
+    assert cached
+    with patch("search_core.superseded", return_value=True):
+        handle_find("report", tmp_path / "scope")
+    assert search.CacheStore(search.ARCHIVE_CACHE).load() == cached
+
+
+@patch("search_core._has_fd", return_value=False)
+def test_find_opens_only_small_uncached_archives(mock_fd, tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    _archives(tmp_path / "scope")
+    with patch.dict("search_core.SETTINGS", {"find_archive_max_mb": 0}):
+        titles = [r["title"] for r in handle_find("report", tmp_path / "scope")]
+        assert titles == ["report.md"]
+        handle_archive("report", tmp_path / "scope")  # caches every archive
+        titles = [r["title"] for r in handle_find("report", tmp_path / "scope")]
+    assert "bundle.zip › docs/report_2024.pdf" in titles
+
+# --- Shared caches ---
+
+def test_cache_store_tolerates_missing_and_corrupt_files(tmp_path, monkeypatch):
+    from search_core import CacheStore
+
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path))
+    store = CacheStore("test.cache")
+    assert store.load() == {}
+    store.path.write_bytes(b"\xff\x00garbage")
+    assert store.load() == {}
+    store.path.write_bytes(b"")
+    assert store.load() == {}
+    store.save([1, 2])  # wrong kind
+    assert store.load() == {}
+
+
+def test_cache_store_update_keeps_concurrent_writers_entries(tmp_path, monkeypatch):
+    from search_core import CacheStore
+
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path))
+    store = CacheStore("test.cache")
+    store.save({"a": 1, "b": 2})
+    mine = store.load()
+    CacheStore("test.cache").update({"c": 3})  # another process, meanwhile
+    mine["a"] = 10
+    assert store.update({"a": mine["a"]}, removed=["b"]) == {"c": 3, "a": 10}
+    assert list(store.update({"c": 4, "d": 5}, limit=2)) == ["c", "d"]
+
+
+def test_cache_store_under_concurrent_processes(tmp_path):
+    import subprocess
+
+    script = (
+        "import sys, search_core\n"
+        "store = search_core.CacheStore('test.cache')\n"
+        "for i in range(25):\n"
+        "    store.update({f'{sys.argv[1]}-{i}': i})\n"
+    )
+    env = dict(os.environ, alfred_workflow_data=str(tmp_path))
+    root = Path(__file__).resolve().parent.parent
+    procs = [
+        subprocess.Popen([sys.executable, "-c", script, str(n)], cwd=str(root), env=env)
+        for n in range(4)
+    ]
+    assert all(proc.wait() == 0 for proc in procs)
+    from search_core import _read_marshal
+    assert len(_read_marshal(tmp_path / "test.cache")) == 100
+    assert [p.name for p in tmp_path.iterdir() if p.suffix == ".tmp"] == []
+
+
+def test_cache_store_without_fcntl(tmp_path, monkeypatch):
+    from search_core import CacheStore
+
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path))
+    monkeypatch.setitem(sys.modules, "fcntl", None)  # import fails, as on Windows
+    assert CacheStore("test.cache").update({"a": 1}) == {"a": 1}
+    assert not (tmp_path / "test.cache.lock").exists()
+
+
+def test_cache_stats_are_appended_per_process(tmp_path, monkeypatch):
+    import search_core as search
+
+    stats = tmp_path / "stats.jsonl"
+    monkeypatch.setenv("search_stats", str(stats))
+    monkeypatch.setattr(search, "_cache_stats", {})
+    search.count_cache("dirs.snapshot", True)
+    search.count_cache("dirs.snapshot", False)
+    search.count_cache("dirs.snapshot", True)
+    search.write_cache_stats()
+    search.write_cache_stats()
+    lines = [json.loads(line) for line in stats.read_text().splitlines()]
+    assert len(lines) == 2 and lines[0]["caches"] == {"dirs.snapshot": [2, 1]}
+
+
+def test_du_counts_hits_on_second_run(tmp_path, monkeypatch):
+    import search_core as search
+
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    monkeypatch.setattr(search, "_cache_stats", {})
+    _deep_tree(tmp_path / "tree")
+    handle_du("", tmp_path / "tree")
+    misses = search._cache_stats[search.DIR_SNAPSHOTS][1]
+    handle_du("", tmp_path / "tree")
+    assert search._cache_stats[search.DIR_SNAPSHOTS] == [misses, misses]
+
+
+# --- Changes since last visit ---
+
+def _changes_tree(root: Path) -> None:
+    (root / "src" / "lib").mkdir(parents=True)
+    (root / "docs").mkdir()
+    (root / "src" / "main.py").write_text("print(1)")
+    (root / "src" / "lib" / "util.py").write_text("x = 1")
+    (root / "docs" / "guide.md").write_text("guide")
+    (root / "notes.txt").write_text("notes")
+
+
+@pytest.fixture
+def changes_env(tmp_path, monkeypatch):
+    monkeypatch.setenv("alfred_workflow_data", str(tmp_path / "data"))
+    monkeypatch.setattr("search_core.CHANGES_RERUN", 0)
+    _changes_tree(tmp_path / "scope")
+    return tmp_path / "scope"
+
+
+def test_changes_first_visit_saves_snapshot(changes_env):
+    results = handle_changes("", changes_env)
+    assert results[0]["title"] == "Snapshot saved: 4 files in 4 folders"
+    assert handle_changes("", changes_env)[0]["title"] == "0 created, 0 modified, 0 deleted"
+    assert handle_changes("all", changes_env)[0]["title"] == "Usage: changes"
+
+
+def test_changes_reports_created_modified_deleted(changes_env):
+    import shutil
+
+    handle_changes("", changes_env)
+    (changes_env / "src" / "new.py").write_text("new")
+    tmp = changes_env / "docs" / "guide.md.tmp"
+    tmp.write_text("guide, rewritten")
+    os.replace(tmp, changes_env / "docs" / "guide.md")  # an editor's atomic save
+    shutil.rmtree(changes_env / "src" / "lib")
+    (changes_env / "notes.txt").unlink()
+
+    results = handle_changes("", changes_env)
+    assert results[0]["title"] == "1 created, 1 modified, 2 deleted"
+    marks = sorted((r["title"], r["subtitle"].split(",")[0]) for r in results[1:])
+    assert marks == [
+        ("guide.md", "✎ modified"), ("new.py", "✚ created"),
+        ("notes.txt", "✖ deleted"), ("util.py", "✖ deleted"),
+    ]
+    assert all(r["valid"] is False for r in results[1:] if "deleted" in r["subtitle"])
+    assert handle_changes("", changes_env)[0]["title"] == "0 created, 0 modified, 0 deleted"
+
+
+def test_changes_rescans_only_directories_whose_mtime_moved(changes_env):
+    import search_core as search
+
+    handle_changes("", changes_env)
+    (changes_env / "src" / "lib" / "more.py").write_text("y = 2")
+    scanned = []
+    real_scan = search._scan_dir_stats
+
+    def scan(path):
+        scanned.append(path)
+        return real_scan(path)
+
+    with patch("search_core._scan_dir_stats", side_effect=scan):
+        results = handle_changes("", changes_env)
+    assert scanned == [str(changes_env / "src" / "lib")]
+    assert [r["title"] for r in results[1:]] == ["more.py"]
+
+
+def test_changes_rerun_keeps_comparing_with_previous_baseline(changes_env, monkeypatch):
+    handle_changes("", changes_env)
+    (changes_env / "docs" / "faq.md").write_text("faq")
+    monkeypatch.setattr("search_core.CHANGES_RERUN", 60)
+    assert handle_changes("", changes_env)[0]["title"] == "1 created, 0 modified, 0 deleted"
+    assert handle_changes("", changes_env)[0]["title"] == "1 created, 0 modified, 0 deleted"